@@ -6,13 +6,21 @@ FastAPI backend для подключения веб-приложения к Pos
 import os
 import uuid
 import shutil
+import asyncio
+from dataclasses import asdict
 from pathlib import Path
 from fastapi import FastAPI, HTTPException, UploadFile, File, Form
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse, FileResponse
 from pydantic import BaseModel
 from typing import Optional
-import asyncpg
+import pg_pool
+from pg_pool import InstrumentedPool
+from query_stats import query_stats
+from poster_catalog import PosterCatalog
+from poster_views import poster_views
+from db import MEDIA_VARIANTS_SQL
+import images
 from contextlib import asynccontextmanager
 import logging
 import httpx
@@ -21,13 +29,6 @@ import httpx
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger("TusaBotAPI")
 
-# Настройки БД из переменных окружения
-DB_HOST = os.getenv("DB_HOST", "localhost")
-DB_PORT = int(os.getenv("DB_PORT", "5432"))
-DB_NAME = os.getenv("DB_NAME", "EuphoriaDB")
-DB_USER = os.getenv("DB_USER", "postgres")
-DB_PASSWORD = os.getenv("DB_PASSWORD", "1")
-
 # Telegram Bot Token для получения файлов
 BOT_TOKEN = os.getenv("BOT_TOKEN", "")
 
@@ -35,7 +36,9 @@ BOT_TOKEN = os.getenv("BOT_TOKEN", "")
 ADMIN_IDS = set(map(int, os.getenv("ADMIN_IDS", "825042510,8160172817").split(",")))
 
 # Глобальный пул соединений
-db_pool: Optional[asyncpg.Pool] = None
+db_pool: Optional[InstrumentedPool] = None
+# Активные афиши в памяти, обновляются по NOTIFY poster_changed
+poster_catalog = PosterCatalog()
 
 
 # Функция проверки админа
@@ -84,23 +87,21 @@ async def lifespan(app: FastAPI):
     # Startup
     global db_pool
     try:
-        db_pool = await asyncpg.create_pool(
-            host=DB_HOST,
-            port=DB_PORT,
-            database=DB_NAME,
-            user=DB_USER,
-            password=DB_PASSWORD,
-            min_size=1,
-            max_size=10,
-        )
+        db_pool = await pg_pool.create_pool(name="api")
         logger.info("Database pool created successfully")
     except Exception as e:
         logger.error(f"Failed to create database pool: {e}")
         raise
+    try:
+        await poster_catalog.start(db_pool)
+    except Exception as e:
+        logger.warning(f"Failed to load poster catalog: {e}")
     
     yield
     
     # Shutdown
+    await poster_catalog.stop()
+    images.shutdown()
     if db_pool:
         await db_pool.close()
         logger.info("Database pool closed")
@@ -149,65 +150,40 @@ async def health_check():
     try:
         async with db_pool.acquire() as conn:
             await conn.fetchval("SELECT 1")
-        return {"status": "healthy", "database": "connected"}
+        snapshot = poster_catalog.snapshot
+        return {
+            "status": "healthy",
+            "database": "connected",
+            "pool": db_pool.stats(),
+            "poster_catalog": {
+                "active": len(snapshot.posters),
+                "loaded_at": snapshot.loaded_at.isoformat() if snapshot.loaded_at else None,
+                "refreshes": poster_catalog.refreshes,
+            },
+        }
     except Exception as e:
         logger.error(f"Health check failed: {e}")
         raise HTTPException(status_code=503, detail=f"Database connection failed: {str(e)}")
 
 
+@app.get("/db-stats")
+async def db_stats(user_id: int, limit: int = 30):
+    """Время запросов к БД в этом процессе API (только для админов)"""
+    if not is_admin(user_id):
+        raise HTTPException(status_code=403, detail="Access denied. Admins only.")
+    return {
+        "pool": db_pool.stats() if db_pool else None,
+        "queries": query_stats.snapshot()[:limit],
+    }
+
+
 @app.get("/posters")
 async def get_posters():
-    """Получить все активные афиши"""
+    """Получить все активные афиши (из каталога в памяти, новые первыми)"""
     if not db_pool:
         raise HTTPException(status_code=503, detail="Database not available")
     
-    try:
-        async with db_pool.acquire() as conn:
-            rows = await conn.fetch(
-                """
-                SELECT id, file_id, caption, ticket_url, venue_map_file_id, created_at, is_active
-                FROM posters
-                WHERE is_active = true
-                ORDER BY created_at DESC
-                """
-            )
-            
-            posters = []
-            for row in rows:
-                file_id = row['file_id']
-                # Проверяем, является ли file_id локальным путем к файлу
-                is_local_file = file_id.startswith('/posters/') or file_id.startswith('posters/')
-                
-                caption = row['caption'] or ""
-                lines = caption.split('\n', 1)
-                title = lines[0] if lines else "Мероприятие"
-                subtitle = lines[1] if len(lines) > 1 else ""
-                
-                # Формируем URL для фото
-                if is_local_file:
-                    # Убедимся что путь начинается с /
-                    photo_url = file_id if file_id.startswith('/') else f'/{file_id}'
-                else:
-                    # Это Telegram file_id, используем прокси
-                    photo_url = f"/photo/{file_id}"
-                
-                posters.append({
-                    "id": row['id'],
-                    "file_id": file_id,
-                    "photo_url": photo_url,
-                    "caption": caption,
-                    "title": title,
-                    "subtitle": subtitle,
-                    "ticket_url": row['ticket_url'],
-                    "venue_map_file_id": row['venue_map_file_id'],
-                    "created_at": row['created_at'].isoformat(),
-                    "is_active": row['is_active']
-                })
-            
-            return posters
-    except Exception as e:
-        logger.error(f"Failed to fetch posters: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+    return poster_views.get(poster_catalog.posters).web
 
 
 @app.get("/posters/latest")
@@ -216,54 +192,10 @@ async def get_latest_poster():
     if not db_pool:
         raise HTTPException(status_code=503, detail="Database not available")
     
-    try:
-        async with db_pool.acquire() as conn:
-            row = await conn.fetchrow(
-                """
-                SELECT id, file_id, caption, ticket_url, venue_map_file_id, created_at, is_active
-                FROM posters
-                WHERE is_active = true
-                ORDER BY created_at DESC
-                LIMIT 1
-                """
-            )
-            
-            if not row:
-                raise HTTPException(status_code=404, detail="No active posters found")
-            
-            # Парсим caption для разделения на title и subtitle
-            caption = row['caption'] or ""
-            lines = caption.split('\n', 1)
-            title = lines[0] if lines else "Мероприятие"
-            subtitle = lines[1] if len(lines) > 1 else ""
-            
-            # file_id теперь может быть путем к файлу (/posters/poster_123.jpg) или Telegram file_id
-            file_id = row['file_id']
-            is_local_file = file_id.startswith('/posters/') or file_id.startswith('posters/')
-            
-            # Формируем URL для фото
-            if is_local_file:
-                photo_url = file_id if file_id.startswith('/') else f'/{file_id}'
-            else:
-                photo_url = f"/photo/{file_id}"
-            
-            return {
-                "id": row['id'],
-                "file_id": file_id,
-                "photo_url": photo_url,
-                "caption": caption,
-                "title": title,
-                "subtitle": subtitle,
-                "ticket_url": row['ticket_url'],
-                "venue_map_file_id": row['venue_map_file_id'],
-                "created_at": row['created_at'].isoformat(),
-                "is_active": row['is_active']
-            }
-    except HTTPException:
-        raise
-    except Exception as e:
-        logger.error(f"Failed to fetch latest poster: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+    latest = poster_views.get(poster_catalog.posters).latest
+    if not latest:
+        raise HTTPException(status_code=404, detail="No active posters found")
+    return latest.web
 
 
 @app.get("/posters/{poster_id}")
@@ -310,34 +242,20 @@ async def get_stats():
     
     try:
         async with db_pool.acquire() as conn:
-            # Статистика пользователей
-            user_stats = await conn.fetchrow("""
-                SELECT 
-                    COUNT(*) as total_users,
-                    COUNT(vk_id) as users_with_vk,
-                    COUNT(CASE WHEN gender = 'male' THEN 1 END) as male_users,
-                    COUNT(CASE WHEN gender = 'female' THEN 1 END) as female_users
-                FROM users
-            """)
-            
-            # Статистика афиш
-            poster_stats = await conn.fetchrow("""
-                SELECT 
-                    COUNT(*) as total_posters,
-                    COUNT(CASE WHEN is_active = true THEN 1 END) as active_posters
-                FROM posters
-            """)
+            # Счётчики ведут триггеры (migrations/005_stats_counters.sql) — без COUNT(*) по таблицам
+            rows = await conn.fetch("SELECT name, value FROM stats_counters")
+            counters = {row['name']: row['value'] for row in rows}
             
             return {
                 "users": {
-                    "total": user_stats['total_users'],
-                    "with_vk": user_stats['users_with_vk'],
-                    "male": user_stats['male_users'],
-                    "female": user_stats['female_users']
+                    "total": counters.get('users_total', 0),
+                    "with_vk": counters.get('users_with_vk', 0),
+                    "male": counters.get('users_male', 0),
+                    "female": counters.get('users_female', 0)
                 },
                 "posters": {
-                    "total": poster_stats['total_posters'],
-                    "active": poster_stats['active_posters']
+                    "total": counters.get('posters_total', 0),
+                    "active": counters.get('posters_active', 0)
                 }
             }
     except Exception as e:
@@ -392,8 +310,9 @@ async def get_stories():
     try:
         async with db_pool.acquire() as conn:
             rows = await conn.fetch(
-                """
-                SELECT id, file_id, caption, slot_number, created_at, is_active
+                f"""
+                SELECT id, file_id, caption, slot_number, created_at, is_active,
+                       {MEDIA_VARIANTS_SQL.format(source="file_id")}
                 FROM stories
                 WHERE is_active = true
                 ORDER BY slot_number ASC
@@ -414,7 +333,9 @@ async def get_stories():
                 stories.append({
                     "id": row['id'],
                     "file_id": file_id,
-                    "photo_url": photo_url,
+                    # Уменьшенная копия, если она есть, иначе оригинал
+                    "photo_url": images.pick_variant(row['variants']) or photo_url,
+                    "images": images.variants_json(row['variants']),
                     "caption": row['caption'],
                     "slot_number": row['slot_number'],
                     "created_at": row['created_at'].isoformat(),
@@ -555,6 +476,11 @@ async def check_admin_endpoint(user_id: int):
     return {"is_admin": is_admin(user_id)}
 
 
+def save_upload(src, file_path: Path) -> None:
+    with open(file_path, "wb") as buffer:
+        shutil.copyfileobj(src, buffer)
+
+
 @app.post("/upload-story-photo")
 async def upload_story_photo(
     user_id: int = Form(...),
@@ -579,19 +505,22 @@ async def upload_story_photo(
         unique_filename = f"{uuid.uuid4()}{file_extension}"
         file_path = upload_dir / unique_filename
         
-        # Сохраняем файл
-        with open(file_path, "wb") as buffer:
-            shutil.copyfileobj(file.file, buffer)
+        # Сохраняем файл (в потоке, чтобы не блокировать event loop)
+        await asyncio.to_thread(save_upload, file.file, file_path)
         
         # Возвращаем относительный путь для сохранения в БД
         relative_path = f"/uploads/stories/{unique_filename}"
         
         logger.info(f"Story photo uploaded: {relative_path}")
         
+        # Уменьшенные копии для веб-приложения (в процессе пула images)
+        variants = await images.process_upload(db_pool, relative_path, file_path, "/uploads/stories")
+        
         return {
             "success": True,
             "photo_url": relative_path,
-            "filename": unique_filename
+            "filename": unique_filename,
+            "images": images.variants_json(asdict(v) for v in variants),
         }
     except Exception as e:
         logger.error(f"Failed to upload story photo: {e}")
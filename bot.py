@@ -1,7 +1,8 @@
 import os
+import tempfile
 import logging
 import asyncio
-from datetime import datetime, timedelta, time, timezone
+from datetime import date, datetime, timedelta, time, timezone
 from pathlib import Path
 import pytz
 from typing import Set, Optional
@@ -24,14 +25,15 @@ from telegram import (
     Update,
     InlineKeyboardButton,
     InlineKeyboardMarkup,
+    Message,
     ReplyKeyboardMarkup,
     KeyboardButton,
-    ReplyKeyboardRemove,
+    InputMediaPhoto,
     BotCommand,
     WebAppInfo,
 )
 from telegram.constants import ChatMemberStatus
-from telegram.error import Forbidden
+from telegram.error import BadRequest, Forbidden
 from telegram.ext import (
     Application,
     ApplicationBuilder,
@@ -46,12 +48,31 @@ from telegram.ext import (
 )
 from telegram.request import HTTPXRequest
 from db import (
-    create_pool, init_schema, upsert_user, get_user, get_user_by_username, 
-    get_all_user_ids, get_user_stats, export_users_to_excel,
-    create_poster, get_active_posters, get_latest_poster, get_poster_by_id,
-    deactivate_poster, delete_poster as db_delete_poster, update_poster_ticket_url,
+    create_pool, init_schema, get_user, get_user_by_username, search_users,
+    get_user_stats,
+    create_poster, get_latest_poster, get_poster_by_id,
+    deactivate_poster, delete_poster as db_delete_poster, update_poster_ticket_url, replace_file_id,
     mark_attendance, get_user_attendances, get_poster_attendances, get_attendance_stats,
-    create_story, get_active_stories, delete_story, update_story_order, update_story_caption
+    create_story, get_active_stories, delete_story, update_story_order, update_story_caption,
+    unblock_user, count_segment_users, get_recent_broadcast_jobs, get_broadcast_job, count_broadcast_messages
+)
+from user_cache import user_cache
+from roster import UserRoster, ROSTER_SYNC_INTERVAL
+from poster_catalog import PosterCatalog
+from poster_views import poster_views
+from images import process_upload, shutdown as shutdown_image_workers
+from file_id_check import (
+    FILE_ID_CHECK_INTERVAL, FILE_ID_UPLOAD_CHAT_ID, check_file_ids, is_local_file, local_photo,
+)
+from excel_export import export_users_to_excel
+from bulk_io import BULK_TABLES, export_table, import_table
+from query_stats import query_stats, DB_SLOW_QUERY_MS
+from registration_buffer import RegistrationBuffer
+from broadcast import (
+    BROADCAST_CONCURRENCY, BroadcastResult, BroadcastTask, launch_broadcast_job, get_broadcast_task,
+    stop_background_broadcasts, resume_broadcast_jobs, text_payload, photo_payload,
+    parse_segment, describe_segment, copy_payload, stage_message, job_summary, BROADCAST_STAGING_CHAT_ID,
+    launch_broadcast_revision, get_revision_task, run_reengage_job,
 )
 
 # ----------------------
@@ -125,6 +146,9 @@ WEEKLY_MINUTE = int(_get_env("WEEKLY_MINUTE", "0"))
 PROXY_URL = _get_env("PROXY_URL", "")
 # Convert MSK (UTC+3) local hour to UTC for job queue
 WEEKLY_HOUR_UTC = (WEEKLY_HOUR_LOCAL - 3) % 24
+# Допустимый возраст — как в ограничении users_age_check (миграция 011)
+MIN_AGE = 16
+MAX_AGE = 100
 
 logger.info("Loaded .env from: %s", _DOTENV_PATH)
 
@@ -145,14 +169,10 @@ def ensure_data_dir() -> None:
     DATA_DIR.mkdir(exist_ok=True)
 
 
-def week_key_for_date(dt: datetime) -> str:
-    iso_year, iso_week, _ = dt.isocalendar()
-    return f"{iso_year}-W{iso_week:02d}"
-
-
-def previous_week_key(now: datetime) -> str:
-    last_week_date = now - timedelta(days=7)
-    return week_key_for_date(last_week_date)
+def previous_week_start(now: datetime) -> date:
+    """Понедельник прошлой недели"""
+    last_week_date = (now - timedelta(days=7)).date()
+    return last_week_date - timedelta(days=last_week_date.weekday())
 
 
 async def is_user_subscribed(context: ContextTypes.DEFAULT_TYPE, user_id: int) -> tuple[bool, bool, bool]:
@@ -201,13 +221,114 @@ async def get_bot_channel_status(context: ContextTypes.DEFAULT_TYPE) -> str:
         return f"❌ Не удалось проверить статус бота в {CHANNEL_USERNAME}. Убедитесь, что бот добавлен в канал как администратор."
 
 
-def get_known_users(context: ContextTypes.DEFAULT_TYPE) -> Set[int]:
+def get_known_users(context: ContextTypes.DEFAULT_TYPE) -> UserRoster:
     bd = context.bot_data
     if "known_users" not in bd:
-        bd["known_users"] = set()
+        bd["known_users"] = UserRoster()
     return bd["known_users"]
 
 
+def get_poster_catalog(context: ContextTypes.DEFAULT_TYPE) -> PosterCatalog:
+    bd = context.bot_data
+    if "poster_catalog" not in bd:
+        bd["poster_catalog"] = PosterCatalog()
+    return bd["poster_catalog"]
+
+
+def get_all_posters(context: ContextTypes.DEFAULT_TYPE) -> tuple:
+    """Активные афиши от старых к новым; афиша из /save_poster (без записи в БД) — последней"""
+    posters = get_poster_catalog(context).posters
+    manual = context.bot_data.get("poster")
+    if manual and not manual.get("id"):
+        posters = (*posters, manual)
+    return posters
+
+
+def get_current_poster(context: ContextTypes.DEFAULT_TYPE):
+    posters = get_all_posters(context)
+    return posters[-1] if posters else None
+
+
+def forget_blocked_users(context: ContextTypes.DEFAULT_TYPE, result: BroadcastResult) -> None:
+    """Убрать из рассылок тех, кто заблокировал бота (в БД они уже отмечены)"""
+    if result.blocked_ids:
+        get_known_users(context).mark_blocked(result.blocked_ids)
+
+
+def start_broadcast(
+    context: ContextTypes.DEFAULT_TYPE,
+    kind: str,
+    payload: dict,
+    *,
+    title: str,
+    name: str,
+    progress_message=None,
+    created_by: Optional[int] = None,
+    segment: Optional[dict] = None,
+    on_done=None,
+) -> BroadcastTask:
+    """Запустить рассылку в фоне: всем известным пользователям или сегменту из БД"""
+    async def done(result: BroadcastResult) -> None:
+        forget_blocked_users(context, result)
+        if on_done:
+            await on_done(result)
+
+    return launch_broadcast_job(
+        get_db_pool(context),
+        context.bot,
+        kind,
+        payload,
+        get_known_users(context),
+        title=title,
+        name=name,
+        created_by=created_by,
+        segment=segment,
+        progress_message=progress_message,
+        on_done=done,
+    )
+
+
+async def copy_or_build_payload(
+    context: ContextTypes.DEFAULT_TYPE, preview: dict, kind: str, payload: dict
+) -> tuple[str, dict]:
+    """Рассылать копией сообщения предпросмотра, если оно есть.
+
+    copyMessage сохраняет форматирование ровно как в предпросмотре и не гоняет
+    подпись с entities в каждом запросе. Без предпросмотра — обычная отправка.
+    """
+    source = preview.get("preview_message")
+    if not source:
+        return kind, payload
+    try:
+        from_chat_id, message_id = await stage_message(context.bot, *source)
+    except Exception as e:
+        logger.warning("Failed to stage broadcast message, copying the preview: %s", e)
+        from_chat_id, message_id = source
+    return "copy", copy_payload(
+        from_chat_id, message_id, reply_markup=preview.get("button_markup"), media=preview.get("type") == "photo"
+    )
+
+
+async def send_broadcast_confirmation(message: Message, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Спросить подтверждение рассылки из broadcast_preview с выбранной аудиторией"""
+    preview = context.user_data.get("broadcast_preview") or {}
+    segment = preview.get("segment")
+    audience = describe_segment(segment)
+    if segment is not None:
+        audience += f" ({preview.get('audience_size', 0)} чел.)"
+    else:
+        audience += f" ({len(get_known_users(context))} чел.)"
+    
+    rows = [[InlineKeyboardButton("✅ Да, отправить", callback_data=f"broadcast:confirm_{preview.get('type')}")]]
+    if get_db_pool(context):
+        rows.append([InlineKeyboardButton("🎯 Выбрать аудиторию", callback_data="broadcast:segment")])
+    rows.append([InlineKeyboardButton("❌ Нет, отменить", callback_data="broadcast:cancel")])
+    await message.reply_text(
+        f"✅ Всё верно? Отправить рассылку?\n🎯 Аудитория: {audience}",
+        reply_markup=InlineKeyboardMarkup(rows)
+    )
+
+
 def get_db_pool(context: ContextTypes.DEFAULT_TYPE):
     try:
         return context.application.bot_data.get("db_pool")
@@ -215,6 +336,13 @@ def get_db_pool(context: ContextTypes.DEFAULT_TYPE):
         return None
 
 
+def save_profile(context: ContextTypes.DEFAULT_TYPE, tg_id: int, **fields) -> None:
+    """Сохранить поля профиля через буфер регистрации (запись в БД пачкой)"""
+    buffer = context.application.bot_data.get("registration_buffer")
+    if buffer:
+        buffer.update(tg_id, **fields)
+
+
 async def load_user_data_from_db(context: ContextTypes.DEFAULT_TYPE, user_id: int):
     """Загружает данные пользователя из БД в context.user_data"""
     logger.info("=== LOAD_USER_DATA_FROM_DB START ===")
@@ -239,13 +367,19 @@ async def load_user_data_from_db(context: ContextTypes.DEFAULT_TYPE, user_id: in
             # Загружаем все доступные данные
             context.user_data["name"] = user_in_db.get("name")
             context.user_data["gender"] = user_in_db.get("gender")
-            context.user_data["age"] = user_in_db.get("age")
+            age = user_in_db.get("age")
+            # Старые базы принимали возраст от 14: такой возраст спрашиваем заново,
+            # сама запись в БД не меняется, пока пользователь не ответит
+            if age is not None and not MIN_AGE <= age <= MAX_AGE:
+                logger.info("User %s has out-of-range age %s, asking again", user_id, age)
+                age = None
+            context.user_data["age"] = age
             
             # Проверяем полноту регистрации - нужны минимум имя, пол и возраст
             has_required_data = (
                 user_in_db.get("name") and 
                 user_in_db.get("gender") and 
-                user_in_db.get("age") is not None
+                age is not None
             )
             
             if has_required_data:
@@ -337,6 +471,13 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     
     # Загружаем данные пользователя из БД
     if pool:
+        # Повторный /start после блокировки: пользователь снова получает рассылки
+        try:
+            if await unblock_user(pool, user.id):
+                get_known_users(context).unblock(user.id)
+                logger.info("User %s unblocked the bot, back in broadcasts", user.id)
+        except Exception as e:
+            logger.warning("Failed to unblock user %s: %s", user.id, e)
         await load_user_data_from_db(context, user.id)
     else:
         logger.warning("No DB pool - cannot load user data")
@@ -459,8 +600,37 @@ async def menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     await show_main_menu(update, context)
 
 
-async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Показать главное меню с текущей афишей и навигацией"""
+async def edit_poster_in_place(
+    message: Message, file_id: str, caption: str, reply_markup: InlineKeyboardMarkup
+) -> bool:
+    """Показать афишу в существующем сообщении с фото. False — если нужно отправить заново"""
+    if not message.photo or not file_id or file_id.startswith('/'):
+        return False
+    try:
+        await message.edit_media(
+            InputMediaPhoto(media=file_id, caption=caption, parse_mode='HTML'),
+            reply_markup=reply_markup,
+        )
+        return True
+    except BadRequest as e:
+        # Та же афиша с теми же кнопками — показывать нечего, это не ошибка
+        if "not modified" in str(e).lower():
+            return True
+        logger.info("Failed to edit poster in place, resending: %s", e)
+        return False
+
+
+async def show_main_menu(
+    update: Update, context: ContextTypes.DEFAULT_TYPE, carousel_message: Optional[Message] = None
+) -> None:
+    """Показать главное меню с текущей афишей и навигацией.
+
+    С `carousel_message` (сообщение-афиша, на котором нажали кнопку) афиша
+    подменяется в нём же через editMessageMedia — один запрос к Bot API
+    вместо удаления и отправки заново. Если подменить не вышло (это не фото,
+    сообщение слишком старое), старое сообщение удаляется и афиша
+    отправляется новым.
+    """
     user = update.effective_user
     if not user:
         return
@@ -479,6 +649,13 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
     
     logger.info("show_main_menu for user %s: registered=%s", user.id, is_registered)
     
+    if carousel_message is not None and (not is_registered or not get_all_posters(context)):
+        # Подменять нечем — старое сообщение убираем, как раньше
+        try:
+            await carousel_message.delete()
+        except Exception:
+            pass
+    
     if not is_registered:
         logger.info("User %s not registered in show_main_menu - redirecting to registration", user.id)
         await update.effective_chat.send_message(
@@ -488,13 +665,7 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         return
     
     # Получаем все афиши
-    all_posters = context.bot_data.get("all_posters", [])
-    current_poster = context.bot_data.get("poster")
-    
-    # Если есть текущая афиша, но её нет в списке всех афиш, добавляем
-    if current_poster and current_poster not in all_posters:
-        all_posters.append(current_poster)
-        context.bot_data["all_posters"] = all_posters
+    all_posters = get_all_posters(context)
     
     if not all_posters:
         # Нет афиш - показываем заглушку
@@ -520,85 +691,52 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         current_poster_index = 0
         context.user_data["current_poster_index"] = current_poster_index
     
-    # Показываем текущую афишу
+    # Показываем текущую афишу: подпись и кнопки готовятся один раз на версию каталога
+    is_admin = user.id in get_admins(context)
+    views = poster_views.get(all_posters)
     poster = all_posters[current_poster_index]
-    
-    # Создаем кнопки навигации и действий
-    nav_buttons = []
-    
-    # Навигация по афишам (если больше одной)
-    if len(all_posters) > 1:
-        nav_row = []
-        if current_poster_index > 0:
-            nav_row.append(InlineKeyboardButton("⬅️ Предыдущая", callback_data="poster_prev"))
-        if current_poster_index < len(all_posters) - 1:
-            nav_row.append(InlineKeyboardButton("➡️ Следующая", callback_data="poster_next"))
-        if nav_row:
-            nav_buttons.append(nav_row)
-    
-    # Основные кнопки действий в правильном порядке
-    action_buttons = []
-    
-    # 1. Кнопка билетов (если есть ссылка)
-    if poster.get("ticket_url"):
-        action_buttons.append([InlineKeyboardButton("🎫 Купить билет", url=poster["ticket_url"])])
-    
-    # 2. Кнопка работы промоутером
-    action_buttons.append([InlineKeyboardButton("💼 Работа промоутером", url="https://t.me/euphoriamsktus")])
-    
-    # 3. Кнопка схемы зала (если есть)
-    if poster.get("venue_map_file_id"):
-        action_buttons.append([InlineKeyboardButton("🗺 Схема зала", callback_data=f"view_venue_map:{current_poster_index}")])
-    
-    # Админские кнопки
-    if user and user.id in get_admins(context):
-        admin_row = []
-        admin_row.append(InlineKeyboardButton("🛠 Админ-панель", callback_data="open_admin"))
-        if len(all_posters) > 0:
-            admin_row.append(InlineKeyboardButton("🗑 Удалить", callback_data=f"delete_poster:{current_poster_index}"))
-        action_buttons.append(admin_row)
-    
-    # Собираем все кнопки
-    all_buttons = nav_buttons + action_buttons
+    caption, markup = views.carousel(current_poster_index, is_admin)
     
     # Отправляем или редактируем афишу
     try:
-        caption = poster.get("caption", "")
-        if len(all_posters) > 1:
-            caption += f"\n\n📍 Афиша {current_poster_index + 1} из {len(all_posters)}"
-        
         file_id = poster.get("file_id")
-        photo_path = poster.get("photo_path")
+        photo_path = poster.get("photo_path") or (file_id if is_local_file(file_id) else None)
+        # file_id, который проверка пометила нерабочим, не пробуем, если есть локальная копия
+        use_file_id = not is_local_file(file_id) and not (
+            poster.get("file_id_broken_at") and local_photo(photo_path)
+        )
         
         # Проверяем что file_id существует
         if not file_id:
             logger.error("Poster has no file_id: %s", poster)
             await update.effective_chat.send_message(
                 "❌ Ошибка: афиша не содержит фото.\n\nПожалуйста, пересоздайте афишу.",
-                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🛠 Админ-панель", callback_data="open_admin")]]) if user.id in get_admins(context) else None
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🛠 Админ-панель", callback_data="open_admin")]]) if is_admin else None
             )
             return
         
-        logger.info("Sending poster with file_id: %s, photo_path: %s", file_id, photo_path)
+        if carousel_message is not None:
+            if use_file_id and await edit_poster_in_place(carousel_message, file_id, caption, markup):
+                return
+            try:
+                await carousel_message.delete()
+            except Exception:
+                pass
         
-        # Убираем админскую клавиатуру если была
-        keyboard_remove_msg = await update.effective_chat.send_message(
-            "📋 Главное меню", 
-            reply_markup=ReplyKeyboardRemove()
-        )
+        logger.info("Sending poster with file_id: %s, photo_path: %s", file_id, photo_path)
         
         # Пытаемся отправить афишу - сначала с file_id, если не работает - с локального файла
         photo_sent = False
         
         # Попытка 1: Используем Telegram file_id
-        if file_id and not file_id.startswith('/'):
+        if use_file_id:
             try:
                 await context.bot.send_photo(
                     chat_id=update.effective_chat.id,
                     photo=file_id,
                     caption=caption,
                     parse_mode='HTML',
-                    reply_markup=InlineKeyboardMarkup(all_buttons)
+                    reply_markup=markup
                 )
                 photo_sent = True
                 logger.info("Poster sent successfully using file_id")
@@ -608,31 +746,29 @@ async def show_main_menu(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         # Попытка 2: Используем локальный файл если file_id не сработал
         if not photo_sent and photo_path:
             try:
-                local_file = Path(__file__).parent / "project" / "public" / photo_path.lstrip("/")
-                if local_file.exists():
+                local_file = local_photo(photo_path)
+                if local_file:
                     with open(local_file, 'rb') as photo_file:
-                        await context.bot.send_photo(
+                        sent = await context.bot.send_photo(
                             chat_id=update.effective_chat.id,
                             photo=photo_file,
                             caption=caption,
                             parse_mode='HTML',
-                            reply_markup=InlineKeyboardMarkup(all_buttons)
+                            reply_markup=markup
                         )
                     photo_sent = True
                     logger.info("Poster sent successfully using local file: %s", local_file)
+                    # Запоминаем свежий file_id, чтобы следующие показы не загружали файл заново
+                    pool = get_db_pool(context)
+                    if pool and poster.get("id") and not is_local_file(file_id):
+                        await replace_file_id(pool, "poster", poster["id"], file_id, sent.photo[-1].file_id)
                 else:
-                    logger.error("Local file not found: %s", local_file)
+                    logger.error("Local file not found: %s", photo_path)
             except Exception as e:
                 logger.error("Failed to send with local file: %s", e)
         
         if not photo_sent:
             raise Exception("Failed to send poster with both file_id and local file")
-        
-        # Удаляем сообщение "Главное меню" чтобы не дублировать
-        try:
-            await keyboard_remove_msg.delete()
-        except:
-            pass  # Игнорируем ошибки удаления
             
     except Exception as e:
         logger.exception("Failed to send poster: %s", e)
@@ -652,6 +788,152 @@ async def show_id(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         await update.effective_chat.send_message(f"Ваш ID: {user.id}")
 
 
+async def send_subscription_report(
+    message: Message, context: ContextTypes.DEFAULT_TYPE, target_user_id: int, username_display: str
+) -> None:
+    """Отчёт о подписках пользователя для админской проверки по username/ID"""
+    # Проверяем подписки на каналы и чат
+    tg1_ok, tg2_ok, chat_ok = await is_user_subscribed(context, target_user_id)
+
+    # Формируем отчет (экранируем специальные символы Markdown)
+    def escape_markdown(text):
+        """Экранирует специальные символы для Markdown"""
+        special_chars = ['_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|', '{', '}', '.', '!']
+        for char in special_chars:
+            text = text.replace(char, '\\' + char)
+        return text
+
+    username_safe = escape_markdown(str(username_display))
+
+    report = f"🔍 **Проверка подписок для {username_safe}**\n\n"
+    report += f"👤 Telegram ID: `{target_user_id}`\n\n"
+    report += "📺 **Telegram каналы:**\n"
+    report += f"{'✅' if tg1_ok else '❌'} {CHANNEL_USERNAME} \\(MEDIA FAM\\)\n"
+    report += f"{'✅' if tg2_ok else '❌'} {CHANNEL_USERNAME_2} \\(THE FAMILY\\)\n\n"
+    report += "💬 **Telegram чат:**\n"
+    report += f"{'✅' if chat_ok else '❌'} {CHAT_USERNAME} \\(Family Guests\\)\n"
+
+    all_ok = tg1_ok and tg2_ok and chat_ok
+    report += f"\n{'🎉 **Все подписки активны\\!**' if all_ok else '⚠️ **Не все подписки активны**'}"
+
+    # Кнопки в зависимости от режима
+    if context.user_data.get("continuous_check_mode"):
+        # Режим непрерывной проверки - оставляем флаг активным
+        kb = [[InlineKeyboardButton("🔙 Завершить проверку", callback_data="admin:stop_check")]]
+        await message.reply_text(
+            report + "\n\n💡 Введите следующий username или нажмите 'Завершить проверку'",
+            reply_markup=InlineKeyboardMarkup(kb),
+            parse_mode="MarkdownV2"
+        )
+        # НЕ сбрасываем флаг awaiting_username_check!
+    else:
+        # Обычный режим - одна проверка
+        context.user_data["awaiting_username_check"] = False
+        await message.reply_text(
+            report,
+            reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад в панель", callback_data="admin:refresh")]]),
+            parse_mode="MarkdownV2"
+        )
+
+
+async def send_users_export(context: ContextTypes.DEFAULT_TYPE, status_message: Message) -> None:
+    """Собрать Excel с пользователями в фоне и отправить его админу"""
+    back = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад в панель", callback_data="admin:refresh")]])
+    file_path = None
+    try:
+        file_path = await export_users_to_excel(get_db_pool(context))
+        with open(file_path, 'rb') as f:
+            await context.bot.send_document(
+                chat_id=status_message.chat_id,
+                document=f,
+                filename="users_export.xlsx",
+                caption="📊 Экспорт пользователей TusaBot"
+            )
+        await status_message.edit_text("✅ Файл экспорта отправлен!", reply_markup=back)
+    except Exception as e:
+        logger.error("Failed to export users: %s", e)
+        await status_message.edit_text(f"❌ Ошибка экспорта: {e}", reply_markup=back)
+    finally:
+        context.application.bot_data["users_export_running"] = False
+        if file_path:
+            os.remove(file_path)
+
+
+async def send_bulk_export(context: ContextTypes.DEFAULT_TYPE, status_message: Message) -> None:
+    """Выгрузить users и attendances в CSV.gz в фоне и отправить файлы админу"""
+    back = InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад в панель", callback_data="admin:refresh")]])
+    stamp = datetime.now().strftime("%Y%m%d_%H%M")
+    with tempfile.TemporaryDirectory(prefix="bulk_export_") as tmp:
+        try:
+            counts = []
+            for table in BULK_TABLES:
+                path = os.path.join(tmp, f"{table}_{stamp}.csv.gz")
+                count = await export_table(get_db_pool(context), table, path)
+                with open(path, 'rb') as f:
+                    await context.bot.send_document(
+                        chat_id=status_message.chat_id,
+                        document=f,
+                        filename=os.path.basename(path),
+                        caption=f"📦 {table}: {count} строк"
+                    )
+                counts.append(f"{table}: {count}")
+            await status_message.edit_text("✅ Выгрузка отправлена (" + ", ".join(counts) + ")", reply_markup=back)
+        except Exception as e:
+            logger.error("Failed to dump tables: %s", e)
+            await status_message.edit_text(f"❌ Ошибка выгрузки: {e}", reply_markup=back)
+        finally:
+            context.application.bot_data["bulk_io_running"] = False
+
+
+async def run_bulk_import(context: ContextTypes.DEFAULT_TYPE, table: str, path: str, status_message: Message) -> None:
+    """Загрузить присланный CSV.gz в таблицу в фоне"""
+    try:
+        loaded, written = await import_table(get_db_pool(context), table, path)
+        if table == "users":
+            # Профили изменены в обход функций db.py
+            user_cache.clear()
+        skipped = f", пропущено {loaded - written}" if loaded != written else ""
+        await status_message.edit_text(f"✅ {table}: прочитано {loaded} строк, записано {written}{skipped}")
+    except Exception as e:
+        logger.error("Failed to import %s: %s", table, e)
+        await status_message.edit_text(f"❌ Ошибка загрузки {table}: {e}")
+    finally:
+        context.application.bot_data["bulk_io_running"] = False
+        os.remove(path)
+
+
+async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Файлы от админа: загрузка CSV.gz после кнопки «Загрузка CSV.gz»"""
+    if not context.user_data.get("awaiting_bulk_import") or not await admin_only(update, context):
+        return
+    document = update.message.document
+    file_name = document.file_name or ""
+    table = next((name for name in BULK_TABLES if file_name.startswith(name)), None)
+    if table is None or not file_name.endswith(".csv.gz"):
+        await update.message.reply_text(
+            "❌ Нужен файл " + " или ".join(f"{name}*.csv.gz" for name in BULK_TABLES)
+        )
+        return
+    if context.application.bot_data.get("bulk_io_running"):
+        await update.message.reply_text("⏳ Выгрузка или загрузка уже идёт, попробуйте позже")
+        return
+    context.user_data["awaiting_bulk_import"] = False
+    context.application.bot_data["bulk_io_running"] = True
+    status_message = await update.message.reply_text(f"⏳ Загружаю {file_name} в {table}...")
+    fd, path = tempfile.mkstemp(suffix=".csv.gz")
+    os.close(fd)
+    try:
+        telegram_file = await document.get_file()
+        await telegram_file.download_to_drive(path)
+    except Exception as e:
+        context.application.bot_data["bulk_io_running"] = False
+        os.remove(path)
+        logger.error("Failed to download import file: %s", e)
+        await status_message.edit_text(f"❌ Не удалось скачать файл: {e}")
+        return
+    context.application.create_task(run_bulk_import(context, table, path, status_message))
+
+
 async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     query = update.callback_query
     try:
@@ -722,26 +1004,18 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         
         elif data == "show_current_poster":
             # Показать актуальную афишу (последнюю)
-            all_posters = context.bot_data.get("all_posters", [])
+            all_posters = get_all_posters(context)
             if all_posters:
                 context.user_data["current_poster_index"] = len(all_posters) - 1
-            # UX: удаляем старое сообщение и отправляем новое фото афиши
-            try:
-                await query.message.delete()
-            except Exception:
-                pass
-            await show_main_menu(update, context)
+            # UX: подменяем афишу в том же сообщении (или отправляем заново)
+            await show_main_menu(update, context, carousel_message=query.message)
         
         elif data == "poster":
             # Показать актуальную афишу (последнюю) - для совместимости
-            all_posters = context.bot_data.get("all_posters", [])
+            all_posters = get_all_posters(context)
             if all_posters:
                 context.user_data["current_poster_index"] = len(all_posters) - 1
-            try:
-                await query.message.delete()
-            except Exception:
-                pass
-            await show_main_menu(update, context)
+            await show_main_menu(update, context, carousel_message=query.message)
         
         elif data == "open_admin":
             # Открыть админ-панель через callback
@@ -752,32 +1026,24 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             await load_user_data_from_db(context, user.id)
             
             # Сбрасываем индекс афиши на последнюю (самую новую)
-            all_posters = context.bot_data.get("all_posters", [])
+            all_posters = get_all_posters(context)
             if all_posters:
                 context.user_data["current_poster_index"] = len(all_posters) - 1
-            try:
-                await query.message.delete()
-            except Exception:
-                pass
-            await show_main_menu(update, context)
+            await show_main_menu(update, context, carousel_message=query.message)
         
         elif data == "poster_prev":
             # Переход к предыдущей афише
-            all_posters = context.bot_data.get("all_posters", [])
+            all_posters = get_all_posters(context)
             current_index = context.user_data.get("current_poster_index", len(all_posters) - 1 if all_posters else 0)
             if current_index > 0:
                 context.user_data["current_poster_index"] = current_index - 1
-            try:
-                await query.message.delete()
-            except Exception:
-                pass
-            await show_main_menu(update, context)
+            await show_main_menu(update, context, carousel_message=query.message)
         
         elif data.startswith("view_venue_map:"):
             # Просмотр схемы зала
             try:
                 poster_index = int(data.split(":", 1)[1])
-                all_posters = context.bot_data.get("all_posters", [])
+                all_posters = get_all_posters(context)
                 
                 if poster_index < 0 or poster_index >= len(all_posters):
                     await query.answer("❌ Афиша не найдена")
@@ -808,7 +1074,7 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             # Удаление афиши по индексу из главного меню
             try:
                 poster_index = int(data.split(":", 1)[1])
-                all_posters = context.bot_data.get("all_posters", [])
+                all_posters = get_all_posters(context)
                 
                 if poster_index < 0 or poster_index >= len(all_posters):
                     await query.answer("❌ Афиша не найдена")
@@ -869,23 +1135,11 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                     await query.edit_message_text(f"❌ Ошибка удаления из БД: {e}")
                     return
                 
-                # Обновляем локальный кэш
-                all_posters = context.bot_data.get("all_posters", [])
-                context.bot_data["all_posters"] = [p for p in all_posters if p.get("id") != poster_id]
+                # Каталог обновится и по NOTIFY, но ответ админу должен учитывать удаление сразу
+                await get_poster_catalog(context).refresh(pool)
                 
-                current_poster = context.bot_data.get("poster")
-                if current_poster and current_poster.get("id") == poster_id:
-                    # Загружаем новую текущую афишу из БД
-                    active_posters = await get_active_posters(pool)
-                    if active_posters:
-                        context.bot_data["poster"] = active_posters[-1]
-                        context.bot_data["all_posters"] = active_posters
-                    else:
-                        context.bot_data.pop("poster", None)
-                        context.bot_data["all_posters"] = []
-                    
                 caption = poster.get("caption", "Без описания")[:50]
-                remaining = len(context.bot_data.get("all_posters", []))
+                remaining = len(get_all_posters(context))
                 
                 await query.edit_message_text(
                     f"✅ **Афиша удалена:**\n{caption}\n\n"
@@ -901,15 +1155,11 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         
         elif data == "poster_next":
             # Переход к следующей афише
-            all_posters = context.bot_data.get("all_posters", [])
+            all_posters = get_all_posters(context)
             current_index = context.user_data.get("current_poster_index", len(all_posters) - 1 if all_posters else 0)
             if current_index < len(all_posters) - 1:
                 context.user_data["current_poster_index"] = current_index + 1
-            try:
-                await query.message.delete()
-            except Exception:
-                pass
-            await show_main_menu(update, context)
+            await show_main_menu(update, context, carousel_message=query.message)
         
         elif data.startswith("gender_"):
             # Обработка выбора пола
@@ -917,14 +1167,8 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             context.user_data["gender"] = gender
             context.user_data["registration_step"] = "age"
             
-            # Сохраняем пол в БД
-            pool = get_db_pool(context)
-            if pool:
-                try:
-                    await upsert_user(pool, tg_id=user.id, gender=gender, username=user.username)
-                    logger.info("Gender saved to DB for user %s: %s", user.id, gender)
-                except Exception as e:
-                    logger.warning("Failed to save gender to DB: %s", e)
+            # Сохраняем пол в БД (пачкой, в фоне)
+            save_profile(context, user.id, gender=gender, username=user.username)
             
             gender_text = {
                 "male": "мужской",
@@ -960,40 +1204,26 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                 )
             
             elif sub == "broadcast_now":
-                await do_weekly_broadcast(context)
-                await query.edit_message_text("Афиша отправлена всем ✅")
+                await query.edit_message_text("📤 Запускаю рассылку афиши...")
+                await do_weekly_broadcast(context, progress_message=query.message)
             
             elif sub == "post_to_channel":
                 # Публикация афиши в канал
-                all_posters = context.bot_data.get("all_posters", [])
+                all_posters = get_all_posters(context)
                 if not all_posters:
                     await query.edit_message_text("❌ Нет афиш для публикации")
                     return
                 
-                poster = all_posters[-1]
-                file_id = poster.get("file_id")
-                caption = poster.get("caption", "")
-                ticket_url = poster.get("ticket_url")
-                venue_map_file_id = poster.get("venue_map_file_id")
-                
-                # Формируем кнопки
-                buttons = []
-                if ticket_url:
-                    buttons.append([InlineKeyboardButton("🎫 Купить билет", url=ticket_url)])
-                buttons.append([InlineKeyboardButton("💼 Работа промоутером", url="https://t.me/euphoriamsktus")])
-                if venue_map_file_id:
-                    buttons.append([InlineKeyboardButton("🗺 Схема зала", callback_data=f"view_venue_map:0")])
-                
-                reply_markup = InlineKeyboardMarkup(buttons) if buttons else None
+                view = poster_views.get(all_posters).latest
                 
                 try:
                     # Публикуем в канал @euphoriamskt
                     await context.bot.send_photo(
                         chat_id="@euphoriamskt",
-                        photo=file_id,
-                        caption=caption,
+                        photo=view.poster.get("file_id"),
+                        caption=view.caption,
                         parse_mode='HTML',
-                        reply_markup=reply_markup
+                        reply_markup=view.broadcast_markup
                     )
                     await query.edit_message_text("✅ Афиша опубликована в канале @euphoriamskt")
                 except Exception as e:
@@ -1008,7 +1238,8 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                 pool = get_db_pool(context)
                 if pool:
                     try:
-                        active_posters = await get_active_posters(pool)
+                        # Новые сверху, как раньше
+                        active_posters = get_poster_catalog(context).posters[::-1]
                         if not active_posters:
                             await query.edit_message_text("❌ Нет активных афиш для удаления")
                             return
@@ -1059,6 +1290,32 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                     parse_mode="Markdown"
                 )
             
+            elif sub == "broadcast_jobs":
+                # Последние рассылки: отзыв или правка у всех получателей
+                pool = get_db_pool(context)
+                if not pool:
+                    await query.edit_message_text("❌ База данных недоступна")
+                    return
+                jobs = await get_recent_broadcast_jobs(pool)
+                if not jobs:
+                    await query.edit_message_text(
+                        "Рассылок пока не было",
+                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("◀️ Назад в панель", callback_data="admin:back_to_panel")]])
+                    )
+                    return
+                keyboard = []
+                for job in jobs:
+                    mark = "🗑" if job["recalled_at"] else ("⏳" if job["status"] == "running" else "📨")
+                    keyboard.append([InlineKeyboardButton(
+                        f"{mark} #{job['id']} от {job['created_at']:%d.%m %H:%M} — {job['delivered']} доставлено",
+                        callback_data=f"broadcast:job:{job['id']}"
+                    )])
+                keyboard.append([InlineKeyboardButton("◀️ Назад в панель", callback_data="admin:back_to_panel")])
+                await query.edit_message_text(
+                    "🗂 Последние рассылки. Выберите, чтобы удалить или исправить у всех получателей:",
+                    reply_markup=InlineKeyboardMarkup(keyboard)
+                )
+            
             elif sub == "stats":
                 count = len(get_known_users(context))
                 await query.edit_message_text(f"Пользователей: {count}")
@@ -1093,7 +1350,8 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                             caption=draft.get("caption") or "",
                             ticket_url=draft.get("ticket_url"),
                             venue_map_file_id=draft.get("venue_map_file_id"),
-                            venue_map_url=draft.get("venue_map_url")
+                            venue_map_url=draft.get("venue_map_url"),
+                            photo_path=draft.get("photo_path"),
                         )
                         logger.info("Poster saved to DB with ID: %s, file_id: %s", poster_id, draft["file_id"])
                     except Exception as e:
@@ -1101,7 +1359,6 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                         await query.edit_message_text(f"❌ Ошибка сохранения в БД: {e}")
                         return
                 
-                # Также сохраняем в bot_data для обратной совместимости
                 poster = {
                     "id": poster_id,
                     "file_id": draft["file_id"], 
@@ -1111,12 +1368,13 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                     "venue_map_file_id": draft.get("venue_map_file_id"),
                     "venue_map_url": draft.get("venue_map_url")
                 }
-                context.bot_data["poster"] = poster
-                
-                # Добавляем афишу в список всех афиш
-                all_posters = context.bot_data.get("all_posters", [])
-                all_posters.append(poster)
-                context.bot_data["all_posters"] = all_posters
+                if poster_id:
+                    # Не ждём NOTIFY: новая афиша должна быть в каталоге к следующему показу меню
+                    await get_poster_catalog(context).refresh(pool)
+                else:
+                    # Без БД афиша живёт только в памяти бота
+                    context.bot_data["poster"] = poster
+                all_posters = get_all_posters(context)
                 
                 # Сбрасываем индекс для всех пользователей на последнюю афишу
                 # чтобы новая афиша показывалась сразу
@@ -1208,6 +1466,12 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                         text += f"• Мужчин: {stats.get('male_users', 0)}\n"
                         text += f"• Женщин: {stats.get('female_users', 0)}\n"
                         text += f"• Зарегистрировано сегодня: {stats.get('today_registrations', 0)}"
+                        # Возрастные группы — из реестра в памяти, без запроса к БД
+                        ages = get_known_users(context).age_histogram()
+                        if ages:
+                            text += "\n\n🎂 **Возраст** (кто не заблокировал бота):\n"
+                            for label, low, high in (("16–17", 16, 17), ("18–20", 18, 20), ("21–24", 21, 24), ("25–29", 25, 29), ("30+", 30, 200)):
+                                text += f"• {label}: {sum(n for age, n in ages.items() if low <= age <= high)}\n"
                     except Exception as e:
                         text = f"❌ Ошибка получения статистики: {e}"
                 else:
@@ -1223,51 +1487,55 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                     await query.answer("❌ База данных недоступна", show_alert=True)
                     return
                 
+                if context.application.bot_data.get("users_export_running"):
+                    await query.answer("⏳ Экспорт уже готовится", show_alert=True)
+                    return
                 await query.answer("📊 Создаю файл экспорта...", show_alert=False)
-                
-                try:
-                    # Создаем Excel файл
-                    file_path = await export_users_to_excel(pool)
-                    
-                    # Отправляем файл
-                    with open(file_path, 'rb') as f:
-                        await context.bot.send_document(
-                            chat_id=query.message.chat_id,
-                            document=f,
-                            filename="users_export.xlsx",
-                            caption="📊 Экспорт пользователей TusaBot"
-                        )
-                    
-                    # Удаляем временный файл
-                    import os
-                    os.remove(file_path)
-                    
-                    await query.edit_message_text(
-                        "✅ Файл экспорта отправлен!",
-                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад в панель", callback_data="admin:refresh")]])
-                    )
-                except Exception as e:
-                    logger.error("Failed to export users: %s", e)
-                    await query.edit_message_text(
-                        f"❌ Ошибка экспорта: {e}",
-                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад в панель", callback_data="admin:refresh")]])
-                    )
+                await query.edit_message_text("⏳ Готовлю файл экспорта, бот в это время работает как обычно...")
+                # Экспорт большой базы занимает время — не держим очередь обновлений
+                context.application.bot_data["users_export_running"] = True
+                context.application.create_task(send_users_export(context, query.message))
+            
+            elif sub == "dump_csv":
+                # Сырые выгрузки users и attendances для аналитики
+                if not get_db_pool(context):
+                    await query.answer("❌ База данных недоступна", show_alert=True)
+                    return
+                if context.application.bot_data.get("bulk_io_running"):
+                    await query.answer("⏳ Выгрузка или загрузка уже идёт", show_alert=True)
+                    return
+                await query.answer()
+                await query.edit_message_text("⏳ Выгружаю таблицы в CSV.gz...")
+                context.application.bot_data["bulk_io_running"] = True
+                context.application.create_task(send_bulk_export(context, query.message))
+            
+            elif sub == "load_csv":
+                context.user_data["awaiting_bulk_import"] = True
+                await query.answer()
+                await query.edit_message_text(
+                    "📥 Отправьте файл .csv.gz, выгруженный кнопкой «Выгрузка CSV.gz».\n"
+                    "Таблица определяется по имени файла: "
+                    + ", ".join(f"{name}*.csv.gz" for name in BULK_TABLES)
+                    + "\n\nСуществующие строки обновятся по ключу. Файлы больше 20 МБ загружайте через "
+                    "python bulk_io.py import на сервере.",
+                    reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад в панель", callback_data="admin:refresh")]])
+                )
             
             elif sub == "list_posters":
                 # Показать список всех афиш
-                all_posters = context.bot_data.get("all_posters", [])
+                all_posters = get_all_posters(context)
                 if not all_posters:
                     text = "📋 Список афиш пуст"
                 else:
                     text = f"📋 **Список всех афиш ({len(all_posters)}):**\n\n"
-                    current_poster = context.bot_data.get("poster")
+                    current_poster = all_posters[-1]
                     
                     for i, poster in enumerate(all_posters):
                         caption = poster.get("caption", "Без описания")
                         if len(caption) > 40:
                             caption = caption[:40] + "..."
                         
-                        status = "🟢 ТЕКУЩАЯ" if poster == current_poster else "⚪"
+                        status = "🟢 ТЕКУЩАЯ" if poster is current_poster else "⚪"
                         ticket_status = "🎫" if poster.get("ticket_url") else "❌"
                         
                         text += f"{i+1}. {status} {caption}\n   Билеты: {ticket_status}\n\n"
@@ -1292,6 +1560,14 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
                     parse_mode="Markdown"
                 )
             
+            elif sub.startswith("check_user:"):
+                # Выбран пользователь из подсказок «возможно, вы имели в виду»
+                target_user_id = int(sub.split(":", 1)[1])
+                await query.answer()
+                profile = await get_user(get_db_pool(context), target_user_id)
+                display = f"@{profile['username']}" if profile and profile.get("username") else f"ID {target_user_id}"
+                await send_subscription_report(query.message, context, target_user_id, display)
+            
             elif sub == "stop_check":
                 # Завершение режима непрерывной проверки
                 context.user_data["awaiting_username_check"] = False
@@ -1320,34 +1596,24 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             button_markup = preview.get("button_markup")
             button_text = preview.get("button_text")
             
-            # Отправляем рассылку
-            success_count = 0
-            failed_count = 0
-            
-            for uid in list(get_known_users(context)):
-                try:
-                    await context.bot.send_message(
-                        uid, 
-                        text_content,
-                        entities=entities,  # Передаём форматирование
-                        reply_markup=button_markup
-                    )
-                    success_count += 1
-                except Forbidden:
-                    logger.info("Cannot message user %s (blocked)", uid)
-                    failed_count += 1
-                except Exception as e:
-                    logger.warning("Broadcast text failed to %s: %s", uid, e)
-                    failed_count += 1
-            
             # Очищаем данные
             context.user_data.pop("broadcast_preview", None)
             
-            button_info = f"\n• С кнопкой: {button_text}" if button_markup else ""
-            await query.edit_message_text(
-                f"✅ Рассылка завершена!\n"
-                f"• Успешно: {success_count}\n"
-                f"• Ошибок: {failed_count}{button_info}"
+            # Рассылка идёт в фоне, прогресс — правками этого сообщения
+            button_info = f" (с кнопкой «{button_text}»)" if button_markup else ""
+            kind, payload = await copy_or_build_payload(
+                context, preview, "text",
+                text_payload(text_content, entities=entities, reply_markup=button_markup),
+            )
+            start_broadcast(
+                context,
+                kind,
+                payload,
+                title=f"Рассылка{button_info}",
+                name="Broadcast text",
+                progress_message=query.message,
+                created_by=user.id,
+                segment=preview.get("segment"),
             )
         
         elif data == "broadcast:confirm_photo":
@@ -1363,40 +1629,137 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
             button_markup = preview.get("button_markup")
             button_text = preview.get("button_text")
             
-            # Отправляем рассылку
-            success_count = 0
-            failed_count = 0
-            
-            for uid in list(get_known_users(context)):
-                try:
-                    await context.bot.send_photo(
-                        uid, 
-                        photo=photo, 
-                        caption=caption,
-                        caption_entities=caption_entities,  # Передаём форматирование
-                        reply_markup=button_markup
-                    )
-                    success_count += 1
-                except Forbidden:
-                    logger.info("Cannot message user %s (blocked)", uid)
-                    failed_count += 1
-                except Exception as e:
-                    logger.warning("Broadcast photo failed to %s: %s", uid, e)
-                    failed_count += 1
-            
             # Очищаем данные
             context.user_data.pop("broadcast_preview", None)
             
-            button_info = f"\n• С кнопкой: {button_text}" if button_markup else ""
+            # Рассылка идёт в фоне, прогресс — правками этого сообщения
+            button_info = f" (с кнопкой «{button_text}»)" if button_markup else ""
+            kind, payload = await copy_or_build_payload(
+                context, preview, "photo",
+                photo_payload(photo, caption, caption_entities=caption_entities, reply_markup=button_markup),
+            )
+            start_broadcast(
+                context,
+                kind,
+                payload,
+                title=f"Рассылка{button_info}",
+                name="Broadcast photo",
+                progress_message=query.message,
+                created_by=user.id,
+                segment=preview.get("segment"),
+            )
+        
+        elif data == "broadcast:segment":
+            # Выбор аудитории рассылки
+            if "broadcast_preview" not in context.user_data:
+                await query.edit_message_text("❌ Ошибка: данные рассылки не найдены")
+                return
+            context.user_data["awaiting_broadcast_segment"] = True
             await query.edit_message_text(
-                f"✅ Рассылка завершена!\n"
-                f"• Успешно: {success_count}\n"
-                f"• Ошибок: {failed_count}{button_info}"
+                "🎯 Отправьте фильтр аудитории, любые поля можно опустить:\n\n"
+                "пол=ж возраст=18-25 с=2024-01-01 по=2024-06-30 афиша=12\n\n"
+                "• пол — м или ж\n"
+                "• возраст — диапазон (18-25, 21-, 30)\n"
+                "• с / по — даты регистрации\n"
+                "• афиша — ID афиши, на которой отмечался пользователь\n\n"
+                "Заблокировавшие бота не получат рассылку. «все» — сбросить фильтр."
             )
         
+        elif data.startswith(("broadcast:job:", "broadcast:recall:", "broadcast:recall_ok:", "broadcast:relink:", "broadcast:retext:")):
+            # Отзыв и правка отправленной рассылки
+            if user.id not in get_admins(context):
+                return
+            pool = get_db_pool(context)
+            if not pool:
+                await query.edit_message_text("❌ База данных недоступна")
+                return
+            _, action, job_id = data.split(":")
+            job_id = int(job_id)
+            back = [InlineKeyboardButton("◀️ К рассылкам", callback_data="admin:broadcast_jobs")]
+            
+            if action == "job":
+                job = await get_broadcast_job(pool, job_id)
+                if not job:
+                    await query.edit_message_text("❌ Рассылка не найдена", reply_markup=InlineKeyboardMarkup([back]))
+                    return
+                delivered = await count_broadcast_messages(pool, job_id)
+                payload = job["payload"]
+                preview_text = payload.get("text") or payload.get("caption") or "(копия сообщения)"
+                await query.edit_message_text(
+                    f"📨 Рассылка #{job_id} от {job['created_at']:%d.%m.%Y %H:%M}\n"
+                    f"• Доставлено сообщений: {delivered}\n"
+                    + (f"• Отозвана: {job['recalled_at']:%d.%m.%Y %H:%M}\n" if job["recalled_at"] else "")
+                    + f"\n{preview_text[:300]}\n\n"
+                    "Удалить сообщения бот может только в течение 48 часов после отправки.",
+                    reply_markup=InlineKeyboardMarkup([
+                        [InlineKeyboardButton("🗑 Удалить у всех", callback_data=f"broadcast:recall:{job_id}")],
+                        [InlineKeyboardButton("🔗 Заменить кнопку", callback_data=f"broadcast:relink:{job_id}")],
+                        [InlineKeyboardButton("✏️ Изменить текст", callback_data=f"broadcast:retext:{job_id}")],
+                        back,
+                    ])
+                )
+            
+            elif action == "recall":
+                await query.edit_message_text(
+                    f"⚠️ Удалить рассылку #{job_id} у всех получателей?",
+                    reply_markup=InlineKeyboardMarkup([
+                        [InlineKeyboardButton("🗑 Да, удалить", callback_data=f"broadcast:recall_ok:{job_id}")],
+                        back,
+                    ])
+                )
+            
+            elif action == "recall_ok":
+                job = await get_broadcast_job(pool, job_id)
+                if job and job["recalled_at"]:
+                    await query.edit_message_text(
+                        f"✅ Рассылка #{job_id} уже удалена {job['recalled_at']:%d.%m.%Y %H:%M}",
+                        reply_markup=InlineKeyboardMarkup([back])
+                    )
+                    return
+                # Повторное нажатие не должно запускать второй отзыв
+                if get_revision_task(job_id):
+                    await query.edit_message_text(
+                        f"⏳ Рассылка #{job_id} уже удаляется или изменяется",
+                        reply_markup=InlineKeyboardMarkup([back])
+                    )
+                    return
+                launch_broadcast_revision(
+                    pool, context.bot, job_id, "delete",
+                    title=f"Удаление рассылки #{job_id}",
+                    progress_message=query.message,
+                )
+            
+            elif action == "relink":
+                context.user_data["awaiting_broadcast_revision"] = {"job_id": job_id, "action": "markup"}
+                await query.edit_message_text(
+                    f"🔗 Отправьте новую кнопку для рассылки #{job_id} в формате:\n"
+                    "`Текст кнопки | https://ссылка`\n\n"
+                    "Отправьте «-», чтобы убрать кнопки.",
+                    parse_mode="Markdown"
+                )
+            
+            elif action == "retext":
+                context.user_data["awaiting_broadcast_revision"] = {"job_id": job_id, "action": "text"}
+                await query.edit_message_text(
+                    f"✏️ Отправьте новый текст для рассылки #{job_id}.\n"
+                    "Форматирование сохранится, кнопки останутся прежними."
+                )
+        
+        elif data.startswith("broadcast:stop:"):
+            # Остановка фоновой рассылки
+            if user.id not in get_admins(context):
+                return
+            task = get_broadcast_task(int(data.rsplit(":", 1)[1]))
+            if task:
+                # Итог с количеством отправленных допишет сама рассылка
+                task.cancel()
+            else:
+                await query.edit_message_reply_markup(reply_markup=None)
+        
         elif data == "broadcast:cancel":
             # Отмена рассылки
             context.user_data.pop("broadcast_preview", None)
+            context.user_data.pop("awaiting_broadcast_segment", None)
             await query.edit_message_text("❌ Рассылка отменена")
     
     except Exception as e:
@@ -1408,35 +1771,22 @@ async def handle_buttons(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 
 
 async def send_poster_to_chat(context: ContextTypes.DEFAULT_TYPE, chat_id: int) -> None:
-    all_posters = context.bot_data.get("all_posters", [])
+    all_posters = get_all_posters(context)
     if not all_posters:
         await context.bot.send_message(chat_id, "Афиш пока нет ;(")
         return
     
     # Берем последнюю (самую новую) афишу для рассылки
-    poster = all_posters[-1]
-    file_id = poster.get("file_id")
-    caption = poster.get("caption", "")
-    ticket_url = poster.get("ticket_url")
-    venue_map_file_id = poster.get("venue_map_file_id")
+    view = poster_views.get(all_posters).latest
     
     try:
-        # Формируем кнопки как в show_main_menu
-        buttons = []
-        
-        # 1. Кнопка билетов (если есть)
-        if ticket_url:
-            buttons.append([InlineKeyboardButton("🎫 Купить билет", url=ticket_url)])
-        
-        # 2. Кнопка работы промоутером (всегда)
-        buttons.append([InlineKeyboardButton("💼 Работа промоутером", url="https://t.me/euphoriamsktus")])
-        
-        # 3. Кнопка схемы зала (если есть)
-        if venue_map_file_id:
-            buttons.append([InlineKeyboardButton("🗺 Схема зала", callback_data=f"view_venue_map:0")])
-        
-        reply_markup = InlineKeyboardMarkup(buttons) if buttons else None
-        await context.bot.send_photo(chat_id=chat_id, photo=file_id, caption=caption, parse_mode='HTML', reply_markup=reply_markup)
+        await context.bot.send_photo(
+            chat_id=chat_id,
+            photo=view.poster.get("file_id"),
+            caption=view.caption,
+            parse_mode='HTML',
+            reply_markup=view.broadcast_markup
+        )
     except Forbidden:
         logger.info("Cannot send message to chat_id %s (blocked or privacy)", chat_id)
     except Exception as e:
@@ -1472,6 +1822,17 @@ async def save_poster(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
     await msg.reply_text("Афиша сохранена ✅ (фото и подпись). Для ссылки используйте /set_ticket <url>")
 
 
+async def save_ticket_url(context: ContextTypes.DEFAULT_TYPE, url: str) -> None:
+    """Ссылка на билеты для текущей афиши: в БД (каталог обновится), без БД — в памяти"""
+    poster = get_current_poster(context)
+    pool = get_db_pool(context)
+    if poster and poster.get("id") and pool:
+        await update_poster_ticket_url(pool, poster["id"], url)
+        await get_poster_catalog(context).refresh(pool)
+    else:
+        context.bot_data["poster"] = {**(poster or {}), "ticket_url": url}
+
+
 async def set_ticket(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not await admin_only(update, context):
         return
@@ -1482,9 +1843,7 @@ async def set_ticket(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
         await msg.reply_text("Укажи ссылку: /set_ticket https://...")
         return
     url = context.args[0].strip()
-    poster = context.bot_data.get("poster") or {}
-    poster["ticket_url"] = url
-    context.bot_data["poster"] = poster
+    await save_ticket_url(context, url)
     await msg.reply_text("Ссылка на покупку билета сохранена ✅")
 
 
@@ -1515,8 +1874,8 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
             logger.warning("Failed to get stats: %s", e)
     
     # Показать информацию об афишах и пользователях
-    all_posters = context.bot_data.get("all_posters", [])
-    current_poster = context.bot_data.get("poster")
+    all_posters = get_all_posters(context)
+    current_poster = get_current_poster(context)
     
     status_text = "🛠 **Админ-панель TusaBot**\n\n"
     
@@ -1541,7 +1900,21 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         status_text += f"• Сегодня: {stats.get('today_registrations', 0)}\n"
     else:
         status_text += f"• Всего: {len(get_known_users(context))}\n"
-    
+    cache_stats = user_cache.stats()
+    status_text += (
+        f"• Кэш профилей: {cache_stats['size']} "
+        f"(попаданий {cache_stats['hit_rate']:.0%}, {cache_stats['hits']}/{cache_stats['hits'] + cache_stats['misses']})\n"
+    )
+    roster = get_known_users(context)
+    status_text += f"• Реестр в памяти: {len(roster)} для рассылок, {roster.nbytes // 1024} КБ\n"
+    pool = get_db_pool(context)
+    if pool:
+        pool_stats = pool.stats()
+        status_text += (
+            f"• Соединения БД: {pool_stats['in_use']}/{pool_stats['max_size']} заняты, "
+            f"ожидание ср. {pool_stats['wait_avg_ms']:.1f} мс, макс. {pool_stats['wait_max_ms']:.0f} мс\n"
+        )
+
     # Inline кнопки для удобства
     admin_buttons = [
         # Управление афишами
@@ -1559,7 +1932,8 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         ],
         # Настройки и рассылки
         [
-            InlineKeyboardButton("📝 Текстовая рассылка", callback_data="admin:broadcast_text")
+            InlineKeyboardButton("📝 Текстовая рассылка", callback_data="admin:broadcast_text"),
+            InlineKeyboardButton("🗂 Прошлые рассылки", callback_data="admin:broadcast_jobs")
         ],
         # Пользователи
         [
@@ -1568,7 +1942,11 @@ async def admin_panel(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         ],
         [
             InlineKeyboardButton("👥 Пользователи", callback_data="admin:users_count"),
-            InlineKeyboardButton("📊 Экспорт CSV", callback_data="admin:export_users")
+            InlineKeyboardButton("📊 Экспорт Excel", callback_data="admin:export_users")
+        ],
+        [
+            InlineKeyboardButton("📦 Выгрузка CSV.gz", callback_data="admin:dump_csv"),
+            InlineKeyboardButton("📥 Загрузка CSV.gz", callback_data="admin:load_csv")
         ],
         # Выход
         [InlineKeyboardButton("🏠 Главное меню", callback_data="back_to_menu")]
@@ -1603,8 +1981,31 @@ async def make_admin(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None
 async def broadcast_now(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not await admin_only(update, context):
         return
-    await do_weekly_broadcast(context)
-    await update.message.reply_text("Разослал текущую афишу всем известным пользователям ✅")
+    progress_message = await update.message.reply_text("📤 Запускаю рассылку афиши...")
+    await do_weekly_broadcast(context, progress_message=progress_message)
+
+
+async def db_stats(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
+    """Самые затратные запросы к БД: /dbstats [N], /dbstats reset — обнулить"""
+    if not await admin_only(update, context):
+        return
+    if context.args and context.args[0] == "reset":
+        query_stats.reset()
+        await update.message.reply_text("🧹 Статистика запросов обнулена")
+        return
+    limit = int(context.args[0]) if context.args and context.args[0].isdigit() else 15
+    rows = query_stats.snapshot()[:limit]
+    if not rows:
+        await update.message.reply_text("Запросов к БД пока не было")
+        return
+    lines = [f"🐢 Запросы к БД по суммарному времени (медленные — от {DB_SLOW_QUERY_MS:.0f} мс):", ""]
+    for row in rows:
+        lines.append(
+            f"{row['name']}: {row['count']} шт., всего {row['total_ms'] / 1000:.1f} с\n"
+            f"   p50 {row['p50_ms']:.1f} / p95 {row['p95_ms']:.1f} / p99 {row['p99_ms']:.1f} мс, "
+            f"макс. {row['max_ms']:.0f} мс, медленных {row['slow']}, ошибок {row['errors']}"
+        )
+    await update.message.reply_text("\n".join(lines))
 
 
 async def broadcast_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
@@ -1653,27 +2054,19 @@ async def broadcast_text(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
         caption = update.message.text.partition(' ')[2]
     
     # Рассылаем
-    success_count = 0
-    failed_count = 0
-    
-    for uid in list(get_known_users(context)):
-        try:
-            if photo:
-                await context.bot.send_photo(uid, photo=photo, caption=caption, parse_mode='HTML')
-            else:
-                await context.bot.send_message(uid, caption)
-            success_count += 1
-        except Forbidden:
-            logger.info("Cannot message user %s (blocked)", uid)
-            failed_count += 1
-        except Exception as e:
-            logger.warning("Broadcast failed to %s: %s", uid, e)
-            failed_count += 1
-    
-    await update.message.reply_text(
-        f"✅ Рассылка завершена!\n"
-        f"• Успешно: {success_count}\n"
-        f"• Ошибок: {failed_count}"
+    if photo:
+        kind, payload = "photo", photo_payload(photo, caption, parse_mode='HTML')
+    else:
+        kind, payload = "text", text_payload(caption)
+    progress_message = await update.message.reply_text("📤 Запускаю рассылку...")
+    start_broadcast(
+        context,
+        kind,
+        payload,
+        title="Рассылка",
+        name="Broadcast",
+        progress_message=progress_message,
+        created_by=update.effective_user.id,
     )
 
 
@@ -1682,64 +2075,140 @@ async def broadcast_text(update: Update, context: ContextTypes.DEFAULT_TYPE) ->
 # ----------------------
 
 async def finalize_previous_week_and_reengage(context: ContextTypes.DEFAULT_TYPE) -> None:
-    now = datetime.now(timezone.utc)
-    prev_key = previous_week_key(now)
-
-    for uid in list(get_known_users(context)):
-        ud = context.application.user_data.setdefault(uid, {})
-        attended_weeks: Set[str] = ud.get("attended_weeks", set())
-        missed_in_row = int(ud.get("missed_in_row", 0))
-        if prev_key in attended_weeks:
-            ud["missed_in_row"] = 0
-        else:
-            missed_in_row += 1
-            ud["missed_in_row"] = missed_in_row
-            if missed_in_row > 2:
-                try:
-                    await context.bot.send_message(uid, REENGAGE_TEXT)
-                except Forbidden:
-                    logger.info("Cannot message user %s (blocked)", uid)
-                except Exception as e:
-                    logger.warning("Re-engage send failed to %s: %s", uid, e)
-        context.application.user_data[uid] = ud
+    """Закрыть прошлую неделю и позвать вернуться тех, кто пропустил больше двух недель подряд.
+
+    Серии посещений считаются в БД (user_streaks), рассылка идёт в фоне.
+    """
+    pool = get_db_pool(context)
+    if not pool:
+        logger.warning("Re-engage skipped: DB is not available")
+        return
+    week_start = previous_week_start(datetime.now(timezone.utc))
+    
+    def run(result: BroadcastResult):
+        return run_reengage_job(
+            pool, context.bot, week_start, "text", text_payload(REENGAGE_TEXT), result=result
+        )
+    
+    async def done(result: BroadcastResult) -> None:
+        forget_blocked_users(context, result)
+    
+    BroadcastTask(f"Напоминание за неделю {week_start:%d.%m}", run, on_done=done, pool=pool)
 
 
-async def do_weekly_broadcast(context: ContextTypes.DEFAULT_TYPE) -> None:
-    """Рассылка афиши всем пользователям бота в личные сообщения (БЕЗ публикации в VK)"""
+async def do_weekly_broadcast(context: ContextTypes.DEFAULT_TYPE, progress_message=None) -> None:
+    """Рассылка афиши всем пользователям бота в личные сообщения (БЕЗ публикации в VK).
+
+    Рассылка запускается в фоне, отчёт админам приходит по её завершении.
+    """
     known_users = get_known_users(context)
     if not known_users:
         logger.info("No users to broadcast to")
+        if progress_message:
+            await progress_message.edit_text("❌ Некому рассылать: нет пользователей")
         return
     
     # Получаем последнюю афишу для рассылки
-    all_posters = context.bot_data.get("all_posters", [])
+    all_posters = get_all_posters(context)
     if not all_posters:
         logger.info("No posters to broadcast")
+        if progress_message:
+            await progress_message.edit_text("❌ Нет афиш для рассылки")
         return
     
-    latest_poster = all_posters[-1]
+    view = poster_views.get(all_posters).latest
+    latest_poster = view.poster
     
-    # Рассылка в Telegram (только в личные сообщения пользователям)
-    success_count = 0
-    for user_id in known_users:
+    async def send_report(result: BroadcastResult) -> None:
+        # Отправляем админам отчет
+        if not ADMIN_IDS:
+            return
+        report = f"📊 Рассылка афиши завершена:\n{await job_summary(get_db_pool(context), result)}"
+        for admin_id in ADMIN_IDS:
+            try:
+                await context.bot.send_message(admin_id, report)
+            except Exception as e:
+                logger.warning("Failed to send broadcast report to admin %s: %s", admin_id, e)
+    
+    markup = view.broadcast_markup
+    kind, payload = "photo", photo_payload(
+        latest_poster.get("file_id"),
+        view.caption,
+        reply_markup=markup,
+        parse_mode='HTML',
+    )
+    if BROADCAST_STAGING_CHAT_ID:
+        # Публикуем афишу один раз в служебный чат и рассылаем её копии
         try:
-            await send_poster_to_chat(context, user_id)
-            success_count += 1
+            staged = await context.bot.send_photo(
+                BROADCAST_STAGING_CHAT_ID,
+                photo=latest_poster.get("file_id"),
+                caption=view.caption,
+                parse_mode='HTML',
+            )
+            kind, payload = "copy", copy_payload(staged.chat_id, staged.message_id, reply_markup=markup, media=True)
         except Exception as e:
-            logger.warning("Failed to send poster to user %s: %s", user_id, e)
+            logger.warning("Failed to stage poster for broadcast, sending photos: %s", e)
     
-    logger.info("Broadcast completed: %d/%d users received the poster", 
-                success_count, len(known_users))
+    # Рассылка в Telegram (только в личные сообщения пользователям)
+    start_broadcast(
+        context,
+        kind,
+        payload,
+        title="Рассылка афиши",
+        name="Poster broadcast",
+        progress_message=progress_message,
+        on_done=send_report,
+    )
+
+
+async def sync_user_roster(context: CallbackContext) -> None:
+    """Подтянуть в реестр пользователей изменения из БД (по расписанию)"""
+    pool = get_db_pool(context)
+    if not pool:
+        return
+    try:
+        await get_known_users(context).sync(pool)
+    except Exception as e:
+        logger.warning("Failed to sync user roster: %s", e)
+
+
+async def validate_file_ids(context: CallbackContext) -> None:
+    """Проверить file_id афиш и Stories, перезалить нерабочие из локальных копий (по расписанию)"""
+    pool = get_db_pool(context)
+    if not pool:
+        return
+    upload_chat_id = FILE_ID_UPLOAD_CHAT_ID or BROADCAST_STAGING_CHAT_ID or next(iter(ADMIN_IDS), None)
+    try:
+        summary = await check_file_ids(context.bot, pool, upload_chat_id)
+        logger.info(
+            "file_id check: %d checked, %d broken, %d re-uploaded",
+            summary["checked"], summary["broken"], summary["reuploaded"],
+        )
+    except Exception as e:
+        logger.warning("Failed to check file_ids: %s", e)
+
+
+async def resume_broadcasts(context: CallbackContext) -> None:
+    """Продолжить рассылки, прерванные перезапуском бота"""
+    pool = get_db_pool(context)
+    if not pool:
+        return
     
-    # Отправляем админам отчет
-    if ADMIN_IDS:
-        report = f"📊 Рассылка завершена:\n"
-        report += f"✅ Отправлено: {success_count}/{len(known_users)} пользователей"
+    async def send_report(result: BroadcastResult) -> None:
+        forget_blocked_users(context, result)
+        report = f"♻️ Рассылка #{result.job_id} продолжена после перезапуска и завершена:\n"
+        report += await job_summary(pool, result)
         for admin_id in ADMIN_IDS:
             try:
                 await context.bot.send_message(admin_id, report)
             except Exception as e:
-                logger.warning("Failed to send broadcast report to admin %s: %s", admin_id, e)
+                logger.warning("Failed to send resume report to admin %s: %s", admin_id, e)
+    
+    try:
+        await resume_broadcast_jobs(pool, context.bot, on_done=send_report)
+    except Exception as e:
+        logger.error("Failed to resume broadcast jobs: %s", e)
 
 
 async def weekly_job(context: CallbackContext) -> None:
@@ -1783,12 +2252,7 @@ async def handle_registration_step(update: Update, context: ContextTypes.DEFAULT
         user_data["registration_step"] = "gender"
         
         # Создаем минимальную запись в БД с именем
-        if pool:
-            try:
-                await upsert_user(pool, tg_id=user.id, name=name, username=user.username)
-                logger.info("Name saved to DB for user %s: %s", user.id, name)
-            except Exception as e:
-                logger.warning("Failed to save name to DB: %s", e)
+        save_profile(context, user.id, name=name, username=user.username)
         
         kb = [
             [InlineKeyboardButton("👨 Мужской", callback_data="gender_male")],
@@ -1805,10 +2269,10 @@ async def handle_registration_step(update: Update, context: ContextTypes.DEFAULT
         # Проверяем формат возраста
         try:
             age = int(text.strip())
-            if age < 14 or age > 100:
+            if age < MIN_AGE or age > MAX_AGE:
                 await update.message.reply_text(
                     "❌ Неверный возраст!\n\n"
-                    "Пожалуйста, введите возраст от 14 до 100 лет\n"
+                    f"Пожалуйста, введите возраст от {MIN_AGE} до {MAX_AGE} лет\n"
                     "Например: 25"
                 )
                 return
@@ -1838,19 +2302,15 @@ async def handle_registration_step(update: Update, context: ContextTypes.DEFAULT
             }.get(user_data.get("gender", ""), "не указан")
             
             # Обновляем все данные в БД
-            if pool:
-                try:
-                    await upsert_user(
-                        pool,
-                        tg_id=user.id,
-                        name=name,
-                        gender=user_data.get("gender"),
-                        age=age,
-                        username=user.username,
-                    )
-                    logger.info("Registration completed for user %s: %s", user.id, name)
-                except Exception as e:
-                    logger.warning("DB upsert after registration failed: %s", e)
+            save_profile(
+                context,
+                user.id,
+                name=name,
+                gender=user_data.get("gender"),
+                age=age,
+                username=user.username,
+            )
+            logger.info("Registration completed for user %s: %s", user.id, name)
             
             kb = [[InlineKeyboardButton("🎉 Перейти в меню", callback_data="back_to_menu")]]
             await update.message.reply_text(
@@ -1917,6 +2377,24 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
                             if user_in_db:
                                 target_user_id = user_in_db.get("tg_id")
                                 logger.info(f"Found user by username @{username}: ID={target_user_id}")
+                            elif suggestions := await search_users(pool, username):
+                                # Вероятно, опечатка — предлагаем похожих из БД вместо запроса к Telegram
+                                kb = [
+                                    [InlineKeyboardButton(
+                                        f"@{u['username']}" if u['username'] else (u['name'] or str(u['tg_id'])),
+                                        callback_data=f"admin:check_user:{u['tg_id']}"
+                                    )]
+                                    for u in suggestions
+                                ]
+                                if context.user_data.get("continuous_check_mode"):
+                                    kb.append([InlineKeyboardButton("🔙 Завершить проверку", callback_data="admin:stop_check")])
+                                else:
+                                    kb.append([InlineKeyboardButton("🔙 Назад в панель", callback_data="admin:refresh")])
+                                await update.message.reply_text(
+                                    f"🔎 @{username} не найден. Возможно, вы имели в виду:",
+                                    reply_markup=InlineKeyboardMarkup(kb)
+                                )
+                                return
                             else:
                                 # Если не нашли в БД, пробуем через get_chat (для публичных профилей)
                                 try:
@@ -1963,48 +2441,7 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
                     )
                     return
                 
-                # Проверяем подписки на каналы и чат
-                tg1_ok, tg2_ok, chat_ok = await is_user_subscribed(context, target_user_id)
-                
-                # Формируем отчет (экранируем специальные символы Markdown)
-                def escape_markdown(text):
-                    """Экранирует специальные символы для Markdown"""
-                    special_chars = ['_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|', '{', '}', '.', '!']
-                    for char in special_chars:
-                        text = text.replace(char, '\\' + char)
-                    return text
-                
-                username_safe = escape_markdown(str(username_display))
-                
-                report = f"🔍 **Проверка подписок для {username_safe}**\n\n"
-                report += f"👤 Telegram ID: `{target_user_id}`\n\n"
-                report += "📺 **Telegram каналы:**\n"
-                report += f"{'✅' if tg1_ok else '❌'} {CHANNEL_USERNAME} \\(MEDIA FAM\\)\n"
-                report += f"{'✅' if tg2_ok else '❌'} {CHANNEL_USERNAME_2} \\(THE FAMILY\\)\n\n"
-                report += "💬 **Telegram чат:**\n"
-                report += f"{'✅' if chat_ok else '❌'} {CHAT_USERNAME} \\(Family Guests\\)\n"
-                
-                all_ok = tg1_ok and tg2_ok and chat_ok
-                report += f"\n{'🎉 **Все подписки активны\\!**' if all_ok else '⚠️ **Не все подписки активны**'}"
-                
-                # Кнопки в зависимости от режима
-                if context.user_data.get("continuous_check_mode"):
-                    # Режим непрерывной проверки - оставляем флаг активным
-                    kb = [[InlineKeyboardButton("🔙 Завершить проверку", callback_data="admin:stop_check")]]
-                    await update.message.reply_text(
-                        report + "\n\n💡 Введите следующий username или нажмите 'Завершить проверку'",
-                        reply_markup=InlineKeyboardMarkup(kb),
-                        parse_mode="MarkdownV2"
-                    )
-                    # НЕ сбрасываем флаг awaiting_username_check!
-                else:
-                    # Обычный режим - одна проверка
-                    context.user_data["awaiting_username_check"] = False
-                    await update.message.reply_text(
-                        report,
-                        reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🔙 Назад в панель", callback_data="admin:refresh")]]),
-                        parse_mode="MarkdownV2"
-                    )
+                await send_subscription_report(update.message, context, target_user_id, username_display)
                 return
                 
             except Exception as e:
@@ -2030,12 +2467,67 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
         # Админские команды теперь только через inline кнопки в админ-панели
         # Оставляем только обработку ввода данных
         # Handle admin text inputs
+        revision = context.user_data.pop("awaiting_broadcast_revision", None)
+        if revision and user.id in get_admins(context):
+            job_id, action = revision["job_id"], revision["action"]
+            changes = {}
+            if action == "markup":
+                if text.strip() != "-":
+                    parts = [p.strip() for p in text.split("|")]
+                    if len(parts) != 2 or not is_valid_url(parts[1]):
+                        context.user_data["awaiting_broadcast_revision"] = revision
+                        await update.message.reply_text("❌ Нужен формат: Текст кнопки | https://ссылка")
+                        return
+                    changes["reply_markup"] = InlineKeyboardMarkup([[InlineKeyboardButton(parts[0], url=parts[1])]])
+                else:
+                    changes["reply_markup"] = None
+                title = f"Замена кнопки в рассылке #{job_id}"
+            else:
+                changes["text"] = text
+                changes["entities"] = update.message.entities
+                title = f"Правка текста рассылки #{job_id}"
+            if get_revision_task(job_id):
+                await update.message.reply_text(f"⏳ Рассылка #{job_id} уже удаляется или изменяется, попробуйте позже")
+                return
+            progress_message = await update.message.reply_text(f"📤 {title}...")
+            launch_broadcast_revision(
+                get_db_pool(context), context.bot, job_id, action,
+                title=title, progress_message=progress_message, **changes
+            )
+            return
+        
+        if context.user_data.get("awaiting_broadcast_segment"):
+            preview = context.user_data.get("broadcast_preview")
+            if preview is None:
+                context.user_data["awaiting_broadcast_segment"] = False
+                return
+            if text.strip().lower() == "все":
+                preview.pop("segment", None)
+            else:
+                try:
+                    segment = parse_segment(text)
+                except ValueError as e:
+                    await update.message.reply_text(f"❌ {e}\nПопробуйте ещё раз или отправьте «все»")
+                    return
+                try:
+                    # Реестр в памяти считает сегмент без запроса; афиши (poster_id) — только в БД
+                    audience_size = get_known_users(context).count(segment)
+                    if audience_size is None:
+                        audience_size = await count_segment_users(get_db_pool(context), segment)
+                    preview["audience_size"] = audience_size
+                except Exception as e:
+                    logger.error("Failed to count broadcast segment: %s", e)
+                    await update.message.reply_text(f"❌ Не удалось посчитать аудиторию: {e}")
+                    return
+                preview["segment"] = segment
+            context.user_data["awaiting_broadcast_segment"] = False
+            await send_broadcast_confirmation(update.message, context)
+            return
+        
         if context.user_data.get("awaiting_ticket"):
             context.user_data["awaiting_ticket"] = False
             url = update.message.text.strip()
-            poster = context.bot_data.get("poster") or {}
-            poster["ticket_url"] = url
-            context.bot_data["poster"] = poster
+            await save_ticket_url(context, url)
             await update.message.reply_text("Ссылка сохранена ✅")
             return
             
@@ -2103,22 +2595,19 @@ async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE) -> Non
                 "📝 Предпросмотр рассылки:"
             )
             
-            # Отправляем сообщение с форматированием
-            await context.bot.send_message(
+            # Отправляем сообщение с форматированием (его же потом копирует рассылка)
+            preview_message = await context.bot.send_message(
                 chat_id=update.effective_chat.id,
                 text=text_content,
                 entities=adjusted_entities,  # Передаем скорректированное форматирование
                 reply_markup=button_markup
             )
+            context.user_data["broadcast_preview"]["preview_message"] = (
+                preview_message.chat_id, preview_message.message_id
+            )
             
             # Спрашиваем подтверждение
-            await update.message.reply_text(
-                "✅ Всё верно? Отправить рассылку?",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("✅ Да, отправить", callback_data="broadcast:confirm_text")],
-                    [InlineKeyboardButton("❌ Нет, отменить", callback_data="broadcast:cancel")]
-                ])
-            )
+            await send_broadcast_confirmation(update.message, context)
             return
         
         # Poster draft: expecting caption or link
@@ -2248,23 +2737,20 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
             "📝 Предпросмотр рассылки:"
         )
         
-        # Отправляем фото с форматированием
-        await context.bot.send_photo(
+        # Отправляем фото с форматированием (его же потом копирует рассылка)
+        preview_message = await context.bot.send_photo(
             chat_id=update.effective_chat.id,
             photo=photo,
             caption=caption,
             caption_entities=adjusted_caption_entities,  # Передаем скорректированное форматирование
             reply_markup=button_markup
         )
+        context.user_data["broadcast_preview"]["preview_message"] = (
+            preview_message.chat_id, preview_message.message_id
+        )
         
         # Спрашиваем подтверждение
-        await update.message.reply_text(
-            "✅ Всё верно? Отправить рассылку?",
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("✅ Да, отправить", callback_data="broadcast:confirm_photo")],
-                [InlineKeyboardButton("❌ Нет, отменить", callback_data="broadcast:cancel")]
-            ])
-        )
+        await send_broadcast_confirmation(update.message, context)
         return
 
     # Poster draft: expecting photo at step 'photo' or 'venue_map'
@@ -2317,6 +2803,11 @@ async def handle_photo(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
             # Сохраняем путь для веб-приложения (относительный путь)
             web_path = f"/posters/{filename}"
             
+            # Уменьшенные копии для веб-приложения строятся в фоне, в процессах пула images
+            context.application.create_task(
+                process_upload(get_db_pool(context), web_path, local_path, "/posters")
+            )
+            
             draft["file_id"] = file_id  # Оставляем для бота
             draft["photo_path"] = web_path  # Для веб-приложения
             draft["step"] = "caption"
@@ -2351,12 +2842,12 @@ def build_app() -> Application:
     persistence = None
     
     # Create request with timeout and proxy support
-    request = None
+    # Пул соединений должен вмещать параллельные отправки рассылки
+    # (по умолчанию у Bot всего одно соединение)
+    request_kwargs = {"connection_pool_size": BROADCAST_CONCURRENCY + 8}
     if PROXY_URL:
-        from httpx import AsyncClient
-        from telegram.request import HTTPXRequest
-        client = AsyncClient(proxies=PROXY_URL, timeout=30.0)
-        request = HTTPXRequest(http_client=client)
+        request_kwargs.update(proxy=PROXY_URL, read_timeout=30.0, write_timeout=30.0, connect_timeout=30.0)
+    request = HTTPXRequest(**request_kwargs)
     
     app = ApplicationBuilder().token(BOT_TOKEN).persistence(persistence).request(request).build()
 
@@ -2366,35 +2857,24 @@ def build_app() -> Application:
             pool = await create_pool()
             await init_schema(pool)
             app.bot_data["db_pool"] = pool
-            
-            # Загружаем существующих пользователей из БД
-            user_ids = await get_all_user_ids(pool)
-            app.bot_data["known_users"] = set(user_ids)
-            
-            # Загружаем активные афиши из БД
+            app.bot_data["registration_buffer"] = RegistrationBuffer(pool)
+            # Дослать рассылки, прерванные прошлым перезапуском (в фоне, после старта)
+            app.job_queue.run_once(resume_broadcasts, when=2)
+            
+            # Загружаем существующих пользователей из БД, дальше — только изменения
+            roster = app.bot_data.setdefault("known_users", UserRoster())
+            await roster.load(pool)
+            app.job_queue.run_repeating(sync_user_roster, interval=ROSTER_SYNC_INTERVAL, first=ROSTER_SYNC_INTERVAL)
+            # Нерабочие file_id афиш и Stories находим заранее, а не на показе пользователю
+            app.job_queue.run_repeating(validate_file_ids, interval=FILE_ID_CHECK_INTERVAL, first=60)
+            
+            # Каталог активных афиш: загрузка и подписка на NOTIFY poster_changed
+            catalog = app.bot_data.setdefault("poster_catalog", PosterCatalog())
             try:
-                posters_from_db = await get_active_posters(pool)
-                if posters_from_db:
-                    # Конвертируем в формат bot_data
-                    all_posters = []
-                    for p in posters_from_db:
-                        all_posters.append({
-                            "id": p["id"],
-                            "file_id": p["file_id"],
-                            "caption": p["caption"],
-                            "ticket_url": p["ticket_url"]
-                        })
-                    app.bot_data["all_posters"] = all_posters
-                    # Последняя афиша становится текущей
-                    if all_posters:
-                        app.bot_data["poster"] = all_posters[-1]
-                    logger.info("Loaded %d active posters from DB", len(all_posters))
-                else:
-                    app.bot_data["all_posters"] = []
-                    logger.info("No active posters in DB")
+                await catalog.start(pool)
+                logger.info("Loaded %d active posters from DB", len(catalog))
             except Exception as e:
                 logger.warning("Failed to load posters from DB: %s", e)
-                app.bot_data["all_posters"] = []
             
             # Настраиваем команды бота (только для обычных пользователей)
             commands = [
@@ -2403,11 +2883,23 @@ def build_app() -> Application:
             ]
             await app.bot.set_my_commands(commands)
             
-            logger.info("DB pool initialized, schema ready, loaded %d users, commands set", len(user_ids))
+            logger.info("DB pool initialized, schema ready, loaded %d users, commands set", len(roster))
         except Exception as e:
             logger.error("Failed to init DB: %s", e)
 
+    async def _on_stop(app: Application):
+        # Фоновые рассылки останавливаем до закрытия пула: задания продолжатся при старте
+        await stop_background_broadcasts()
+
     async def _on_shutdown(app: Application):
+        catalog = app.bot_data.get("poster_catalog")
+        if catalog:
+            await catalog.stop()
+        shutdown_image_workers()
+        buffer = app.bot_data.get("registration_buffer")
+        if buffer:
+            # Дописываем изменения профилей до закрытия пула
+            await buffer.close()
         pool = app.bot_data.get("db_pool")
         if pool:
             try:
@@ -2450,12 +2942,15 @@ def build_app() -> Application:
     app.add_handler(CommandHandler("id", show_id))
     app.add_handler(CommandHandler("broadcast_text", broadcast_text))
     app.add_handler(CommandHandler("broadcast_now", broadcast_now))
+    app.add_handler(CommandHandler("dbstats", db_stats))
     app.add_handler(CallbackQueryHandler(handle_buttons))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, handle_text))
     app.add_handler(MessageHandler(filters.PHOTO, handle_photo))
+    app.add_handler(MessageHandler(filters.Document.ALL, handle_document))
 
     # Register lifecycle handlers - удалено неправильный handler
     app.post_init = _on_startup
+    app.post_stop = _on_stop
     app.post_shutdown = _on_shutdown
 
     # ===== АВТОРАССЫЛКА ОТКЛЮЧЕНА =====
@@ -0,0 +1,957 @@
+"""
+Движок массовых рассылок Telegram.
+
+Отправляет сообщения с ограниченной параллельностью под общим token bucket,
+чтобы держать скорость около лимита Telegram (~30 сообщений в секунду на бота).
+"""
+
+import os
+import asyncio
+import itertools
+import logging
+import time
+from dataclasses import dataclass, field
+from datetime import date, datetime, timezone
+from typing import Any, AsyncIterable, AsyncIterator, Awaitable, Callable, Dict, Iterable, Optional, Sequence, Union
+
+import asyncpg
+from telegram import Bot, InlineKeyboardButton, InlineKeyboardMarkup, Message, MessageEntity
+from telegram.error import BadRequest, Forbidden, RetryAfter
+
+from db import (
+    create_broadcast_job, create_segment_broadcast_job, create_reengage_broadcast_job, get_unfinished_broadcast_jobs,
+    iter_pending_broadcast_recipients, get_broadcast_job_counts,
+    save_broadcast_deliveries, get_broadcast_delivery_stats, finish_broadcast_job, mark_users_blocked,
+    get_broadcast_job, count_broadcast_messages, iter_broadcast_messages,
+    update_broadcast_job_markup, mark_broadcast_job_recalled,
+)
+
+logger = logging.getLogger("TusaBot")
+
+# Лимит Telegram ~30 msg/s, оставляем небольшой запас
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "28"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))
+# Нижняя граница скорости при адаптивном снижении после 429
+BROADCAST_MIN_RATE = float(os.getenv("BROADCAST_MIN_RATE", "5"))
+# Сколько раз повторять одно сообщение после RetryAfter
+BROADCAST_MAX_ATTEMPTS = 5
+# Исходы отправки пишутся в БД пачками: не реже чем раз в N получателей или T секунд
+BROADCAST_CHECKPOINT_BATCH = int(os.getenv("BROADCAST_CHECKPOINT_BATCH", "500"))
+BROADCAST_CHECKPOINT_INTERVAL = float(os.getenv("BROADCAST_CHECKPOINT_INTERVAL_MS", "2000")) / 1000
+# Служебный чат, куда сообщение рассылки публикуется один раз для copyMessage.
+# Если не задан, копируется сам предпросмотр из чата админа
+BROADCAST_STAGING_CHAT_ID = int(os.getenv("BROADCAST_STAGING_CHAT_ID", "0")) or None
+
+@dataclass(slots=True)
+class Delivery:
+    """Исход отправки одному получателю"""
+    chat_id: int
+    status: str
+    message_id: Optional[int] = None
+    error: Optional[str] = None
+    sent_at: datetime = field(default_factory=lambda: datetime.now(timezone.utc))
+
+
+SendFunc = Callable[[int], Awaitable[object]]
+ResultFunc = Callable[[Delivery], Awaitable[None]]
+
+
+class TokenBucket:
+    """Token bucket: не больше `rate` токенов в секунду, всплеск до `capacity`.
+
+    После flood control (429) bucket ставится на паузу целиком и снижает
+    скорость; после серии успешных отправок скорость плавно возвращается.
+    """
+
+    # Множитель снижения скорости при 429 и шаг восстановления
+    DECREASE_FACTOR = 0.75
+    INCREASE_STEP = 0.5
+    INCREASE_EVERY = 200
+
+    def __init__(self, rate: float, capacity: float = 1.0, min_rate: float = BROADCAST_MIN_RATE):
+        self.rate = rate
+        self.max_rate = rate
+        self.min_rate = min(min_rate, rate)
+        self.capacity = max(1.0, capacity)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._successes = 0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        # Лок выстраивает ожидающих в очередь, токены раздаются по порядку
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    # Во время паузы токены не копятся
+                    self._tokens = 0.0
+                    self._updated = time.monotonic()
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def on_success(self) -> None:
+        self._successes += 1
+        if self._successes >= self.INCREASE_EVERY and self.rate < self.max_rate:
+            self._successes = 0
+            self.rate = min(self.max_rate, self.rate + self.INCREASE_STEP)
+
+    def on_flood(self, retry_after: float) -> None:
+        """Telegram вернул 429: пауза для всех отправителей и снижение скорости"""
+        now = time.monotonic()
+        self._successes = 0
+        # Параллельные запросы получают 429 пачкой: снижаем скорость
+        # один раз на паузу, а не на каждый ответ
+        if now >= self._paused_until:
+            self.rate = max(self.min_rate, self.rate * self.DECREASE_FACTOR)
+            logger.warning("Flood control: pausing sends for %ss, rate lowered to %.1f msg/s", retry_after, self.rate)
+        self._paused_until = max(self._paused_until, now + retry_after)
+
+
+def is_dead_chat_error(error: BadRequest) -> bool:
+    """Ошибка означает, что чата больше нет и писать туда бесполезно"""
+    message = error.message.lower()
+    return "chat not found" in message or "user not found" in message
+
+
+_bucket: Optional[TokenBucket] = None
+
+
+def get_bucket() -> TokenBucket:
+    """Общий на процесс bucket: параллельные рассылки делят один лимит"""
+    global _bucket
+    if _bucket is None:
+        _bucket = TokenBucket(BROADCAST_RATE)
+    return _bucket
+
+
+def format_summary(sent: int, failed: int, blocked: int, rate: float, throttled: int = 0) -> str:
+    """Итоги рассылки для админа; `failed` включает заблокировавших"""
+    return (
+        f"• Успешно: {sent}\n"
+        f"• Ошибок: {failed} (заблокировали бота: {blocked})\n"
+        f"• Скорость: {rate:.1f} сообщ./сек"
+        + (f"\n• Пауз из-за flood control: {throttled}" if throttled else "")
+    )
+
+
+@dataclass
+class BroadcastResult:
+    total: int = 0
+    sent: int = 0
+    failed: int = 0
+    throttled: int = 0
+    # Сколько получателей запланировано (для прогресса и ETA), если известно
+    planned: int = 0
+    started_at: float = 0.0
+    finished_at: float = 0.0
+    job_id: Optional[int] = None
+    # Рассылку остановил админ (в отличие от остановки процесса)
+    cancelled: bool = False
+    # Получатели, которым писать бесполезно (заблокировали бота / чат не найден)
+    blocked_ids: list[int] = field(default_factory=list)
+
+    @property
+    def blocked(self) -> int:
+        return len(self.blocked_ids)
+
+    @property
+    def elapsed(self) -> float:
+        if not self.started_at:
+            return 0.0
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    @property
+    def rate(self) -> float:
+        """Фактическая скорость запросов к Telegram, сообщений в секунду"""
+        elapsed = self.elapsed
+        return self.total / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def eta(self) -> Optional[float]:
+        """Оценка оставшегося времени в секундах"""
+        if not self.planned or not self.rate:
+            return None
+        return max(0, self.planned - self.total) / self.rate
+
+    def summary(self) -> str:
+        return format_summary(self.sent, self.failed, self.blocked, self.rate, self.throttled)
+
+    def progress(self) -> str:
+        eta = self.eta
+        eta_text = f"~{int(eta) // 60} мин {int(eta) % 60} сек" if eta is not None else "—"
+        planned = f" из {self.planned}" if self.planned else ""
+        return (
+            f"• Обработано: {self.total}{planned}\n"
+            f"• Успешно: {self.sent}\n"
+            f"• Ошибок: {self.failed}\n"
+            f"• Скорость: {self.rate:.1f} сообщ./сек\n"
+            f"• Осталось: {eta_text}"
+        )
+
+
+Recipients = Union[Iterable[int], AsyncIterable[int]]
+
+
+async def run_broadcast(
+    recipients: Recipients,
+    send: SendFunc,
+    *,
+    name: str = "broadcast",
+    concurrency: int = BROADCAST_CONCURRENCY,
+    bucket: Optional[TokenBucket] = None,
+    on_result: Optional[ResultFunc] = None,
+    result: Optional[BroadcastResult] = None,
+) -> BroadcastResult:
+    """Разослать сообщение получателям: `send(chat_id)` вызывается для каждого ID.
+
+    `on_result(delivery)` получает исход каждой отправки (Delivery):
+    "sent" с ID сообщения, "blocked" или "failed" с текстом ошибки. Счётчики пишутся в `result` по ходу
+    рассылки, поэтому переданный снаружи объект годится для показа прогресса.
+    Получателей можно передать асинхронным итератором (например, курсором БД).
+    """
+    bucket = bucket or get_bucket()
+    result = result or BroadcastResult()
+    result.started_at = time.monotonic()
+
+    if isinstance(recipients, AsyncIterable):
+        pending = recipients.__aiter__()
+        lock = asyncio.Lock()
+
+        async def next_recipient() -> Optional[int]:
+            # Асинхронный генератор нельзя продвигать из нескольких задач сразу
+            async with lock:
+                return await anext(pending, None)
+    else:
+        pending = iter(recipients)
+
+        async def next_recipient() -> Optional[int]:
+            return next(pending, None)
+
+    async def deliver(chat_id: int) -> Delivery:
+        for attempt in range(1, BROADCAST_MAX_ATTEMPTS + 1):
+            await bucket.acquire()
+            try:
+                sent = await send(chat_id)
+                bucket.on_success()
+                return Delivery(chat_id, "sent", message_id=getattr(sent, "message_id", None))
+            except RetryAfter as e:
+                # Сообщение не теряется: после общей паузы отправляем его снова
+                result.throttled += 1
+                bucket.on_flood(e.retry_after)
+                if attempt == BROADCAST_MAX_ATTEMPTS:
+                    logger.warning("%s gave up on %s after %d flood waits", name, chat_id, attempt)
+            except Forbidden as e:
+                logger.info("Cannot message user %s (blocked)", chat_id)
+                return Delivery(chat_id, "blocked", error=str(e))
+            except BadRequest as e:
+                if is_dead_chat_error(e):
+                    logger.info("Cannot message user %s (chat not found)", chat_id)
+                    return Delivery(chat_id, "blocked", error=str(e))
+                logger.warning("%s failed to %s: %s", name, chat_id, e)
+                return Delivery(chat_id, "failed", error=str(e))
+            except Exception as e:
+                logger.warning("%s failed to %s: %s", name, chat_id, e)
+                return Delivery(chat_id, "failed", error=str(e))
+        return Delivery(chat_id, "failed", error="Flood control: retry limit exceeded")
+
+    async def worker() -> None:
+        # Воркеры делят один итератор: каждый ID достаётся ровно одному воркеру
+        while (chat_id := await next_recipient()) is not None:
+            result.total += 1
+            delivery = await deliver(chat_id)
+            if delivery.status == "sent":
+                result.sent += 1
+            else:
+                result.failed += 1
+                if delivery.status == "blocked":
+                    result.blocked_ids.append(chat_id)
+            if on_result:
+                await on_result(delivery)
+
+    try:
+        await asyncio.gather(*(worker() for _ in range(max(1, concurrency))))
+    finally:
+        if hasattr(pending, "aclose"):
+            # Освобождаем курсор и соединение, даже если рассылку прервали
+            try:
+                await pending.aclose()
+            except Exception as e:
+                logger.debug("Failed to close recipients iterator: %s", e)
+    result.finished_at = time.monotonic()
+    logger.info(
+        "%s completed: %d/%d sent, %d failed in %.1fs (%.1f msg/s)",
+        name, result.sent, result.total, result.failed, result.elapsed, result.rate,
+    )
+    return result
+
+
+# ----------------------
+# Сохраняемые задания рассылок
+# ----------------------
+
+def text_payload(
+    text: str,
+    entities: Optional[Sequence[MessageEntity]] = None,
+    reply_markup: Optional[InlineKeyboardMarkup] = None,
+    parse_mode: Optional[str] = None,
+) -> Dict[str, Any]:
+    """Содержимое текстовой рассылки в виде, пригодном для JSONB"""
+    return {
+        "text": text,
+        "entities": [e.to_dict() for e in entities or ()],
+        "reply_markup": reply_markup.to_dict() if reply_markup else None,
+        "parse_mode": parse_mode,
+    }
+
+
+def photo_payload(
+    photo: str,
+    caption: str = "",
+    caption_entities: Optional[Sequence[MessageEntity]] = None,
+    reply_markup: Optional[InlineKeyboardMarkup] = None,
+    parse_mode: Optional[str] = None,
+) -> Dict[str, Any]:
+    """Содержимое фото-рассылки в виде, пригодном для JSONB"""
+    return {
+        "photo": photo,
+        "caption": caption,
+        "caption_entities": [e.to_dict() for e in caption_entities or ()],
+        "reply_markup": reply_markup.to_dict() if reply_markup else None,
+        "parse_mode": parse_mode,
+    }
+
+
+def copy_payload(
+    from_chat_id: int,
+    message_id: int,
+    reply_markup: Optional[InlineKeyboardMarkup] = None,
+    media: bool = False,
+) -> Dict[str, Any]:
+    """Рассылка копированием готового сообщения (copyMessage).
+
+    Медиа, подпись и форматирование Telegram берёт из исходного сообщения,
+    поэтому каждый запрос содержит только ссылку на него и клавиатуру.
+    `media` — у сообщения подпись, а не текст (нужно для последующей правки).
+    """
+    return {
+        "from_chat_id": from_chat_id,
+        "message_id": message_id,
+        "reply_markup": reply_markup.to_dict() if reply_markup else None,
+        "media": media,
+    }
+
+
+async def stage_message(bot: Bot, from_chat_id: int, message_id: int) -> tuple[int, int]:
+    """Опубликовать сообщение в служебном чате и вернуть (chat_id, message_id) источника копий.
+
+    Без BROADCAST_STAGING_CHAT_ID источником остаётся исходное сообщение:
+    его нельзя удалять, пока рассылка (в том числе продолженная после рестарта) не закончится.
+    """
+    if not BROADCAST_STAGING_CHAT_ID:
+        return from_chat_id, message_id
+    staged = await bot.copy_message(BROADCAST_STAGING_CHAT_ID, from_chat_id, message_id)
+    return BROADCAST_STAGING_CHAT_ID, staged.message_id
+
+
+def make_sender(bot: Bot, kind: str, payload: Dict[str, Any]) -> SendFunc:
+    """Собрать функцию отправки по сохранённому содержимому рассылки"""
+    reply_markup = InlineKeyboardMarkup.de_json(payload.get("reply_markup"), bot)
+    parse_mode = payload.get("parse_mode")
+
+    if kind == "text":
+        text = payload["text"]
+        entities = MessageEntity.de_list(payload.get("entities"), bot) or None
+
+        async def send(chat_id: int) -> None:
+            await bot.send_message(
+                chat_id, text, entities=entities, parse_mode=parse_mode, reply_markup=reply_markup
+            )
+        return send
+
+    if kind == "photo":
+        photo = payload["photo"]
+        caption = payload.get("caption") or ""
+        caption_entities = MessageEntity.de_list(payload.get("caption_entities"), bot) or None
+
+        async def send(chat_id: int) -> None:
+            await bot.send_photo(
+                chat_id,
+                photo=photo,
+                caption=caption,
+                caption_entities=caption_entities,
+                parse_mode=parse_mode,
+                reply_markup=reply_markup,
+            )
+        return send
+
+    if kind == "copy":
+        from_chat_id = payload["from_chat_id"]
+        message_id = payload["message_id"]
+
+        async def send(chat_id: int) -> None:
+            await bot.copy_message(chat_id, from_chat_id, message_id, reply_markup=reply_markup)
+        return send
+
+    raise ValueError(f"Unknown broadcast kind: {kind}")
+
+
+class Checkpointer:
+    """Копит исходы отправки и сохраняет их пачками: каждые `batch_size` строк
+    или `interval` секунд.
+
+    Пачка пишется COPY в журнал broadcast_deliveries (с ID доставленных
+    сообщений) и отмечается в broadcast_recipients. Заблокировавшие бота
+    получатели той же пачкой отмечаются в users.blocked_at.
+    """
+
+    def __init__(
+        self,
+        pool: asyncpg.Pool,
+        job_id: int,
+        batch_size: int = BROADCAST_CHECKPOINT_BATCH,
+        interval: float = BROADCAST_CHECKPOINT_INTERVAL,
+    ):
+        self.pool = pool
+        self.job_id = job_id
+        self.batch_size = batch_size
+        self.interval = interval
+        self._deliveries: list[Delivery] = []
+        self._flushed_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def record(self, delivery: Delivery) -> None:
+        self._deliveries.append(delivery)
+        if (
+            len(self._deliveries) >= self.batch_size
+            or time.monotonic() - self._flushed_at >= self.interval
+        ):
+            await self.flush()
+
+    async def flush(self) -> None:
+        async with self._lock:
+            if not self._deliveries:
+                return
+            deliveries, self._deliveries = self._deliveries, []
+            self._flushed_at = time.monotonic()
+            try:
+                await save_broadcast_deliveries(self.pool, self.job_id, [
+                    (d.chat_id, d.status, d.message_id, d.error and d.error[:200], d.sent_at)
+                    for d in deliveries
+                ])
+            except Exception as e:
+                # Не теряем исходы: попробуем записать их со следующей пачкой
+                logger.warning("Failed to checkpoint broadcast job %s: %s", self.job_id, e)
+                self._deliveries[:0] = deliveries
+                return
+            blocked = [d.chat_id for d in deliveries if d.status == "blocked"]
+            if blocked:
+                try:
+                    await mark_users_blocked(self.pool, blocked)
+                except Exception as e:
+                    logger.warning("Failed to mark blocked users: %s", e)
+
+
+async def _run_job(
+    pool: asyncpg.Pool,
+    bot: Bot,
+    job_id: int,
+    kind: str,
+    payload: Dict[str, Any],
+    recipients: Recipients,
+    name: str,
+    result: BroadcastResult,
+) -> BroadcastResult:
+    result.job_id = job_id
+    checkpoint = Checkpointer(pool, job_id)
+    try:
+        try:
+            await run_broadcast(
+                recipients,
+                make_sender(bot, kind, payload),
+                name=f"{name} #{job_id}",
+                on_result=checkpoint.record,
+                result=result,
+            )
+        finally:
+            # Даже при ошибке сохраняем, кому уже отправили, чтобы не слать им повторно
+            await checkpoint.flush()
+    except asyncio.CancelledError:
+        # Остановка процесса не отменяет задание: оно продолжится при старте
+        if result.cancelled:
+            await finish_broadcast_job(pool, job_id, "cancelled")
+        raise
+    await finish_broadcast_job(pool, job_id)
+    return result
+
+
+async def run_broadcast_job(
+    pool: Optional[asyncpg.Pool],
+    bot: Bot,
+    kind: str,
+    payload: Dict[str, Any],
+    recipients: Iterable[int],
+    *,
+    name: str = "Broadcast",
+    created_by: Optional[int] = None,
+    result: Optional[BroadcastResult] = None,
+) -> BroadcastResult:
+    """Сохранить рассылку как задание в БД и выполнить её.
+
+    Если процесс упадёт посреди отправки, задание продолжится
+    с неотправленных получателей при следующем старте (resume_broadcast_jobs).
+    Без БД рассылка выполняется как обычно, без сохранения.
+    """
+    recipients = list(recipients)
+    result = result or BroadcastResult()
+    result.planned = len(recipients)
+    if pool is None:
+        return await run_broadcast(recipients, make_sender(bot, kind, payload), name=name, result=result)
+    job_id = await create_broadcast_job(pool, kind, payload, recipients, created_by)
+    return await _run_job(pool, bot, job_id, kind, payload, recipients, name, result)
+
+
+async def run_segment_broadcast_job(
+    pool: asyncpg.Pool,
+    bot: Bot,
+    kind: str,
+    payload: Dict[str, Any],
+    segment: Dict[str, Any],
+    *,
+    name: str = "Segment broadcast",
+    created_by: Optional[int] = None,
+    result: Optional[BroadcastResult] = None,
+) -> BroadcastResult:
+    """Рассылка по сегменту аудитории (см. parse_segment).
+
+    Получатели выбираются в Postgres и читаются страницами по мере отправки,
+    полный список ID в память не попадает.
+    """
+    result = result or BroadcastResult()
+    job_id, result.planned = await create_segment_broadcast_job(pool, kind, payload, segment, created_by)
+    return await _run_pending(pool, bot, job_id, kind, payload, name, result)
+
+
+async def run_reengage_job(
+    pool: asyncpg.Pool,
+    bot: Bot,
+    week_start: date,
+    kind: str,
+    payload: Dict[str, Any],
+    *,
+    min_missed: int = 3,
+    name: str = "Re-engage",
+    result: Optional[BroadcastResult] = None,
+) -> BroadcastResult:
+    """Посчитать серии пропусков за неделю в БД и разослать напоминание тем, кто пропал.
+
+    Python не перебирает пользователей: получатели выбираются одним запросом
+    (create_reengage_broadcast_job) и читаются страницами.
+    """
+    result = result or BroadcastResult()
+    job_id, result.planned = await create_reengage_broadcast_job(pool, week_start, kind, payload, min_missed)
+    logger.info("Week %s closed, %d users to re-engage (job #%s)", week_start, result.planned, job_id)
+    return await _run_pending(pool, bot, job_id, kind, payload, name, result)
+
+
+def _run_pending(
+    pool: asyncpg.Pool,
+    bot: Bot,
+    job_id: int,
+    kind: str,
+    payload: Dict[str, Any],
+    name: str,
+    result: BroadcastResult,
+) -> Awaitable[BroadcastResult]:
+    """Выполнить задание, получатели которого уже записаны в БД"""
+    recipients = iter_pending_broadcast_recipients(pool, job_id, page_size=BROADCAST_CHECKPOINT_BATCH)
+    return _run_job(pool, bot, job_id, kind, payload, recipients, name, result)
+
+
+async def job_summary(pool: Optional[asyncpg.Pool], result: BroadcastResult) -> str:
+    """Итоги рассылки по журналу доставок в БД (учитывает и отправленное до рестарта).
+
+    Без БД или при ошибке запроса — по счётчикам из `result`.
+    """
+    if pool is None or result.job_id is None:
+        return result.summary()
+    try:
+        stats = await get_broadcast_delivery_stats(pool, result.job_id)
+    except Exception as e:
+        logger.warning("Failed to load delivery stats for job %s: %s", result.job_id, e)
+        return result.summary()
+    return format_summary(
+        stats["sent"], stats["failed"] + stats["blocked"], stats["blocked"], stats["rate"], result.throttled
+    )
+
+
+# ----------------------
+# Сегменты аудитории
+# ----------------------
+
+_SEGMENT_KEYS = ("пол", "возраст", "с", "по", "афиша")
+_GENDERS = {"м": "male", "муж": "male", "male": "male", "ж": "female", "жен": "female", "female": "female"}
+
+
+def parse_segment(text: str) -> Dict[str, Any]:
+    """Разобрать фильтр аудитории вида `пол=ж возраст=18-25 с=2024-01-01 по=2024-06-30 афиша=12`.
+
+    Любой ключ можно опустить. Бросает ValueError с понятным админу текстом.
+    """
+    segment: Dict[str, Any] = {}
+    for token in text.split():
+        key, sep, value = token.partition("=")
+        key = key.lower()
+        if not sep or not value:
+            raise ValueError(f"Непонятный фильтр: {token}")
+        if key not in _SEGMENT_KEYS:
+            raise ValueError(f"Неизвестный фильтр: {key}")
+        try:
+            if key == "пол":
+                segment["gender"] = _GENDERS[value.lower()]
+            elif key == "возраст":
+                low, _, high = value.partition("-")
+                if low:
+                    segment["age_min"] = int(low)
+                if high:
+                    segment["age_max"] = int(high)
+                elif not value.endswith("-"):
+                    segment["age_max"] = int(low)
+            elif key == "с":
+                segment["registered_from"] = date.fromisoformat(value)
+            elif key == "по":
+                segment["registered_to"] = date.fromisoformat(value)
+            else:
+                segment["poster_id"] = int(value.lstrip("#"))
+        except (KeyError, ValueError):
+            raise ValueError(f"Неверное значение фильтра: {token}") from None
+    return segment
+
+
+def describe_segment(segment: Optional[Dict[str, Any]]) -> str:
+    """Короткое описание сегмента для админа"""
+    if not segment:
+        return "все пользователи"
+    parts = []
+    if segment.get("gender"):
+        parts.append("девушки" if segment["gender"] == "female" else "парни")
+    if segment.get("age_min") is not None or segment.get("age_max") is not None:
+        parts.append(f"возраст {segment.get('age_min', '')}–{segment.get('age_max', '')}")
+    if segment.get("registered_from"):
+        parts.append(f"зарегистрированы с {segment['registered_from']:%d.%m.%Y}")
+    if segment.get("registered_to"):
+        parts.append(f"зарегистрированы по {segment['registered_to']:%d.%m.%Y}")
+    if segment.get("poster_id"):
+        parts.append(f"были на афише #{segment['poster_id']}")
+    return ", ".join(parts)
+
+
+# ----------------------
+# Фоновые рассылки
+# ----------------------
+
+BROADCAST_PROGRESS_INTERVAL = float(os.getenv("BROADCAST_PROGRESS_INTERVAL", "5"))
+
+RunFunc = Callable[[BroadcastResult], Awaitable[BroadcastResult]]
+DoneFunc = Callable[[BroadcastResult], Awaitable[None]]
+
+_tasks: Dict[int, "BroadcastTask"] = {}
+# Идущие отзывы и правки по ID рассылки: одновременно — не больше одной
+_revisions: Dict[int, "BroadcastTask"] = {}
+
+
+class BroadcastTask:
+    """Рассылка, выполняемая в фоне вне обработчика апдейта.
+
+    Прогресс (отправлено/ошибки/ETA) показывается редкими правками одного
+    сообщения админа, под которым есть кнопка остановки.
+    """
+
+    _ids = itertools.count(1)
+
+    def __init__(
+        self,
+        title: str,
+        run: RunFunc,
+        progress_message: Optional[Message] = None,
+        on_done: Optional[DoneFunc] = None,
+        pool: Optional[asyncpg.Pool] = None,
+    ):
+        self.id = next(self._ids)
+        self.pool = pool
+        self.title = title
+        self.result = BroadcastResult()
+        self.progress_message = progress_message
+        self._run = run
+        self._on_done = on_done
+        self._last_text: Optional[str] = None
+        _tasks[self.id] = self
+        self.task = asyncio.create_task(self._main(), name=f"broadcast-{self.id}")
+
+    def cancel(self) -> None:
+        """Остановить рассылку по запросу админа"""
+        self.result.cancelled = True
+        self.task.cancel()
+
+    def _cancel_markup(self) -> InlineKeyboardMarkup:
+        return InlineKeyboardMarkup([
+            [InlineKeyboardButton("⛔ Остановить рассылку", callback_data=f"broadcast:stop:{self.id}")]
+        ])
+
+    async def _edit(self, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None) -> None:
+        if not self.progress_message or text == self._last_text:
+            return
+        self._last_text = text
+        # Правки прогресса тоже расходуют общий лимит запросов
+        await get_bucket().acquire()
+        try:
+            await self.progress_message.edit_text(text, reply_markup=reply_markup)
+        except Exception as e:
+            logger.debug("Failed to update broadcast progress: %s", e)
+
+    async def _report_progress(self) -> None:
+        while True:
+            await self._edit(f"📤 {self.title}...\n{self.result.progress()}", self._cancel_markup())
+            await asyncio.sleep(BROADCAST_PROGRESS_INTERVAL)
+
+    async def _main(self) -> None:
+        reporter = asyncio.create_task(self._report_progress())
+        try:
+            await self._run(self.result)
+            text = f"✅ {self.title} завершена!\n{await job_summary(self.pool, self.result)}"
+        except asyncio.CancelledError:
+            if not self.result.cancelled:
+                raise
+            text = f"⛔ {self.title} остановлена\n{self.result.summary()}"
+        except Exception as e:
+            logger.exception("%s failed: %s", self.title, e)
+            text = f"❌ {self.title} прервана ошибкой: {e}\n{self.result.summary()}"
+        finally:
+            reporter.cancel()
+            _tasks.pop(self.id, None)
+        await self._edit(text)
+        if self._on_done:
+            try:
+                await self._on_done(self.result)
+            except Exception as e:
+                logger.warning("Broadcast on_done hook failed: %s", e)
+
+
+def launch_broadcast_job(
+    pool: Optional[asyncpg.Pool],
+    bot: Bot,
+    kind: str,
+    payload: Dict[str, Any],
+    recipients: Iterable[int],
+    *,
+    title: str = "Рассылка",
+    name: str = "Broadcast",
+    created_by: Optional[int] = None,
+    segment: Optional[Dict[str, Any]] = None,
+    progress_message: Optional[Message] = None,
+    on_done: Optional[DoneFunc] = None,
+) -> BroadcastTask:
+    """Запустить рассылку в фоне и сразу вернуть управление.
+
+    С `segment` (нужна БД) получатели выбираются запросом, а `recipients` не используются.
+    """
+    if segment is not None:
+        def run(result: BroadcastResult) -> Awaitable[BroadcastResult]:
+            return run_segment_broadcast_job(
+                pool, bot, kind, payload, segment, name=name, created_by=created_by, result=result
+            )
+
+        return BroadcastTask(title, run, progress_message=progress_message, on_done=on_done, pool=pool)
+
+    recipients = list(recipients)
+
+    def run(result: BroadcastResult) -> Awaitable[BroadcastResult]:
+        return run_broadcast_job(
+            pool, bot, kind, payload, recipients, name=name, created_by=created_by, result=result
+        )
+
+    return BroadcastTask(title, run, progress_message=progress_message, on_done=on_done, pool=pool)
+
+
+def get_broadcast_task(task_id: int) -> Optional[BroadcastTask]:
+    return _tasks.get(task_id)
+
+
+async def stop_background_broadcasts() -> None:
+    """Остановить фоновые рассылки при выключении бота.
+
+    Задания остаются в статусе running и продолжатся при следующем старте.
+    """
+    tasks = [t.task for t in _tasks.values()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+
+async def resume_broadcast_jobs(
+    pool: asyncpg.Pool,
+    bot: Bot,
+    on_done: Optional[DoneFunc] = None,
+) -> list[BroadcastTask]:
+    """Дослать в фоне незавершённые рассылки тем, кто их ещё не получил.
+
+    Прогресс показывается новым сообщением админу, создавшему рассылку.
+    """
+    tasks = []
+    for job in await get_unfinished_broadcast_jobs(pool):
+        left = (await get_broadcast_job_counts(pool, job["id"])).get("pending", 0)
+        logger.info("Resuming broadcast job #%s: %d recipients left", job["id"], left)
+
+        progress_message = None
+        if job["created_by"]:
+            try:
+                progress_message = await bot.send_message(
+                    job["created_by"], f"♻️ Продолжаю рассылку #{job['id']} после перезапуска..."
+                )
+            except Exception as e:
+                logger.warning("Failed to notify %s about resumed broadcast: %s", job["created_by"], e)
+
+        def run(result: BroadcastResult, job=job, left=left) -> Awaitable[BroadcastResult]:
+            result.planned = left
+            return _run_pending(pool, bot, job["id"], job["kind"], job["payload"], "Resumed broadcast", result)
+
+        tasks.append(
+            BroadcastTask(
+                f"Рассылка #{job['id']}", run, progress_message=progress_message, on_done=on_done, pool=pool
+            )
+        )
+    return tasks
+
+
+# ----------------------
+# Отзыв и правка отправленных рассылок
+# ----------------------
+
+def make_reviser(
+    bot: Bot,
+    action: str,
+    job: Dict[str, Any],
+    message_ids: Dict[int, int],
+    *,
+    text: Optional[str] = None,
+    entities: Optional[Sequence[MessageEntity]] = None,
+    reply_markup: Optional[InlineKeyboardMarkup] = None,
+) -> SendFunc:
+    """Функция правки уже доставленного сообщения рассылки.
+
+    action: "delete" — удалить, "markup" — заменить кнопки на `reply_markup`,
+    "text" — заменить текст/подпись на `text` (кнопки рассылки сохраняются).
+    ID сообщения берётся из `message_ids` по chat_id; запись остаётся до
+    окончательного исхода, чтобы повтор после RetryAfter нашёл её снова.
+    """
+    if action == "delete":
+        async def send(chat_id: int) -> object:
+            return await bot.delete_message(chat_id, message_ids[chat_id])
+        return send
+
+    if action == "markup":
+        async def send(chat_id: int) -> object:
+            return await bot.edit_message_reply_markup(
+                chat_id, message_ids[chat_id], reply_markup=reply_markup
+            )
+        return send
+
+    if action == "text":
+        payload = job["payload"]
+        # Кнопки рассылки остаются прежними
+        job_markup = InlineKeyboardMarkup.de_json(payload.get("reply_markup"), bot)
+        entities = list(entities or ()) or None
+        if job["kind"] == "photo" or payload.get("media"):
+            async def send(chat_id: int) -> object:
+                return await bot.edit_message_caption(
+                    chat_id, message_ids[chat_id],
+                    caption=text, caption_entities=entities, reply_markup=job_markup,
+                )
+        else:
+            async def send(chat_id: int) -> object:
+                return await bot.edit_message_text(
+                    text, chat_id, message_ids[chat_id], entities=entities, reply_markup=job_markup,
+                )
+        return send
+
+    raise ValueError(f"Unknown broadcast revision: {action}")
+
+
+async def run_broadcast_revision(
+    pool: asyncpg.Pool,
+    bot: Bot,
+    job_id: int,
+    action: str,
+    *,
+    result: Optional[BroadcastResult] = None,
+    **changes: Any,
+) -> BroadcastResult:
+    """Удалить или изменить рассылку у всех получателей через тот же ограниченный по скорости движок.
+
+    Пары (получатель, сообщение) читаются страницами из broadcast_deliveries;
+    в памяти держатся только ID сообщений, ещё не получивших окончательный исход.
+    """
+    result = result or BroadcastResult()
+    job = await get_broadcast_job(pool, job_id)
+    if job is None:
+        raise ValueError(f"Рассылка #{job_id} не найдена")
+    result.planned = await count_broadcast_messages(pool, job_id)
+
+    message_ids: Dict[int, int] = {}
+
+    async def recipients() -> AsyncIterator[int]:
+        async for user_id, message_id in iter_broadcast_messages(pool, job_id, page_size=BROADCAST_CHECKPOINT_BATCH):
+            message_ids[user_id] = message_id
+            yield user_id
+
+    async def forget(delivery: Delivery) -> None:
+        # Исход окончательный (повторы после RetryAfter уже позади)
+        message_ids.pop(delivery.chat_id, None)
+
+    send = make_reviser(bot, action, job, message_ids, **changes)
+    if action == "markup":
+        markup = changes.get("reply_markup")
+        await update_broadcast_job_markup(pool, job_id, markup.to_dict() if markup else None)
+    await run_broadcast(
+        recipients(), send, name=f"Broadcast #{job_id} {action}", on_result=forget, result=result,
+    )
+    if action == "delete":
+        await mark_broadcast_job_recalled(pool, job_id)
+    return result
+
+
+def launch_broadcast_revision(
+    pool: asyncpg.Pool,
+    bot: Bot,
+    job_id: int,
+    action: str,
+    *,
+    title: str,
+    progress_message: Optional[Message] = None,
+    **changes: Any,
+) -> BroadcastTask:
+    """Запустить run_broadcast_revision в фоне с прогрессом и кнопкой остановки"""
+    def run(result: BroadcastResult) -> Awaitable[BroadcastResult]:
+        return run_broadcast_revision(pool, bot, job_id, action, result=result, **changes)
+
+    task = BroadcastTask(title, run, progress_message=progress_message)
+    _revisions[job_id] = task
+
+    def forget(_: asyncio.Task) -> None:
+        if _revisions.get(job_id) is task:
+            del _revisions[job_id]
+
+    task.task.add_done_callback(forget)
+    return task
+
+
+def get_revision_task(job_id: int) -> Optional[BroadcastTask]:
+    """Идущий отзыв или правка рассылки job_id"""
+    return _revisions.get(job_id)
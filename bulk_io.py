@@ -0,0 +1,188 @@
+"""
+Выгрузка и загрузка users и attendances в CSV (gzip) через COPY.
+
+COPY передаёт строки потоком, без построчных INSERT и без загрузки
+таблицы в память; сжатие и чтение файла идут в отдельном потоке.
+Загрузка идёт через временную таблицу и один INSERT ... ON CONFLICT,
+поэтому существующие строки обновляются, а не дублируются.
+
+Запуск вручную:
+    python bulk_io.py export users users.csv.gz
+    python bulk_io.py import attendances attendances.csv.gz
+"""
+
+import os
+import csv
+import sys
+import gzip
+import asyncio
+import logging
+from dataclasses import dataclass
+from typing import AsyncIterator, Dict
+
+import asyncpg
+
+logger = logging.getLogger("TusaBot")
+
+# Размер куска при чтении файла для COPY FROM
+BULK_READ_CHUNK = 1 << 20
+# Уровень gzip: 6 — разумный компромисс между размером и скоростью
+BULK_GZIP_LEVEL = int(os.getenv("BULK_GZIP_LEVEL", "6"))
+
+
+@dataclass(frozen=True)
+class BulkTable:
+    name: str
+    columns: tuple[str, ...]
+    key: tuple[str, ...]
+    order_by: str
+    # Условие, которому должна удовлетворять загружаемая строка s (например, внешние ключи)
+    import_filter: str = "TRUE"
+
+
+BULK_TABLES: Dict[str, BulkTable] = {
+    "users": BulkTable(
+        name="users",
+        columns=(
+            "tg_id", "name", "gender", "age", "vk_id", "username",
+            "registered_at", "created_at", "updated_at", "blocked_at",
+        ),
+        key=("tg_id",),
+        order_by="tg_id",
+    ),
+    "attendances": BulkTable(
+        name="attendances",
+        columns=("user_id", "poster_id", "attended_at"),
+        key=("user_id", "poster_id"),
+        order_by="user_id, poster_id",
+        import_filter=(
+            "EXISTS (SELECT 1 FROM users u WHERE u.tg_id = s.user_id)"
+            " AND EXISTS (SELECT 1 FROM posters p WHERE p.id = s.poster_id)"
+        ),
+    ),
+}
+
+
+def get_bulk_table(name: str) -> BulkTable:
+    try:
+        return BULK_TABLES[name]
+    except KeyError:
+        raise ValueError(f"Неизвестная таблица: {name} (доступны: {', '.join(BULK_TABLES)})")
+
+
+def _copy_count(status: str) -> int:
+    # asyncpg возвращает статус вида "COPY 12345"
+    return int(status.split()[-1])
+
+
+async def export_table(pool: asyncpg.Pool, table: str, path: str) -> int:
+    """Выгрузить таблицу в gzip CSV с заголовком. Возвращает число строк"""
+    spec = get_bulk_table(table)
+    gz = await asyncio.to_thread(gzip.open, path, "wb", BULK_GZIP_LEVEL)
+    try:
+        async def write(chunk: bytes) -> None:
+            await asyncio.to_thread(gz.write, chunk)
+
+        async with pool.acquire() as conn:
+            status = await conn.copy_from_query(
+                f"SELECT {', '.join(spec.columns)} FROM {spec.name} ORDER BY {spec.order_by}",
+                output=write,
+                format="csv",
+                header=True,
+            )
+    finally:
+        await asyncio.to_thread(gz.close)
+    count = _copy_count(status)
+    logger.info("Exported %d rows from %s to %s", count, spec.name, path)
+    return count
+
+
+async def _read_chunks(gz: gzip.GzipFile) -> AsyncIterator[bytes]:
+    while True:
+        chunk = await asyncio.to_thread(gz.read, BULK_READ_CHUNK)
+        if not chunk:
+            return
+        yield chunk
+
+
+async def import_table(pool: asyncpg.Pool, table: str, path: str) -> tuple[int, int]:
+    """Загрузить gzip CSV в таблицу (upsert по ключу).
+
+    Набор и порядок колонок берутся из заголовка файла. Возвращает
+    (строк в файле, строк записано); разница — строки, не прошедшие
+    import_filter (например, посещения несуществующих пользователей).
+    """
+    spec = get_bulk_table(table)
+    gz = await asyncio.to_thread(gzip.open, path, "rb")
+    try:
+        header_line = await asyncio.to_thread(gz.readline)
+        columns = next(csv.reader([header_line.decode("utf-8-sig")]), [])
+        unknown = [c for c in columns if c not in spec.columns]
+        if unknown:
+            raise ValueError(f"Неизвестные колонки для {spec.name}: {', '.join(unknown)}")
+        missing = [c for c in spec.key if c not in columns]
+        if missing:
+            raise ValueError(f"В файле нет ключевых колонок {spec.name}: {', '.join(missing)}")
+
+        column_list = ", ".join(columns)
+        updates = [c for c in columns if c not in spec.key]
+        conflict = (
+            "DO UPDATE SET " + ", ".join(f"{c} = EXCLUDED.{c}" for c in updates)
+            if updates else "DO NOTHING"
+        )
+        staging = f"bulk_{spec.name}"
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute(
+                    f"CREATE TEMP TABLE {staging} (LIKE {spec.name} INCLUDING DEFAULTS) ON COMMIT DROP"
+                )
+                # Номер строки файла: COPY заполняет default по порядку строк,
+                # а порядок обычного чтения таблицы SQL не гарантирует
+                await conn.execute(f"ALTER TABLE {staging} ADD COLUMN bulk_line BIGSERIAL")
+                status = await conn.copy_to_table(
+                    staging, source=_read_chunks(gz), columns=columns, format="csv",
+                )
+                loaded = _copy_count(status)
+                # DISTINCT ON: при повторах ключа в файле побеждает последняя строка
+                status = await conn.execute(
+                    f"""
+                    INSERT INTO {spec.name} ({column_list})
+                    SELECT DISTINCT ON ({', '.join(spec.key)}) {column_list}
+                    FROM {staging} s
+                    WHERE {spec.import_filter}
+                    ORDER BY {', '.join(spec.key)}, bulk_line DESC
+                    ON CONFLICT ({', '.join(spec.key)}) {conflict}
+                    """
+                )
+    finally:
+        await asyncio.to_thread(gz.close)
+    written = int(status.split()[-1])
+    logger.info("Imported %d/%d rows into %s from %s", written, loaded, spec.name, path)
+    return loaded, written
+
+
+async def main(argv: list[str]) -> None:
+    if len(argv) != 3 or argv[0] not in ("export", "import"):
+        print(__doc__)
+        sys.exit(1)
+    mode, table, path = argv
+    from db import create_pool
+
+    pool = await create_pool()
+    try:
+        if mode == "export":
+            count = await export_table(pool, table, path)
+            print(f"✅ {table}: выгружено {count} строк в {path}")
+        else:
+            loaded, written = await import_table(pool, table, path)
+            print(f"✅ {table}: прочитано {loaded} строк, записано {written}")
+    finally:
+        await pool.close()
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main(sys.argv[1:]))
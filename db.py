@@ -1,115 +1,33 @@
-import os
 import asyncpg
-from typing import Optional, Any, Dict
+from datetime import date, datetime
+from typing import Optional, Any, AsyncIterator, Dict
 import logging
 
+import pg_pool
+from pg_pool import InstrumentedPool
+from migrate import apply_migrations
+from user_cache import user_cache, MISSING
+
 logger = logging.getLogger("TusaBot")
 
-# Environment with sane defaults based on your provided DB creds
-DB_HOST = os.getenv("DB_HOST", "localhost")
-DB_PORT = int(os.getenv("DB_PORT", "5432"))
-DB_NAME = os.getenv("DB_NAME", "EuphoriaDB")
-DB_USER = os.getenv("DB_USER", "postgres")
-DB_PASSWORD = os.getenv("DB_PASSWORD", "1")
-
-
-async def create_pool() -> asyncpg.Pool:
-    return await asyncpg.create_pool(
-        host=DB_HOST,
-        port=DB_PORT,
-        database=DB_NAME,
-        user=DB_USER,
-        password=DB_PASSWORD,
-        min_size=1,
-        max_size=10,
-        command_timeout=30,
+# Текст должен совпадать с запросом в get_user: кэш подготовленных запросов — по тексту
+USER_BY_ID_QUERY = "SELECT * FROM users WHERE tg_id=$1"
+
+
+async def create_pool() -> InstrumentedPool:
+    """Пул бота: настройки, JSON-кодеки и метрики — в pg_pool.py"""
+    return await pg_pool.create_pool(
+        name="bot",
+        # tg_id 0 не бывает: запрос ничего не читает, но остаётся в кэше соединения
+        warmup_queries=((USER_BY_ID_QUERY, (0,)),),
     )
 
 
 async def init_schema(pool: asyncpg.Pool) -> None:
-    async with pool.acquire() as conn:
-        # Таблица пользователей
-        await conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS users (
-                tg_id BIGINT PRIMARY KEY,
-                name TEXT,
-                gender TEXT CHECK (gender IN ('male', 'female')),
-                age INTEGER CHECK (age >= 16 AND age <= 100),
-                vk_id TEXT,
-                username TEXT,
-                registered_at TIMESTAMPTZ DEFAULT now(),
-                created_at TIMESTAMPTZ DEFAULT now(),
-                updated_at TIMESTAMPTZ DEFAULT now()
-            );
-            """
-        )
-        
-        # Таблица афиш
-        await conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS posters (
-                id SERIAL PRIMARY KEY,
-                file_id TEXT NOT NULL,
-                caption TEXT,
-                ticket_url TEXT,
-                created_at TIMESTAMPTZ DEFAULT now(),
-                is_active BOOLEAN DEFAULT true
-            );
-            """
-        )
-        
-        # Таблица посещаемости
-        await conn.execute(
-            """
-            CREATE TABLE IF NOT EXISTS attendances (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT REFERENCES users(tg_id) ON DELETE CASCADE,
-                poster_id INTEGER REFERENCES posters(id) ON DELETE CASCADE,
-                attended_at TIMESTAMPTZ DEFAULT now(),
-                UNIQUE(user_id, poster_id)
-            );
-            """
-        )
-        
-        # Индексы
-        await conn.execute(
-            """
-            CREATE INDEX IF NOT EXISTS idx_users_vk_id ON users(vk_id);
-            CREATE INDEX IF NOT EXISTS idx_users_registered_at ON users(registered_at);
-            CREATE INDEX IF NOT EXISTS idx_posters_is_active ON posters(is_active);
-            CREATE INDEX IF NOT EXISTS idx_attendances_user_id ON attendances(user_id);
-            CREATE INDEX IF NOT EXISTS idx_attendances_poster_id ON attendances(poster_id);
-            """
-        )
-        
-        # Создание функции для автоматического обновления updated_at
-        await conn.execute(
-            """
-            CREATE OR REPLACE FUNCTION update_updated_at_column()
-            RETURNS TRIGGER AS $$
-            BEGIN
-                NEW.updated_at = now();
-                RETURN NEW;
-            END;
-            $$ language 'plpgsql';
-            """
-        )
-        
-        # Создание триггера для автоматического обновления updated_at в таблице users
-        await conn.execute(
-            """
-            DROP TRIGGER IF EXISTS update_users_updated_at ON users;
-            """
-        )
-        await conn.execute(
-            """
-            CREATE TRIGGER update_users_updated_at 
-                BEFORE UPDATE ON users 
-                FOR EACH ROW 
-                EXECUTE FUNCTION update_updated_at_column();
-            """
-        )
+    """Довести схему БД до актуальной версии (см. migrate.py и migrations/*.sql)"""
+    applied = await apply_migrations(pool)
+    if applied:
+        logger.info("Applied DB migrations: %s", ", ".join(applied))
 
 
 async def upsert_user(
@@ -124,7 +42,7 @@ async def upsert_user(
         try:
             logger.info("Upserting user %s: name=%s, gender=%s, age=%s, username=%s", 
                        tg_id, name, gender, age, username)
-            await conn.execute(
+            row = await conn.fetchrow(
                 """
                 INSERT INTO users (tg_id, name, gender, age, username)
                 VALUES ($1, $2, $3, $4, $5)
@@ -132,7 +50,8 @@ async def upsert_user(
                 SET name = COALESCE(EXCLUDED.name, users.name),
                     gender = COALESCE(EXCLUDED.gender, users.gender),
                     age = COALESCE(EXCLUDED.age, users.age),
-                    username = COALESCE(EXCLUDED.username, users.username);
+                    username = COALESCE(EXCLUDED.username, users.username)
+                RETURNING *;
                 """,
                 tg_id,
                 name,
@@ -140,38 +59,174 @@ async def upsert_user(
                 age,
                 username,
             )
+            user_cache.put(tg_id, dict(row))
             logger.info("Successfully upserted user %s", tg_id)
         except Exception as e:
             logger.error("Failed to upsert user %s: %s", tg_id, e)
             raise
 
 
+async def upsert_users(pool: asyncpg.Pool, updates: Dict[int, Dict[str, Any]]) -> list[Dict[str, Any]]:
+    """Пакетный upsert профилей одним запросом: {tg_id: {name, gender, age, username}}.
+
+    Как и upsert_user, не затирает известные поля значениями None.
+    Возвращает строки пользователей после записи.
+    """
+    tg_ids = list(updates)
+    fields = [updates[tg_id] for tg_id in tg_ids]
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(
+            """
+            INSERT INTO users (tg_id, name, gender, age, username)
+            SELECT * FROM unnest($1::bigint[], $2::text[], $3::text[], $4::int[], $5::text[])
+            ON CONFLICT (tg_id) DO UPDATE
+            SET name = COALESCE(EXCLUDED.name, users.name),
+                gender = COALESCE(EXCLUDED.gender, users.gender),
+                age = COALESCE(EXCLUDED.age, users.age),
+                username = COALESCE(EXCLUDED.username, users.username)
+            RETURNING *
+            """,
+            tg_ids,
+            [f.get("name") for f in fields],
+            [f.get("gender") for f in fields],
+            [f.get("age") for f in fields],
+            [f.get("username") for f in fields],
+        )
+        return [dict(row) for row in rows]
+
+
 async def set_vk_id(pool: asyncpg.Pool, tg_id: int, vk_id: str) -> None:
     async with pool.acquire() as conn:
-        await conn.execute(
-            "UPDATE users SET vk_id=$2 WHERE tg_id=$1",
+        row = await conn.fetchrow(
+            "UPDATE users SET vk_id=$2 WHERE tg_id=$1 RETURNING *",
             tg_id,
             vk_id,
         )
+        user_cache.put(tg_id, dict(row) if row else None)
 
 
 async def get_user(pool: asyncpg.Pool, tg_id: int) -> Optional[Dict[str, Any]]:
+    """Профиль пользователя; повторные запросы отдаются из user_cache"""
+    cached = user_cache.get(tg_id)
+    if cached is not MISSING:
+        return cached
     async with pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT * FROM users WHERE tg_id=$1", tg_id)
-        return dict(row) if row else None
+        row = await conn.fetchrow(USER_BY_ID_QUERY, tg_id)
+    return user_cache.put(tg_id, dict(row) if row else None)
 
 
 async def get_user_by_username(pool: asyncpg.Pool, username: str) -> Optional[Dict[str, Any]]:
-    """Поиск пользователя по Telegram username"""
+    """Поиск пользователя по Telegram username (индекс idx_users_username_lower)"""
     async with pool.acquire() as conn:
         row = await conn.fetchrow("SELECT * FROM users WHERE LOWER(username)=LOWER($1)", username)
         return dict(row) if row else None
 
 
-async def get_all_user_ids(pool: asyncpg.Pool) -> list[int]:
+async def search_users(pool: asyncpg.Pool, query: str, limit: int = 5) -> list[Dict[str, Any]]:
+    """Похожие пользователи по username и имени, лучшие совпадения первыми.
+
+    Оператор % (pg_trgm) отбирает кандидатов по триграммным индексам,
+    score — наибольшее сходство с username или именем (0..1).
+    """
+    query = query.strip().lstrip('@').lower()
+    if not query:
+        return []
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(
+            """
+            SELECT tg_id, name, username,
+                   GREATEST(
+                       similarity(LOWER(username), $1),
+                       similarity(LOWER(name), $1)
+                   ) AS score
+            FROM users
+            WHERE LOWER(username) % $1 OR LOWER(name) % $1
+            ORDER BY (LOWER(username) = $1) IS TRUE DESC, score DESC, tg_id
+            LIMIT $2
+            """,
+            query, limit
+        )
+        return [dict(row) for row in rows]
+
+
+async def fetch_roster_rows(
+    pool: asyncpg.Pool, after_tg_id: int, limit: int
+) -> list[asyncpg.Record]:
+    """Пачка пользователей для roster.py по порядку tg_id (полная загрузка)"""
     async with pool.acquire() as conn:
-        rows = await conn.fetch("SELECT tg_id FROM users")
-        return [r[0] for r in rows]
+        return await conn.fetch(
+            """
+            SELECT tg_id, gender, age, registered_at::date - DATE '1970-01-01' AS reg_day,
+                   blocked_at IS NOT NULL AS blocked, updated_at
+            FROM users
+            WHERE tg_id > $1
+            ORDER BY tg_id
+            LIMIT $2
+            """,
+            after_tg_id, limit
+        )
+
+
+async def fetch_roster_changes(
+    pool: asyncpg.Pool, since: datetime, after_tg_id: int, limit: int
+) -> list[asyncpg.Record]:
+    """Пачка пользователей, изменённых после (since, after_tg_id), по порядку updated_at"""
+    async with pool.acquire() as conn:
+        return await conn.fetch(
+            """
+            SELECT tg_id, gender, age, registered_at::date - DATE '1970-01-01' AS reg_day,
+                   blocked_at IS NOT NULL AS blocked, updated_at
+            FROM users
+            WHERE (updated_at, tg_id) > ($1, $2)
+            ORDER BY updated_at, tg_id
+            LIMIT $3
+            """,
+            since, after_tg_id, limit
+        )
+
+
+async def get_users_total(pool: asyncpg.Pool) -> int:
+    """Число строк в users по счётчику stats_counters"""
+    async with pool.acquire() as conn:
+        return await conn.fetchval(
+            "SELECT COALESCE((SELECT value FROM stats_counters WHERE name = 'users_total'), 0)"
+        )
+
+
+async def get_db_now(pool: asyncpg.Pool) -> datetime:
+    async with pool.acquire() as conn:
+        return await conn.fetchval("SELECT now()")
+
+
+async def mark_users_blocked(pool: asyncpg.Pool, user_ids: list[int]) -> None:
+    """Отметить пачку пользователей, заблокировавших бота или удалённых"""
+    query = "UPDATE users SET blocked_at = now() WHERE tg_id = ANY($1::bigint[]) AND blocked_at IS NULL"
+    async with pool.acquire() as conn:
+        try:
+            await conn.execute(query, user_ids)
+        except asyncpg.CheckViolationError as e:
+            # Строка со старым возрастом вне users_age_check (миграция 011) не должна
+            # мешать отметить остальных
+            logger.warning("Marking %d users blocked row by row: %s", len(user_ids), e)
+            for tg_id in user_ids:
+                try:
+                    await conn.execute(query, [tg_id])
+                except asyncpg.CheckViolationError as e:
+                    logger.warning("Cannot mark user %s blocked: %s", tg_id, e)
+    user_cache.invalidate(*user_ids)
+
+
+async def unblock_user(pool: asyncpg.Pool, tg_id: int) -> bool:
+    """Вернуть пользователя в рассылки. True если он был отмечен заблокировавшим"""
+    async with pool.acquire() as conn:
+        result = await conn.execute(
+            "UPDATE users SET blocked_at = NULL WHERE tg_id = $1 AND blocked_at IS NOT NULL",
+            tg_id
+        )
+    if result == "UPDATE 0":
+        return False
+    user_cache.invalidate(tg_id)
+    return True
 
 
 async def load_user_vk_data(pool: asyncpg.Pool) -> dict[int, str]:
@@ -182,145 +237,24 @@ async def load_user_vk_data(pool: asyncpg.Pool) -> dict[int, str]:
 
 
 async def get_user_stats(pool: asyncpg.Pool) -> dict:
-    """Получить статистику пользователей"""
+    """Получить статистику пользователей (счётчики ведут триггеры, см. migrations/005)"""
     async with pool.acquire() as conn:
         stats = await conn.fetchrow("""
-            SELECT 
-                COUNT(*) as total_users,
-                COUNT(CASE WHEN gender = 'male' THEN 1 END) as male_users,
-                COUNT(CASE WHEN gender = 'female' THEN 1 END) as female_users,
-                COUNT(CASE WHEN registered_at >= CURRENT_DATE THEN 1 END) as today_registrations
-            FROM users
+            SELECT
+                COALESCE(MAX(value) FILTER (WHERE name = 'users_total'), 0) AS total_users,
+                COALESCE(MAX(value) FILTER (WHERE name = 'users_male'), 0) AS male_users,
+                COALESCE(MAX(value) FILTER (WHERE name = 'users_female'), 0) AS female_users,
+                COALESCE(MAX(value) FILTER (WHERE name = 'users_with_vk'), 0) AS users_with_vk,
+                COALESCE((
+                    SELECT value FROM stats_daily
+                    WHERE name = 'registrations' AND day = CURRENT_DATE
+                ), 0) AS today_registrations
+            FROM stats_counters
+            WHERE name IN ('users_total', 'users_male', 'users_female', 'users_with_vk')
         """)
         return dict(stats) if stats else {}
 
 
-async def export_users_to_excel(pool: asyncpg.Pool, filename: str = "users_export.xlsx") -> str:
-    """Экспорт всех пользователей в Excel файл"""
-    try:
-        from openpyxl import Workbook
-        from openpyxl.styles import Font, PatternFill, Alignment
-        from datetime import datetime
-        
-        async with pool.acquire() as conn:
-            users = await conn.fetch("""
-                SELECT 
-                    tg_id,
-                    name,
-                    gender,
-                    age,
-                    registered_at,
-                    created_at
-                FROM users 
-                ORDER BY registered_at DESC
-            """)
-        
-        # Создаем Excel файл
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "Пользователи TusaBot"
-        
-        # Заголовки
-        headers = [
-            "Telegram ID", "Имя", "Пол", "Возраст", 
-            "Дата регистрации", "Дата создания"
-        ]
-        
-        # Стилизация заголовков
-        header_font = Font(bold=True, color="FFFFFF")
-        header_fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
-        header_alignment = Alignment(horizontal="center", vertical="center")
-        
-        for col, header in enumerate(headers, 1):
-            cell = ws.cell(row=1, column=col, value=header)
-            cell.font = header_font
-            cell.fill = header_fill
-            cell.alignment = header_alignment
-        
-        # Данные пользователей
-        for row_idx, user in enumerate(users, 2):
-            ws.cell(row=row_idx, column=1, value=user['tg_id'])
-            ws.cell(row=row_idx, column=2, value=user['name'] or "Не указано")
-            
-            # Пол на русском
-            gender_map = {"male": "Мужской", "female": "Женский"}
-            ws.cell(row=row_idx, column=3, value=gender_map.get(user['gender'], "Не указано"))
-            
-            # Возраст
-            age = user.get('age')
-            if age:
-                ws.cell(row=row_idx, column=4, value=f"{age} лет")
-            else:
-                ws.cell(row=row_idx, column=4, value="Не указано")
-            
-            # Даты
-            if user.get('registered_at'):
-                ws.cell(row=row_idx, column=5, value=user['registered_at'].strftime("%d.%m.%Y %H:%M"))
-            else:
-                ws.cell(row=row_idx, column=5, value="Не указано")
-                
-            if user.get('created_at'):
-                ws.cell(row=row_idx, column=6, value=user['created_at'].strftime("%d.%m.%Y %H:%M"))
-            else:
-                ws.cell(row=row_idx, column=6, value="Не указано")
-        
-        # Автоподбор ширины колонок
-        for column in ws.columns:
-            max_length = 0
-            column_letter = column[0].column_letter
-            for cell in column:
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
-            adjusted_width = min(max_length + 2, 50)
-            ws.column_dimensions[column_letter].width = adjusted_width
-        
-        # Добавляем лист со статистикой
-        stats_ws = wb.create_sheet("Статистика")
-        stats = await get_user_stats(pool)
-        
-        stats_data = [
-            ["Показатель", "Значение"],
-            ["Всего пользователей", stats.get('total_users', 0)],
-            ["С привязанным VK", stats.get('users_with_vk', 0)],
-            ["Мужчин", stats.get('male_users', 0)],
-            ["Женщин", stats.get('female_users', 0)],
-            ["Зарегистрировано сегодня", stats.get('today_registrations', 0)],
-            ["Дата экспорта", datetime.now().strftime("%d.%m.%Y %H:%M")]
-        ]
-        
-        for row_idx, (label, value) in enumerate(stats_data, 1):
-            stats_ws.cell(row=row_idx, column=1, value=label)
-            stats_ws.cell(row=row_idx, column=2, value=value)
-            if row_idx == 1:  # Заголовок
-                stats_ws.cell(row=row_idx, column=1).font = header_font
-                stats_ws.cell(row=row_idx, column=2).font = header_font
-                stats_ws.cell(row=row_idx, column=1).fill = header_fill
-                stats_ws.cell(row=row_idx, column=2).fill = header_fill
-        
-        # Автоподбор ширины для статистики
-        for column in stats_ws.columns:
-            max_length = 0
-            column_letter = column[0].column_letter
-            for cell in column:
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
-            adjusted_width = max_length + 2
-            stats_ws.column_dimensions[column_letter].width = adjusted_width
-        
-        # Сохраняем файл
-        wb.save(filename)
-        return filename
-        
-    except Exception as e:
-        raise Exception(f"Ошибка экспорта в Excel: {e}")
-
-
 # ----------------------
 # Функции для работы с афишами (posters)
 # ----------------------
@@ -332,13 +266,14 @@ async def create_poster(
     ticket_url: Optional[str] = None,
     venue_map_file_id: Optional[str] = None,
     venue_map_url: Optional[str] = None,
+    photo_path: Optional[str] = None,
 ) -> int:
     """Создать новую афишу и вернуть её ID"""
     async with pool.acquire() as conn:
         row = await conn.fetchrow(
             """
-            INSERT INTO posters (file_id, caption, ticket_url, venue_map_file_id, venue_map_url, is_active)
-            VALUES ($1, $2, $3, $4, $5, true)
+            INSERT INTO posters (file_id, caption, ticket_url, venue_map_file_id, venue_map_url, photo_path, is_active)
+            VALUES ($1, $2, $3, $4, $5, $6, true)
             RETURNING id
             """,
             file_id,
@@ -346,16 +281,28 @@ async def create_poster(
             ticket_url,
             venue_map_file_id,
             venue_map_url,
+            photo_path,
         )
         return row['id']
 
 
+# Варианты фото строки (см. images.py) списком jsonb; {source} — выражение с веб-путём оригинала
+MEDIA_VARIANTS_SQL = """(
+    SELECT jsonb_agg(jsonb_build_object(
+        'variant', v.variant, 'format', v.format, 'path', v.path,
+        'width', v.width, 'height', v.height, 'bytes', v.bytes
+    ) ORDER BY v.width, v.format)
+    FROM media_variants v WHERE v.source = {source}
+) AS variants"""
+
+
 async def get_active_posters(pool: asyncpg.Pool) -> list[Dict[str, Any]]:
-    """Получить все активные афиши"""
+    """Получить все активные афиши (с вариантами фото)"""
     async with pool.acquire() as conn:
         rows = await conn.fetch(
-            """
-            SELECT id, file_id, caption, ticket_url, venue_map_file_id, venue_map_url, created_at, is_active
+            f"""
+            SELECT id, file_id, caption, ticket_url, venue_map_file_id, venue_map_url, created_at, is_active,
+                   photo_path, file_id_broken_at, {MEDIA_VARIANTS_SQL.format(source="COALESCE(photo_path, file_id)")}
             FROM posters
             WHERE is_active = true
             ORDER BY created_at DESC
@@ -369,7 +316,8 @@ async def get_latest_poster(pool: asyncpg.Pool) -> Optional[Dict[str, Any]]:
     async with pool.acquire() as conn:
         row = await conn.fetchrow(
             """
-            SELECT id, file_id, caption, ticket_url, venue_map_file_id, venue_map_url, created_at, is_active
+            SELECT id, file_id, caption, ticket_url, venue_map_file_id, venue_map_url, created_at, is_active,
+                   photo_path, file_id_broken_at
             FROM posters
             WHERE is_active = true
             ORDER BY created_at DESC
@@ -383,7 +331,11 @@ async def get_poster_by_id(pool: asyncpg.Pool, poster_id: int) -> Optional[Dict[
     """Получить афишу по ID"""
     async with pool.acquire() as conn:
         row = await conn.fetchrow(
-            "SELECT id, file_id, caption, ticket_url, venue_map_file_id, venue_map_url, created_at, is_active FROM posters WHERE id=$1",
+            """
+            SELECT id, file_id, caption, ticket_url, venue_map_file_id, venue_map_url, created_at, is_active,
+                   photo_path, file_id_broken_at
+            FROM posters WHERE id=$1
+            """,
             poster_id
         )
         return dict(row) if row else None
@@ -417,6 +369,75 @@ async def update_poster_ticket_url(pool: asyncpg.Pool, poster_id: int, ticket_ur
         )
 
 
+# Таблицы с Telegram file_id, которые проверяет file_id_check.py
+FILE_ID_TABLES = {"poster": "posters", "story": "stories"}
+
+
+async def get_file_id_targets(pool: asyncpg.Pool) -> list[asyncpg.Record]:
+    """Активные афиши и Stories: kind, id, file_id, photo_path (локальная копия), file_id_broken_at"""
+    async with pool.acquire() as conn:
+        return await conn.fetch(
+            """
+            SELECT 'poster' AS kind, id, file_id, photo_path, file_id_broken_at
+            FROM posters WHERE is_active = true
+            UNION ALL
+            SELECT 'story', id, file_id, NULL, file_id_broken_at
+            FROM stories WHERE is_active = true
+            ORDER BY kind, id
+            """
+        )
+
+
+async def set_file_ids_broken(pool: asyncpg.Pool, kind: str, broken_ids: list[int], ok_ids: list[int]) -> None:
+    """Отметить нерабочие file_id и снять отметку с заработавших (строки без изменений не трогаются)"""
+    table = FILE_ID_TABLES[kind]
+    async with pool.acquire() as conn:
+        await conn.execute(
+            f"""
+            UPDATE {table}
+            SET file_id_broken_at = CASE WHEN id = ANY($1::int[]) THEN now() END
+            WHERE (id = ANY($1::int[]) AND file_id_broken_at IS NULL)
+               OR (id = ANY($2::int[]) AND file_id_broken_at IS NOT NULL)
+            """,
+            broken_ids,
+            ok_ids,
+        )
+
+
+async def replace_file_id(pool: asyncpg.Pool, kind: str, item_id: int, old_file_id: str, new_file_id: str) -> bool:
+    """Заменить file_id свежим (после перезаливки). False — если file_id уже успели поменять"""
+    table = FILE_ID_TABLES[kind]
+    async with pool.acquire() as conn:
+        status = await conn.execute(
+            f"UPDATE {table} SET file_id=$3, file_id_broken_at=NULL WHERE id=$1 AND file_id=$2",
+            item_id,
+            old_file_id,
+            new_file_id,
+        )
+        return status == "UPDATE 1"
+
+
+async def save_media_variants(pool: asyncpg.Pool, source: str, variants: list) -> None:
+    """Записать варианты фото (images.Variant) одной командой"""
+    async with pool.acquire() as conn:
+        await conn.execute(
+            """
+            INSERT INTO media_variants AS m (source, variant, format, path, width, height, bytes)
+            SELECT $1, * FROM unnest($2::text[], $3::text[], $4::text[], $5::int[], $6::int[], $7::int[])
+            ON CONFLICT (source, variant, format) DO UPDATE
+            SET path = EXCLUDED.path, width = EXCLUDED.width, height = EXCLUDED.height,
+                bytes = EXCLUDED.bytes, created_at = now()
+            """,
+            source,
+            [v.variant for v in variants],
+            [v.format for v in variants],
+            [v.path for v in variants],
+            [v.width for v in variants],
+            [v.height for v in variants],
+            [v.bytes for v in variants],
+        )
+
+
 # ----------------------
 # Функции для работы с посещаемостью (attendances)
 # ----------------------
@@ -584,3 +605,357 @@ async def update_story(pool: asyncpg.Pool, story_id: int, file_id: Optional[str]
                 "UPDATE stories SET caption = $2 WHERE id = $1",
                 story_id, caption
             )
+
+
+# ----------------------
+# Broadcast jobs
+# ----------------------
+
+async def create_broadcast_job(
+    pool: asyncpg.Pool,
+    kind: str,
+    payload: Dict[str, Any],
+    user_ids: list[int],
+    created_by: Optional[int] = None,
+) -> int:
+    """Создать задание рассылки вместе со списком получателей"""
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            job_id = await conn.fetchval(
+                """
+                INSERT INTO broadcast_jobs (kind, payload, created_by)
+                VALUES ($1, $2::jsonb, $3)
+                RETURNING id
+                """,
+                kind, payload, created_by
+            )
+            await conn.execute(
+                """
+                INSERT INTO broadcast_recipients (job_id, user_id)
+                SELECT $1, unnest($2::bigint[])
+                ON CONFLICT DO NOTHING
+                """,
+                job_id, user_ids
+            )
+            return job_id
+
+
+def _segment_filter(segment: Dict[str, Any], first_arg: int = 1) -> tuple[str, list]:
+    """WHERE для выборки аудитории рассылки из users (алиас u).
+
+    Ключи сегмента: gender, age_min, age_max, registered_from, registered_to
+    (date, правая граница включительно), poster_id (отмечался на афише).
+    Заблокировавшие бота исключаются всегда.
+    """
+    conditions = ["u.blocked_at IS NULL"]
+    args: list = []
+
+    def arg(value: Any) -> str:
+        args.append(value)
+        return f"${first_arg + len(args) - 1}"
+
+    if segment.get("gender"):
+        conditions.append(f"u.gender = {arg(segment['gender'])}")
+    if segment.get("age_min") is not None:
+        conditions.append(f"u.age >= {arg(segment['age_min'])}")
+    if segment.get("age_max") is not None:
+        conditions.append(f"u.age <= {arg(segment['age_max'])}")
+    if segment.get("registered_from"):
+        conditions.append(f"u.registered_at >= {arg(segment['registered_from'])}::date")
+    if segment.get("registered_to"):
+        conditions.append(f"u.registered_at < {arg(segment['registered_to'])}::date + 1")
+    if segment.get("poster_id"):
+        conditions.append(
+            f"EXISTS (SELECT 1 FROM attendances a WHERE a.user_id = u.tg_id AND a.poster_id = {arg(segment['poster_id'])})"
+        )
+    return " AND ".join(conditions), args
+
+
+async def count_segment_users(pool: asyncpg.Pool, segment: Dict[str, Any]) -> int:
+    """Размер аудитории сегмента (для предпросмотра рассылки)"""
+    where, args = _segment_filter(segment)
+    async with pool.acquire() as conn:
+        return await conn.fetchval(f"SELECT COUNT(*) FROM users u WHERE {where}", *args)
+
+
+async def create_segment_broadcast_job(
+    pool: asyncpg.Pool,
+    kind: str,
+    payload: Dict[str, Any],
+    segment: Dict[str, Any],
+    created_by: Optional[int] = None,
+) -> tuple[int, int]:
+    """Создать задание рассылки по сегменту. Возвращает (id задания, число получателей).
+
+    Аудитория выбирается и записывается в broadcast_recipients одним
+    INSERT ... SELECT на стороне Postgres, ID в Python не загружаются.
+    """
+    where, args = _segment_filter(segment, first_arg=2)
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            job_id = await conn.fetchval(
+                """
+                INSERT INTO broadcast_jobs (kind, payload, created_by)
+                VALUES ($1, $2::jsonb, $3)
+                RETURNING id
+                """,
+                kind, payload, created_by
+            )
+            status = await conn.execute(
+                f"""
+                INSERT INTO broadcast_recipients (job_id, user_id)
+                SELECT $1, u.tg_id FROM users u WHERE {where}
+                """,
+                job_id, *args
+            )
+            return job_id, int(status.split()[-1])
+
+
+async def create_reengage_broadcast_job(
+    pool: asyncpg.Pool,
+    week_start: date,
+    kind: str,
+    payload: Dict[str, Any],
+    min_missed: int = 3,
+) -> tuple[int, int]:
+    """Закрыть неделю в user_streaks и создать рассылку тем, кто пропустил `min_missed` недель подряд.
+
+    Неделя посещена, если пользователь отмечался на афише, опубликованной
+    в эту неделю (понедельник `week_start`). Серии всех пользователей
+    обновляются одним upsert, получатели сразу попадают в broadcast_recipients.
+    Повторный запуск за ту же неделю ничего не меняет и никого не добавляет.
+    Возвращает (id задания, число получателей).
+    """
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            job_id = await conn.fetchval(
+                """
+                INSERT INTO broadcast_jobs (kind, payload)
+                VALUES ($1, $2::jsonb)
+                RETURNING id
+                """,
+                kind, payload
+            )
+            status = await conn.execute(
+                """
+                WITH attended AS (
+                    SELECT DISTINCT a.user_id
+                    FROM attendances a
+                    JOIN posters p ON p.id = a.poster_id
+                    WHERE p.created_at >= $2::date AND p.created_at < $2::date + 7
+                ), streaks AS (
+                    INSERT INTO user_streaks AS s (user_id, missed_in_row, last_attended_week, computed_week)
+                    SELECT u.tg_id,
+                           CASE WHEN at.user_id IS NULL THEN 1 ELSE 0 END,
+                           CASE WHEN at.user_id IS NULL THEN NULL ELSE $2::date END,
+                           $2::date
+                    FROM users u
+                    LEFT JOIN attended at ON at.user_id = u.tg_id
+                    ON CONFLICT (user_id) DO UPDATE SET
+                        missed_in_row = CASE WHEN EXCLUDED.last_attended_week IS NULL
+                                             THEN s.missed_in_row + 1 ELSE 0 END,
+                        last_attended_week = COALESCE(EXCLUDED.last_attended_week, s.last_attended_week),
+                        computed_week = EXCLUDED.computed_week
+                    WHERE s.computed_week < EXCLUDED.computed_week
+                    RETURNING s.user_id, s.missed_in_row
+                )
+                INSERT INTO broadcast_recipients (job_id, user_id)
+                SELECT $1, st.user_id
+                FROM streaks st
+                JOIN users u ON u.tg_id = st.user_id
+                WHERE st.missed_in_row >= $3 AND u.blocked_at IS NULL
+                """,
+                job_id, week_start, min_missed
+            )
+            return job_id, int(status.split()[-1])
+
+
+async def get_unfinished_broadcast_jobs(pool: asyncpg.Pool) -> list[Dict[str, Any]]:
+    """Получить рассылки, прерванные на середине (например, рестартом бота)"""
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(
+            """
+            SELECT id, kind, payload, created_by, created_at
+            FROM broadcast_jobs
+            WHERE status = 'running'
+            ORDER BY id
+            """
+        )
+        return [dict(row) for row in rows]
+
+
+async def iter_pending_broadcast_recipients(
+    pool: asyncpg.Pool, job_id: int, page_size: int = 500
+) -> AsyncIterator[int]:
+    """Получатели рассылки, которым ещё ничего не отправлено.
+
+    Читаются страницами по `page_size` по ключу user_id: на каждую страницу
+    соединение берётся из пула ненадолго и без транзакции, так что долгая
+    рассылка не держит соединение и снимок (VACUUM чистит broadcast_recipients).
+    """
+    last_user_id = None
+    while True:
+        async with pool.acquire() as conn:
+            rows = await conn.fetch(
+                """
+                SELECT user_id FROM broadcast_recipients
+                WHERE job_id = $1 AND status = 'pending' AND ($2::bigint IS NULL OR user_id > $2)
+                ORDER BY user_id
+                LIMIT $3
+                """,
+                job_id, last_user_id, page_size
+            )
+        for row in rows:
+            yield row[0]
+        if len(rows) < page_size:
+            return
+        last_user_id = rows[-1][0]
+
+
+async def save_broadcast_deliveries(pool: asyncpg.Pool, job_id: int, rows: list[tuple]) -> None:
+    """Записать пачку исходов отправки: (user_id, status, message_id, error, sent_at).
+
+    Журнал пишется через COPY, статусы получателей — одним UPDATE,
+    оба в одной транзакции, чтобы после рестарта не было повторов.
+    """
+    async with pool.acquire() as conn:
+        async with conn.transaction():
+            await conn.copy_records_to_table(
+                "broadcast_deliveries",
+                records=[(job_id, *row) for row in rows],
+                columns=["job_id", "user_id", "status", "message_id", "error", "sent_at"],
+            )
+            await conn.execute(
+                """
+                UPDATE broadcast_recipients r
+                SET status = v.status
+                FROM unnest($2::bigint[], $3::text[]) AS v(user_id, status)
+                WHERE r.job_id = $1 AND r.user_id = v.user_id
+                """,
+                job_id, [row[0] for row in rows], [row[1] for row in rows]
+            )
+
+
+async def get_recent_broadcast_jobs(pool: asyncpg.Pool, limit: int = 10) -> list[Dict[str, Any]]:
+    """Последние рассылки с числом доставленных сообщений (для отзыва и правки)"""
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(
+            """
+            SELECT j.id, j.kind, j.status, j.created_at, j.recalled_at,
+                   (SELECT COUNT(*) FROM broadcast_deliveries d
+                    WHERE d.job_id = j.id AND d.status = 'sent') AS delivered
+            FROM broadcast_jobs j
+            ORDER BY j.id DESC
+            LIMIT $1
+            """,
+            limit
+        )
+        return [dict(row) for row in rows]
+
+
+async def get_broadcast_job(pool: asyncpg.Pool, job_id: int) -> Optional[Dict[str, Any]]:
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow(
+            """
+            SELECT id, kind, payload, status, created_by, created_at, recalled_at
+            FROM broadcast_jobs WHERE id = $1
+            """,
+            job_id
+        )
+        return dict(row) if row else None
+
+
+async def count_broadcast_messages(pool: asyncpg.Pool, job_id: int) -> int:
+    """Сколько сообщений рассылки доставлено и может быть удалено/изменено"""
+    async with pool.acquire() as conn:
+        return await conn.fetchval(
+            """
+            SELECT COUNT(*) FROM broadcast_deliveries
+            WHERE job_id = $1 AND status = 'sent' AND message_id IS NOT NULL
+            """,
+            job_id
+        )
+
+
+async def iter_broadcast_messages(
+    pool: asyncpg.Pool, job_id: int, page_size: int = 500
+) -> AsyncIterator[tuple[int, int]]:
+    """Пары (user_id, message_id) доставленных сообщений рассылки.
+
+    Страницами по ключу (user_id, message_id), как iter_pending_broadcast_recipients:
+    отзыв или правка не держат соединение пула всё время работы.
+    """
+    last = (None, None)
+    while True:
+        async with pool.acquire() as conn:
+            rows = await conn.fetch(
+                """
+                SELECT user_id, message_id FROM broadcast_deliveries
+                WHERE job_id = $1 AND status = 'sent' AND message_id IS NOT NULL
+                  AND ($2::bigint IS NULL OR (user_id, message_id) > ($2, $3::bigint))
+                ORDER BY user_id, message_id
+                LIMIT $4
+                """,
+                job_id, *last, page_size
+            )
+        for row in rows:
+            yield row[0], row[1]
+        if len(rows) < page_size:
+            return
+        last = (rows[-1][0], rows[-1][1])
+
+
+async def update_broadcast_job_markup(
+    pool: asyncpg.Pool, job_id: int, reply_markup: Optional[Dict[str, Any]]
+) -> None:
+    """Сохранить новую клавиатуру рассылки, чтобы последующие правки текста её не теряли"""
+    async with pool.acquire() as conn:
+        await conn.execute(
+            "UPDATE broadcast_jobs SET payload = jsonb_set(payload, '{reply_markup}', COALESCE($2::jsonb, 'null')) WHERE id = $1",
+            job_id, reply_markup
+        )
+
+
+async def mark_broadcast_job_recalled(pool: asyncpg.Pool, job_id: int) -> None:
+    async with pool.acquire() as conn:
+        await conn.execute("UPDATE broadcast_jobs SET recalled_at = now() WHERE id = $1", job_id)
+
+
+async def get_broadcast_delivery_stats(pool: asyncpg.Pool, job_id: int) -> Dict[str, Any]:
+    """Итоги рассылки по журналу доставок (в том числе до рестарта бота)"""
+    async with pool.acquire() as conn:
+        row = await conn.fetchrow(
+            """
+            SELECT
+                COUNT(*) AS total,
+                COUNT(*) FILTER (WHERE status = 'sent') AS sent,
+                COUNT(*) FILTER (WHERE status = 'failed') AS failed,
+                COUNT(*) FILTER (WHERE status = 'blocked') AS blocked,
+                EXTRACT(EPOCH FROM MAX(sent_at) - MIN(sent_at))::float AS seconds
+            FROM broadcast_deliveries
+            WHERE job_id = $1
+            """,
+            job_id
+        )
+        stats = dict(row)
+        seconds = stats["seconds"] or 0
+        stats["rate"] = stats["total"] / seconds if seconds > 0 else 0.0
+        return stats
+
+
+async def finish_broadcast_job(pool: asyncpg.Pool, job_id: int, status: str = "done") -> None:
+    async with pool.acquire() as conn:
+        await conn.execute(
+            "UPDATE broadcast_jobs SET status = $2, finished_at = now() WHERE id = $1",
+            job_id, status
+        )
+
+
+async def get_broadcast_job_counts(pool: asyncpg.Pool, job_id: int) -> Dict[str, int]:
+    """Количество получателей рассылки по статусам"""
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(
+            "SELECT status, COUNT(*) FROM broadcast_recipients WHERE job_id = $1 GROUP BY status",
+            job_id
+        )
+        return {r[0]: r[1] for r in rows}
@@ -1,11 +1,11 @@
-import os
 from dotenv import load_dotenv
-import asyncpg
 from typing import Optional, Dict, Any, List
 
 # Загружаем переменные окружения из .env файла
 load_dotenv()
 
+import pg_pool  # после load_dotenv: настройки пула читаются из окружения при импорте
+
 class Database:
     _pool = None
     
@@ -13,13 +13,7 @@ class Database:
     async def get_pool(cls):
         """Создает и возвращает пул подключений к базе данных"""
         if cls._pool is None:
-            cls._pool = await asyncpg.create_pool(
-                host=os.getenv("DB_HOST", "localhost"),
-                port=int(os.getenv("DB_PORT", "5432")),
-                database=os.getenv("DB_NAME", "EuphoriaDB"),
-                user=os.getenv("DB_USER", "postgres"),
-                password=os.getenv("DB_PASSWORD", "1")
-            )
+            cls._pool = await pg_pool.create_pool(name="db_config")
         return cls._pool
     
     @classmethod
@@ -0,0 +1,159 @@
+"""
+Экспорт пользователей в Excel без загрузки всей таблицы в память.
+
+Строки читаются из БД серверным курсором пачками и пишутся в книгу
+openpyxl в режиме write-only в отдельном потоке: пока поток пишет одну
+пачку, из БД уже читается следующая, а event loop бота остаётся свободен.
+Ширину колонок write-only лист должен знать до первой строки, поэтому
+она считается по заголовкам и первым EXPORT_WIDTH_SAMPLE строкам.
+"""
+
+import os
+import asyncio
+import tempfile
+import logging
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Sequence
+
+import asyncpg
+
+from db import get_user_stats
+
+logger = logging.getLogger("TusaBot")
+
+EXPORT_BATCH = int(os.getenv("EXPORT_BATCH", "2000"))
+EXPORT_WIDTH_SAMPLE = 1000
+EXPORT_MAX_WIDTH = 50
+
+USER_HEADERS = ["Telegram ID", "Имя", "Пол", "Возраст", "Дата регистрации", "Дата создания"]
+GENDER_NAMES = {"male": "Мужской", "female": "Женский"}
+NOT_SET = "Не указано"
+
+
+def _format_date(value: Optional[datetime]) -> str:
+    return value.strftime("%d.%m.%Y %H:%M") if value else NOT_SET
+
+
+def format_user_row(user: asyncpg.Record) -> List[Any]:
+    """Строка листа «Пользователи» в том виде, в каком её видит админ"""
+    return [
+        user['tg_id'],
+        user['name'] or NOT_SET,
+        GENDER_NAMES.get(user['gender'], NOT_SET),
+        f"{user['age']} лет" if user['age'] else NOT_SET,
+        _format_date(user['registered_at']),
+        _format_date(user['created_at']),
+    ]
+
+
+class UsersWorkbookWriter:
+    """Книга в режиме write-only; все методы вызываются из рабочего потока"""
+
+    def __init__(self):
+        from openpyxl import Workbook
+        from openpyxl.styles import Font, PatternFill, Alignment
+
+        self.wb = Workbook(write_only=True)
+        self.ws = self.wb.create_sheet("Пользователи TusaBot")
+        self.header_font = Font(bold=True, color="FFFFFF")
+        self.header_fill = PatternFill(start_color="366092", end_color="366092", fill_type="solid")
+        self.header_alignment = Alignment(horizontal="center", vertical="center")
+        # Первые строки копятся, пока по ним не станет известна ширина колонок
+        self._sample: Optional[List[List[Any]]] = []
+        self.rows = 0
+
+    def _header(self, ws, values: Sequence[str]) -> list:
+        from openpyxl.cell import WriteOnlyCell
+
+        cells = []
+        for value in values:
+            cell = WriteOnlyCell(ws, value=value)
+            cell.font = self.header_font
+            cell.fill = self.header_fill
+            cell.alignment = self.header_alignment
+            cells.append(cell)
+        return cells
+
+    @staticmethod
+    def _set_widths(ws, rows: Sequence[Sequence[Any]], max_width: Optional[int] = EXPORT_MAX_WIDTH) -> None:
+        from openpyxl.utils import get_column_letter
+
+        widths: Dict[int, int] = {}
+        for row in rows:
+            for col, value in enumerate(row, 1):
+                widths[col] = max(widths.get(col, 0), len(str(value)))
+        for col, width in widths.items():
+            width += 2
+            ws.column_dimensions[get_column_letter(col)].width = min(width, max_width) if max_width else width
+
+    def _start(self) -> None:
+        self._set_widths(self.ws, [USER_HEADERS, *self._sample])
+        self.ws.append(self._header(self.ws, USER_HEADERS))
+        for row in self._sample:
+            self.ws.append(row)
+        self._sample = None
+
+    def write_users(self, users: Sequence[asyncpg.Record]) -> None:
+        for user in users:
+            row = format_user_row(user)
+            self.rows += 1
+            if self._sample is None:
+                self.ws.append(row)
+                continue
+            self._sample.append(row)
+            if len(self._sample) >= EXPORT_WIDTH_SAMPLE:
+                self._start()
+
+    def finish(self, stats: Dict[str, Any], filename: str) -> None:
+        if self._sample is not None:
+            self._start()
+        stats_ws = self.wb.create_sheet("Статистика")
+        stats_data = [
+            ["Всего пользователей", stats.get('total_users', 0)],
+            ["С привязанным VK", stats.get('users_with_vk', 0)],
+            ["Мужчин", stats.get('male_users', 0)],
+            ["Женщин", stats.get('female_users', 0)],
+            ["Зарегистрировано сегодня", stats.get('today_registrations', 0)],
+            ["Дата экспорта", datetime.now().strftime("%d.%m.%Y %H:%M")],
+        ]
+        headers = ["Показатель", "Значение"]
+        self._set_widths(stats_ws, [headers, *stats_data], max_width=None)
+        stats_ws.append(self._header(stats_ws, headers))
+        for row in stats_data:
+            stats_ws.append(row)
+        self.wb.save(filename)
+
+
+async def export_users_to_excel(pool: asyncpg.Pool, filename: Optional[str] = None) -> str:
+    """Экспорт всех пользователей в Excel файл; без filename — во временный файл"""
+    if filename is None:
+        fd, filename = tempfile.mkstemp(prefix="users_export_", suffix=".xlsx")
+        os.close(fd)
+    try:
+        writer = await asyncio.to_thread(UsersWorkbookWriter)
+        async with pool.acquire() as conn:
+            async with conn.transaction():
+                cursor = await conn.cursor(
+                    """
+                    SELECT tg_id, name, gender, age, registered_at, created_at
+                    FROM users
+                    ORDER BY registered_at DESC
+                    """
+                )
+                batch = await cursor.fetch(EXPORT_BATCH)
+                while batch:
+                    writing = asyncio.ensure_future(asyncio.to_thread(writer.write_users, batch))
+                    try:
+                        batch = await cursor.fetch(EXPORT_BATCH)
+                    finally:
+                        await writing
+        stats = await get_user_stats(pool)
+        await asyncio.to_thread(writer.finish, stats, filename)
+        logger.info("Exported %d users to %s", writer.rows, filename)
+        return filename
+    except Exception as e:
+        try:
+            os.remove(filename)
+        except OSError:
+            pass
+        raise Exception(f"Ошибка экспорта в Excel: {e}")
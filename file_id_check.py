@@ -0,0 +1,105 @@
+"""
+Проверка Telegram file_id афиш и Stories.
+
+file_id со временем может перестать работать (бот пересоздан, файл
+удалён на стороне Telegram). Раньше это выяснялось только при показе
+афиши: неудачный send_photo, потом загрузка файла с диска. Теперь раз в
+FILE_ID_CHECK_INTERVAL секунд каждый file_id проверяется через getFile.
+Нерабочий помечается в БД (file_id_broken_at), а если у афиши есть
+локальная копия, фото один раз перезаливается в служебный чат и в БД
+записывается свежий file_id. Каталог афиш подхватит его по NOTIFY.
+"""
+
+import os
+import asyncio
+import logging
+from pathlib import Path
+from typing import Dict, Optional
+
+import asyncpg
+from telegram import Bot
+from telegram.error import BadRequest, TelegramError
+
+from db import get_file_id_targets, set_file_ids_broken, replace_file_id
+
+logger = logging.getLogger("TusaBot")
+
+FILE_ID_CHECK_INTERVAL = float(os.getenv("FILE_ID_CHECK_INTERVAL", "21600"))
+# Пауза между запросами getFile, чтобы не упираться в лимиты Bot API
+FILE_ID_CHECK_DELAY = float(os.getenv("FILE_ID_CHECK_DELAY_MS", "100")) / 1000
+# Чат, куда перезаливаются фото ради нового file_id (сообщение сразу удаляется)
+FILE_ID_UPLOAD_CHAT_ID = int(os.getenv("FILE_ID_UPLOAD_CHAT_ID", "0")) or None
+
+PUBLIC_DIR = Path(__file__).parent / "project" / "public"
+
+
+def is_local_file(file_id: Optional[str]) -> bool:
+    """Путь к файлу (/posters/..., /uploads/...) вместо Telegram file_id"""
+    return bool(file_id) and (file_id.startswith('/') or file_id.startswith('posters/') or file_id.startswith('uploads/'))
+
+
+def local_photo(photo_path: Optional[str]) -> Optional[Path]:
+    """Локальная копия фото афиши, если она есть на диске"""
+    if not photo_path:
+        return None
+    path = PUBLIC_DIR / photo_path.lstrip("/")
+    return path if path.is_file() else None
+
+
+async def is_file_id_valid(bot: Bot, file_id: str) -> Optional[bool]:
+    """True/False — ответ Telegram; None — проверить не удалось (сеть, лимиты)"""
+    try:
+        await bot.get_file(file_id)
+        return True
+    except BadRequest as e:
+        logger.info("file_id rejected by Telegram (%s): %s", e, file_id)
+        return False
+    except TelegramError as e:
+        logger.warning("Failed to check file_id %s: %s", file_id, e)
+        return None
+
+
+async def reupload_photo(bot: Bot, chat_id: int, path: Path) -> str:
+    """Загрузить фото с диска в служебный чат и вернуть новый file_id"""
+    with open(path, "rb") as photo:
+        message = await bot.send_photo(chat_id, photo=photo, disable_notification=True)
+    try:
+        await message.delete()
+    except TelegramError:
+        pass
+    return message.photo[-1].file_id
+
+
+async def check_file_ids(bot: Bot, pool: asyncpg.Pool, upload_chat_id: Optional[int]) -> Dict[str, int]:
+    """Проверить все активные file_id; возвращает счётчики checked/broken/reuploaded"""
+    summary = {"checked": 0, "broken": 0, "reuploaded": 0}
+    broken: Dict[str, list] = {kind: [] for kind in ("poster", "story")}
+    ok: Dict[str, list] = {kind: [] for kind in ("poster", "story")}
+    for row in await get_file_id_targets(pool):
+        kind, item_id, file_id = row['kind'], row['id'], row['file_id']
+        if is_local_file(file_id):
+            continue
+        valid = await is_file_id_valid(bot, file_id)
+        await asyncio.sleep(FILE_ID_CHECK_DELAY)
+        if valid is None:
+            continue
+        summary["checked"] += 1
+        if valid:
+            ok[kind].append(item_id)
+            continue
+        path = local_photo(row['photo_path'])
+        if path and upload_chat_id:
+            try:
+                new_file_id = await reupload_photo(bot, upload_chat_id, path)
+                if await replace_file_id(pool, kind, item_id, file_id, new_file_id):
+                    summary["reuploaded"] += 1
+                    logger.info("Re-uploaded %s %s from %s", kind, item_id, path)
+                continue
+            except TelegramError as e:
+                logger.warning("Failed to re-upload %s %s from %s: %s", kind, item_id, path, e)
+        broken[kind].append(item_id)
+        summary["broken"] += 1
+    for kind in broken:
+        if broken[kind] or ok[kind]:
+            await set_file_ids_broken(pool, kind, broken[kind], ok[kind])
+    return summary
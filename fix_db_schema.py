@@ -3,6 +3,8 @@ import asyncpg
 from dotenv import load_dotenv
 import os
 
+from migrate import migrate_connection
+
 async def fix_database_schema():
     load_dotenv()
     
@@ -18,67 +20,10 @@ async def fix_database_schema():
         print("🔧 Проверка и обновление структуры базы данных...")
         conn = await asyncpg.connect(**db_config)
         
-        # Создаем таблицы, если они не существуют
-        await conn.execute('''
-        CREATE TABLE IF NOT EXISTS users (
-            tg_id BIGINT PRIMARY KEY,
-            name TEXT,
-            gender TEXT CHECK (gender IN ('male', 'female')),
-            age INTEGER CHECK (age >= 14 AND age <= 100),
-            vk_id TEXT,
-            username TEXT,
-            registered_at TIMESTAMPTZ DEFAULT now(),
-            created_at TIMESTAMPTZ DEFAULT now(),
-            updated_at TIMESTAMPTZ DEFAULT now()
-        );
-        
-        CREATE TABLE IF NOT EXISTS posters (
-            id SERIAL PRIMARY KEY,
-            title TEXT NOT NULL,
-            description TEXT,
-            event_date TIMESTAMPTZ,
-            location TEXT,
-            image_url TEXT,
-            ticket_url TEXT,
-            created_at TIMESTAMPTZ DEFAULT now(),
-            updated_at TIMESTAMPTZ DEFAULT now()
-        );
-        
-        CREATE TABLE IF NOT EXISTS attendances (
-            id SERIAL PRIMARY KEY,
-            user_id BIGINT REFERENCES users(tg_id) ON DELETE CASCADE,
-            poster_id INTEGER REFERENCES posters(id) ON DELETE CASCADE,
-            status TEXT DEFAULT 'registered',
-            created_at TIMESTAMPTZ DEFAULT now(),
-            updated_at TIMESTAMPTZ DEFAULT now(),
-            UNIQUE(user_id, poster_id)
-        );
-        
-        -- Создаем функцию для автоматического обновления updated_at
-        CREATE OR REPLACE FUNCTION update_updated_at_column()
-        RETURNS TRIGGER AS $$
-        BEGIN
-            NEW.updated_at = now();
-            RETURN NEW;
-        END;
-        $$ LANGUAGE plpgsql;
-        
-        -- Создаем триггеры для автоматического обновления updated_at
-        DROP TRIGGER IF EXISTS update_users_updated_at ON users;
-        CREATE TRIGGER update_users_updated_at
-        BEFORE UPDATE ON users
-        FOR EACH ROW EXECUTE FUNCTION update_updated_at_column();
-        
-        DROP TRIGGER IF EXISTS update_posters_updated_at ON posters;
-        CREATE TRIGGER update_posters_updated_at
-        BEFORE UPDATE ON posters
-        FOR EACH ROW EXECUTE FUNCTION update_updated_at_column();
-        
-        DROP TRIGGER IF EXISTS update_attendances_updated_at ON attendances;
-        CREATE TRIGGER update_attendances_updated_at
-        BEFORE UPDATE ON attendances
-        FOR EACH ROW EXECUTE FUNCTION update_updated_at_column();
-        ''')
+        # Вся схема описана в migrations/*.sql, применяем только новые миграции
+        applied = await migrate_connection(conn)
+        if applied:
+            print("Применены миграции: " + ", ".join(applied))
         
         print("✅ Структура базы данных успешно обновлена!")
         
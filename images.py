@@ -0,0 +1,145 @@
+"""
+Уменьшенные копии загруженных фото афиш и Stories.
+
+Из оригинала строятся варианты thumb/card/full по ширине, каждый в WebP
+и прогрессивном JPEG, без EXIF (поворот из EXIF применяется к пикселям).
+Pillow работает в отдельных процессах: сжатие нагружает CPU и в потоке
+всё равно держало бы GIL, а event loop бота и API должен оставаться
+свободным. Пути вариантов записываются в media_variants по ключу
+source — веб-пути оригинала (/posters/..., /uploads/stories/...).
+"""
+
+import os
+import asyncio
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Any, Dict, Iterable, List, Mapping, Optional
+
+import asyncpg
+
+from db import save_media_variants
+
+logger = logging.getLogger("TusaBot")
+
+# Ширина вариантов в пикселях; меньшие оригиналы не увеличиваются
+IMAGE_VARIANTS = {"thumb": 320, "card": 720, "full": 1280}
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", "2"))
+IMAGE_WEBP_QUALITY = int(os.getenv("IMAGE_WEBP_QUALITY", "80"))
+IMAGE_JPEG_QUALITY = int(os.getenv("IMAGE_JPEG_QUALITY", "82"))
+
+_executor: Optional[ProcessPoolExecutor] = None
+
+
+@dataclass(frozen=True)
+class Variant:
+    variant: str
+    format: str
+    path: str
+    width: int
+    height: int
+    bytes: int
+
+
+def render_variants(src_file: str, web_dir: str) -> List[Variant]:
+    """Построить варианты рядом с оригиналом (выполняется в процессе пула)"""
+    from PIL import Image, ImageOps
+
+    src = Path(src_file)
+    variants = []
+    with Image.open(src) as original:
+        image = ImageOps.exif_transpose(original)
+        if image.mode in ("RGBA", "LA", "P"):
+            # У JPEG нет прозрачности: кладём на белый фон
+            image = image.convert("RGBA")
+            background = Image.new("RGB", image.size, (255, 255, 255))
+            background.paste(image, mask=image.getchannel("A"))
+            image = background
+        elif image.mode != "RGB":
+            image = image.convert("RGB")
+        for name, width in IMAGE_VARIANTS.items():
+            resized = image.copy()
+            resized.thumbnail((width, width * 10), Image.LANCZOS)
+            for fmt, ext, options in (
+                ("webp", "webp", {"quality": IMAGE_WEBP_QUALITY, "method": 6}),
+                ("jpeg", "jpg", {"quality": IMAGE_JPEG_QUALITY, "progressive": True, "optimize": True}),
+            ):
+                filename = f"{src.stem}_{name}.{ext}"
+                target = src.with_name(filename)
+                # EXIF не передаётся: Pillow пишет метаданные только если их указать явно
+                resized.save(target, fmt.upper(), **options)
+                variants.append(Variant(
+                    name, fmt, f"{web_dir}/{filename}", resized.width, resized.height, target.stat().st_size,
+                ))
+    return variants
+
+
+def _get_executor() -> ProcessPoolExecutor:
+    global _executor
+    if _executor is None:
+        # spawn: дочерний процесс не наследует event loop и соединения родителя
+        _executor = ProcessPoolExecutor(
+            max_workers=IMAGE_WORKERS, mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _executor
+
+
+async def make_variants(src_file: Path, web_dir: str) -> List[Variant]:
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(_get_executor(), render_variants, str(src_file), web_dir)
+    except BrokenProcessPool:
+        # Процесс упал (например, по памяти на огромном файле) — следующий вызов создаст пул заново
+        shutdown()
+        raise
+
+
+async def process_upload(pool: Optional[asyncpg.Pool], source: str, src_file: Path, web_dir: str) -> List[Variant]:
+    """Построить варианты и записать их в БД.
+
+    Ошибки только логируются: оригинал остаётся рабочим и без вариантов.
+    """
+    try:
+        variants = await make_variants(src_file, web_dir)
+        if pool:
+            await save_media_variants(pool, source, variants)
+        logger.info(
+            "Image variants for %s: %d files, %d KB (original %d KB)",
+            source, len(variants), sum(v.bytes for v in variants) // 1024, src_file.stat().st_size // 1024,
+        )
+        return variants
+    except Exception as e:
+        logger.warning("Failed to build image variants for %s: %s", source, e)
+        return []
+
+
+def pick_variant(
+    variants: Optional[Iterable[Mapping[str, Any]]], width: int = IMAGE_VARIANTS["card"], fmt: str = "webp"
+) -> Optional[str]:
+    """Путь самого лёгкого варианта не уже width (или самого широкого, если все уже)"""
+    candidates = [v for v in variants or () if v["format"] == fmt]
+    if not candidates:
+        return None
+    wide_enough = [v for v in candidates if v["width"] >= width]
+    if wide_enough:
+        return min(wide_enough, key=lambda v: v["bytes"])["path"]
+    return max(candidates, key=lambda v: v["width"])["path"]
+
+
+def variants_json(variants: Optional[Iterable[Mapping[str, Any]]]) -> Dict[str, Dict[str, Any]]:
+    """Варианты для веб-приложения: {"card": {"webp": путь, "jpeg": путь, "width": .., "height": ..}}"""
+    result: Dict[str, Dict[str, Any]] = {}
+    for v in variants or ():
+        entry = result.setdefault(v["variant"], {"width": v["width"], "height": v["height"]})
+        entry[v["format"]] = v["path"]
+    return result
+
+
+def shutdown() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
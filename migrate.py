@@ -0,0 +1,104 @@
+"""
+Применение миграций схемы БД из migrations/*.sql.
+
+Применённые версии хранятся в таблице schema_migrations, поэтому каждая
+миграция выполняется один раз. При старте бота, если новых файлов нет,
+это один SELECT без DDL и без блокировок рабочих таблиц.
+
+Запуск вручную:
+    python migrate.py           - применить новые миграции
+    python migrate.py --status  - показать применённые и ожидающие
+"""
+
+import sys
+import asyncio
+import logging
+from pathlib import Path
+
+import asyncpg
+
+logger = logging.getLogger("TusaBot")
+
+MIGRATIONS_DIR = Path(__file__).parent / "migrations"
+# Ключ advisory lock: бот и API могут стартовать одновременно
+MIGRATIONS_LOCK_KEY = 7_245_001
+
+
+def list_migrations() -> list[tuple[str, Path]]:
+    """Файлы миграций по порядку: версия — имя файла без .sql (например, 004_bot_schema)"""
+    return [(path.stem, path) for path in sorted(MIGRATIONS_DIR.glob("*.sql"))]
+
+
+async def get_applied_versions(conn: asyncpg.Connection) -> set[str]:
+    try:
+        rows = await conn.fetch("SELECT version FROM schema_migrations")
+    except asyncpg.UndefinedTableError:
+        return set()
+    return {r[0] for r in rows}
+
+
+async def apply_migrations(pool: asyncpg.Pool) -> list[str]:
+    """Применить ещё не применённые миграции. Возвращает список применённых версий"""
+    async with pool.acquire() as conn:
+        return await migrate_connection(conn)
+
+
+async def migrate_connection(conn: asyncpg.Connection) -> list[str]:
+    """То же, что apply_migrations, на отдельном соединении (для скриптов)"""
+    migrations = list_migrations()
+    applied = await get_applied_versions(conn)
+    if all(version in applied for version, _ in migrations):
+        return []
+
+    await conn.execute("SELECT pg_advisory_lock($1)", MIGRATIONS_LOCK_KEY)
+    try:
+        await conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version TEXT PRIMARY KEY,
+                applied_at TIMESTAMPTZ NOT NULL DEFAULT now()
+            );
+            """
+        )
+        # Пока ждали блокировку, миграции мог применить другой процесс
+        applied = await get_applied_versions(conn)
+        done = []
+        for version, path in migrations:
+            if version in applied:
+                continue
+            logger.info("Applying migration %s", version)
+            async with conn.transaction():
+                await conn.execute(path.read_text(encoding="utf-8"))
+                await conn.execute("INSERT INTO schema_migrations (version) VALUES ($1)", version)
+            done.append(version)
+        return done
+    finally:
+        await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATIONS_LOCK_KEY)
+
+
+async def main(argv: list[str]) -> None:
+    from db import create_pool
+
+    pool = await create_pool()
+    try:
+        if "--status" in argv:
+            async with pool.acquire() as conn:
+                applied = await get_applied_versions(conn)
+            for version, _ in list_migrations():
+                print(f"{'✅' if version in applied else '⏳'} {version}")
+            return
+        done = await apply_migrations(pool)
+        if done:
+            print("✅ Применены миграции: " + ", ".join(done))
+        else:
+            print("✅ Схема БД актуальна, новых миграций нет")
+    finally:
+        await pool.close()
+
+
+if __name__ == "__main__":
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(main(sys.argv[1:]))
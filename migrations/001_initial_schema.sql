@@ -45,5 +45,11 @@ BEFORE UPDATE ON users
 FOR EACH ROW 
 EXECUTE FUNCTION update_updated_at_column();
 
-GRANT ALL PRIVILEGES ON ALL TABLES IN SCHEMA public TO tusabot;
-GRANT ALL PRIVILEGES ON ALL SEQUENCES IN SCHEMA public TO tusabot;
\ No newline at end of file
+-- Права для пользователя бота, если он заведён отдельно от владельца схемы
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_roles WHERE rolname = 'tusabot') THEN
+        GRANT ALL PRIVILEGES ON ALL TABLES IN SCHEMA public TO tusabot;
+        GRANT ALL PRIVILEGES ON ALL SEQUENCES IN SCHEMA public TO tusabot;
+    END IF;
+END $$;
@@ -0,0 +1,67 @@
+-- Миграция: Схема, которую раньше создавал db.init_schema при каждом старте
+-- Дата: 2026-10-18
+-- Все изменения идемпотентны: базы, созданные старым init_schema, проходят миграцию без ошибок
+
+-- Пользователи: username и отметка о блокировке бота
+ALTER TABLE users
+ADD COLUMN IF NOT EXISTS username TEXT;
+
+ALTER TABLE users
+ADD COLUMN IF NOT EXISTS blocked_at TIMESTAMPTZ;
+
+-- Индексы
+CREATE INDEX IF NOT EXISTS idx_posters_is_active ON posters(is_active);
+CREATE INDEX IF NOT EXISTS idx_attendances_user_id ON attendances(user_id);
+CREATE INDEX IF NOT EXISTS idx_attendances_poster_id ON attendances(poster_id);
+
+-- Задания рассылок и их получатели (для продолжения после рестарта)
+CREATE TABLE IF NOT EXISTS broadcast_jobs (
+    id SERIAL PRIMARY KEY,
+    kind TEXT NOT NULL,
+    payload JSONB NOT NULL,
+    status TEXT NOT NULL DEFAULT 'running' CHECK (status IN ('running', 'done', 'cancelled')),
+    created_by BIGINT,
+    created_at TIMESTAMPTZ DEFAULT now(),
+    finished_at TIMESTAMPTZ
+);
+
+ALTER TABLE broadcast_jobs DROP CONSTRAINT IF EXISTS broadcast_jobs_kind_check;
+ALTER TABLE broadcast_jobs ADD CONSTRAINT broadcast_jobs_kind_check
+    CHECK (kind IN ('text', 'photo', 'copy'));
+
+-- Отметка об отзыве рассылки (сообщения удалены у получателей)
+ALTER TABLE broadcast_jobs
+ADD COLUMN IF NOT EXISTS recalled_at TIMESTAMPTZ;
+
+CREATE TABLE IF NOT EXISTS broadcast_recipients (
+    job_id INTEGER REFERENCES broadcast_jobs(id) ON DELETE CASCADE,
+    user_id BIGINT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending' CHECK (status IN ('pending', 'sent', 'failed', 'blocked')),
+    PRIMARY KEY (job_id, user_id)
+);
+
+-- Журнал доставок рассылок: кому, с каким исходом и какое сообщение ушло
+CREATE TABLE IF NOT EXISTS broadcast_deliveries (
+    job_id INTEGER NOT NULL REFERENCES broadcast_jobs(id) ON DELETE CASCADE,
+    user_id BIGINT NOT NULL,
+    status TEXT NOT NULL CHECK (status IN ('sent', 'failed', 'blocked')),
+    message_id BIGINT,
+    error TEXT,
+    sent_at TIMESTAMPTZ NOT NULL DEFAULT now()
+);
+
+CREATE INDEX IF NOT EXISTS idx_broadcast_deliveries_job ON broadcast_deliveries(job_id, user_id);
+CREATE INDEX IF NOT EXISTS idx_broadcast_jobs_running ON broadcast_jobs(status) WHERE status = 'running';
+CREATE INDEX IF NOT EXISTS idx_broadcast_recipients_pending ON broadcast_recipients(job_id) WHERE status = 'pending';
+
+-- Серии пропущенных недель для напоминаний «возвращайся»
+CREATE TABLE IF NOT EXISTS user_streaks (
+    user_id BIGINT PRIMARY KEY REFERENCES users(tg_id) ON DELETE CASCADE,
+    missed_in_row SMALLINT NOT NULL DEFAULT 0,
+    last_attended_week DATE,
+    computed_week DATE NOT NULL
+);
+
+-- Комментарии
+COMMENT ON TABLE broadcast_deliveries IS 'Журнал доставок рассылок с ID отправленных сообщений';
+COMMENT ON TABLE user_streaks IS 'Серии пропущенных недель пользователей';
@@ -0,0 +1,183 @@
+-- Миграция: Счётчики статистики, которые ведут триггеры
+-- Дата: 2026-10-18
+-- Панель админа и /stats в API читают готовые числа по ключу вместо COUNT(*) по всей таблице.
+-- Триггеры уровня оператора: пачка из registration_buffer обновляет каждый счётчик один раз.
+
+CREATE TABLE IF NOT EXISTS stats_counters (
+    name TEXT PRIMARY KEY,
+    value BIGINT NOT NULL DEFAULT 0
+);
+
+-- Счётчики по дням (регистрации за сегодня); день — по часовому поясу сессии, как и CURRENT_DATE
+CREATE TABLE IF NOT EXISTS stats_daily (
+    name TEXT NOT NULL,
+    day DATE NOT NULL,
+    value BIGINT NOT NULL DEFAULT 0,
+    PRIMARY KEY (name, day)
+);
+
+-- Применить изменения пользователей: sign = +1 для новой версии строки, -1 для старой
+CREATE OR REPLACE FUNCTION stats_apply_user_changes(
+    signs INTEGER[], genders TEXT[], vk_flags BOOLEAN[], days DATE[]
+) RETURNS VOID AS $$
+    WITH changes AS (
+        SELECT * FROM unnest(signs, genders, vk_flags, days) AS c(sign, gender, with_vk, day)
+    ),
+    deltas AS (
+        SELECT 'users_total' AS name, sum(sign) AS delta FROM changes
+        UNION ALL SELECT 'users_male', sum(sign) FILTER (WHERE gender = 'male') FROM changes
+        UNION ALL SELECT 'users_female', sum(sign) FILTER (WHERE gender = 'female') FROM changes
+        UNION ALL SELECT 'users_with_vk', sum(sign) FILTER (WHERE with_vk) FROM changes
+    ),
+    counters AS (
+        -- Порядок по имени: параллельные пачки блокируют строки в одном порядке
+        INSERT INTO stats_counters AS s (name, value)
+        SELECT name, delta FROM deltas WHERE delta <> 0 ORDER BY name
+        ON CONFLICT (name) DO UPDATE SET value = s.value + EXCLUDED.value
+    )
+    INSERT INTO stats_daily AS s (name, day, value)
+    SELECT 'registrations', day, sum(sign) FROM changes
+    WHERE day IS NOT NULL
+    GROUP BY day HAVING sum(sign) <> 0
+    ORDER BY day
+    ON CONFLICT (name, day) DO UPDATE SET value = s.value + EXCLUDED.value;
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION stats_users_inserted() RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM stats_apply_user_changes(
+        array_agg(1), array_agg(gender), array_agg(vk_id IS NOT NULL), array_agg(registered_at::date)
+    ) FROM new_rows;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION stats_users_updated() RETURNS TRIGGER AS $$
+BEGIN
+    -- Строки, где нужные поля не менялись, дают +1 и -1 и взаимно сокращаются
+    PERFORM stats_apply_user_changes(
+        array_agg(sign), array_agg(gender), array_agg(with_vk), array_agg(day)
+    ) FROM (
+        SELECT 1 AS sign, gender, vk_id IS NOT NULL AS with_vk, registered_at::date AS day FROM new_rows
+        UNION ALL
+        SELECT -1, gender, vk_id IS NOT NULL, registered_at::date FROM old_rows
+    ) changes;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION stats_users_deleted() RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM stats_apply_user_changes(
+        array_agg(-1), array_agg(gender), array_agg(vk_id IS NOT NULL), array_agg(registered_at::date)
+    ) FROM old_rows;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION stats_users_truncated() RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE stats_counters SET value = 0 WHERE name LIKE 'users\_%';
+    DELETE FROM stats_daily WHERE name = 'registrations';
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Афиши: всего и активных
+CREATE OR REPLACE FUNCTION stats_apply_poster_changes(signs INTEGER[], active_flags BOOLEAN[]) RETURNS VOID AS $$
+    WITH changes AS (
+        SELECT * FROM unnest(signs, active_flags) AS c(sign, active)
+    ),
+    deltas AS (
+        SELECT 'posters_active' AS name, sum(sign) FILTER (WHERE active) AS delta FROM changes
+        UNION ALL SELECT 'posters_total', sum(sign) FROM changes
+    )
+    INSERT INTO stats_counters AS s (name, value)
+    SELECT name, delta FROM deltas WHERE delta <> 0 ORDER BY name
+    ON CONFLICT (name) DO UPDATE SET value = s.value + EXCLUDED.value;
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION stats_posters_inserted() RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM stats_apply_poster_changes(array_agg(1), array_agg(is_active IS TRUE)) FROM new_rows;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION stats_posters_updated() RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM stats_apply_poster_changes(array_agg(sign), array_agg(active)) FROM (
+        SELECT 1 AS sign, is_active IS TRUE AS active FROM new_rows
+        UNION ALL
+        SELECT -1, is_active IS TRUE FROM old_rows
+    ) changes;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION stats_posters_deleted() RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM stats_apply_poster_changes(array_agg(-1), array_agg(is_active IS TRUE)) FROM old_rows;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION stats_posters_truncated() RETURNS TRIGGER AS $$
+BEGIN
+    UPDATE stats_counters SET value = 0 WHERE name LIKE 'posters\_%';
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Начальные значения считаются под блокировкой, чтобы не потерять записи между подсчётом и триггерами
+LOCK TABLE users, posters IN SHARE ROW EXCLUSIVE MODE;
+
+DROP TRIGGER IF EXISTS stats_users_insert ON users;
+DROP TRIGGER IF EXISTS stats_users_update ON users;
+DROP TRIGGER IF EXISTS stats_users_delete ON users;
+DROP TRIGGER IF EXISTS stats_users_truncate ON users;
+CREATE TRIGGER stats_users_insert AFTER INSERT ON users
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION stats_users_inserted();
+CREATE TRIGGER stats_users_update AFTER UPDATE ON users
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION stats_users_updated();
+CREATE TRIGGER stats_users_delete AFTER DELETE ON users
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION stats_users_deleted();
+CREATE TRIGGER stats_users_truncate AFTER TRUNCATE ON users
+    FOR EACH STATEMENT EXECUTE FUNCTION stats_users_truncated();
+
+DROP TRIGGER IF EXISTS stats_posters_insert ON posters;
+DROP TRIGGER IF EXISTS stats_posters_update ON posters;
+DROP TRIGGER IF EXISTS stats_posters_delete ON posters;
+DROP TRIGGER IF EXISTS stats_posters_truncate ON posters;
+CREATE TRIGGER stats_posters_insert AFTER INSERT ON posters
+    REFERENCING NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION stats_posters_inserted();
+CREATE TRIGGER stats_posters_update AFTER UPDATE ON posters
+    REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows FOR EACH STATEMENT EXECUTE FUNCTION stats_posters_updated();
+CREATE TRIGGER stats_posters_delete AFTER DELETE ON posters
+    REFERENCING OLD TABLE AS old_rows FOR EACH STATEMENT EXECUTE FUNCTION stats_posters_deleted();
+CREATE TRIGGER stats_posters_truncate AFTER TRUNCATE ON posters
+    FOR EACH STATEMENT EXECUTE FUNCTION stats_posters_truncated();
+
+DELETE FROM stats_counters WHERE name LIKE 'users\_%' OR name LIKE 'posters\_%';
+DELETE FROM stats_daily WHERE name = 'registrations';
+
+INSERT INTO stats_counters (name, value)
+SELECT unnest(ARRAY['users_total', 'users_male', 'users_female', 'users_with_vk']),
+       unnest(ARRAY[
+           COUNT(*),
+           COUNT(*) FILTER (WHERE gender = 'male'),
+           COUNT(*) FILTER (WHERE gender = 'female'),
+           COUNT(vk_id)
+       ])
+FROM users;
+
+INSERT INTO stats_counters (name, value)
+SELECT unnest(ARRAY['posters_total', 'posters_active']),
+       unnest(ARRAY[COUNT(*), COUNT(*) FILTER (WHERE is_active IS TRUE)])
+FROM posters;
+
+INSERT INTO stats_daily (name, day, value)
+SELECT 'registrations', registered_at::date, COUNT(*)
+FROM users
+WHERE registered_at IS NOT NULL
+GROUP BY registered_at::date;
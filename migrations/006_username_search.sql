@@ -0,0 +1,10 @@
+-- Миграция: Индексы для поиска пользователей админом
+-- Дата: 2026-10-18
+-- LOWER(username) — точный поиск без полного прохода по users,
+-- триграммы (pg_trgm) — подсказки «возможно, вы имели в виду» при опечатках.
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX IF NOT EXISTS idx_users_username_lower ON users (LOWER(username));
+CREATE INDEX IF NOT EXISTS idx_users_username_trgm ON users USING gin (LOWER(username) gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_users_name_trgm ON users USING gin (LOWER(name) gin_trgm_ops);
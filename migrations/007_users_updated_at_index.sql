@@ -0,0 +1,5 @@
+-- Миграция: Индекс для инкрементальной синхронизации roster.py
+-- Дата: 2026-10-18
+-- Бот раз в ROSTER_SYNC_INTERVAL секунд забирает пользователей, изменённых после прошлой синхронизации.
+
+CREATE INDEX IF NOT EXISTS idx_users_updated_at ON users (updated_at, tg_id);
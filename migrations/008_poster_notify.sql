@@ -0,0 +1,15 @@
+-- Миграция: Уведомление poster_changed при изменении афиш
+-- Дата: 2026-10-18
+-- Бот и API держат каталог активных афиш в памяти (poster_catalog.py) и перечитывают его по NOTIFY.
+-- Уведомление уходит при COMMIT, одинаковые уведомления одной транзакции PostgreSQL склеивает.
+
+CREATE OR REPLACE FUNCTION posters_notify_changed() RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM pg_notify('poster_changed', TG_OP);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS posters_notify_change ON posters;
+CREATE TRIGGER posters_notify_change AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON posters
+    FOR EACH STATEMENT EXECUTE FUNCTION posters_notify_changed();
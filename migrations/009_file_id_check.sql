@@ -0,0 +1,15 @@
+-- Миграция: Проверка Telegram file_id афиш и Stories
+-- Дата: 2026-10-18
+-- photo_path — локальная копия фото афиши (project/public/...), из неё бот перезаливает фото,
+-- если Telegram перестал принимать file_id. file_id_broken_at — когда file_id признан нерабочим.
+
+ALTER TABLE posters
+ADD COLUMN IF NOT EXISTS photo_path TEXT,
+ADD COLUMN IF NOT EXISTS file_id_broken_at TIMESTAMPTZ;
+
+ALTER TABLE stories
+ADD COLUMN IF NOT EXISTS file_id_broken_at TIMESTAMPTZ;
+
+COMMENT ON COLUMN posters.photo_path IS 'Путь к локальной копии фото афиши относительно project/public';
+COMMENT ON COLUMN posters.file_id_broken_at IS 'Когда getFile перестал принимать file_id (NULL — рабочий)';
+COMMENT ON COLUMN stories.file_id_broken_at IS 'Когда getFile перестал принимать file_id (NULL — рабочий)';
@@ -0,0 +1,22 @@
+-- Миграция: Уменьшенные копии фото афиш и Stories (images.py)
+-- Дата: 2026-10-18
+-- source — веб-путь оригинала (photo_path афиши или file_id Story с локальным файлом).
+-- Изменения вариантов тоже шлют poster_changed: каталог афиш отдаёт их в API.
+
+CREATE TABLE IF NOT EXISTS media_variants (
+    source TEXT NOT NULL,
+    variant TEXT NOT NULL,
+    format TEXT NOT NULL,
+    path TEXT NOT NULL,
+    width INTEGER NOT NULL,
+    height INTEGER NOT NULL,
+    bytes INTEGER NOT NULL,
+    created_at TIMESTAMPTZ DEFAULT now(),
+    PRIMARY KEY (source, variant, format)
+);
+
+DROP TRIGGER IF EXISTS media_variants_notify_change ON media_variants;
+CREATE TRIGGER media_variants_notify_change AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON media_variants
+    FOR EACH STATEMENT EXECUTE FUNCTION posters_notify_changed();
+
+COMMENT ON TABLE media_variants IS 'Варианты фото (thumb/card/full в WebP и JPEG) для веб-приложения';
@@ -0,0 +1,12 @@
+-- Миграция: Единое ограничение возраста пользователей
+-- Дата: 2026-10-18
+-- Базы, созданные старыми скриптами, допускали возраст от 14 лет, новые — от 16.
+-- Бот принимает 16–100, ограничение пересоздаётся с этим же диапазоном.
+-- NOT VALID: существующие строки не проверяются и не меняются, проверяются только
+-- новые записи. Возраст вне диапазона бот спрашивает у пользователя заново.
+-- Пока пользователь не ответил, UPDATE его строки тоже не пройдёт проверку:
+-- mark_users_blocked в этом случае отмечает пачку по одной строке.
+
+ALTER TABLE users DROP CONSTRAINT IF EXISTS users_age_check;
+ALTER TABLE users ADD CONSTRAINT users_age_check
+    CHECK (age >= 16 AND age <= 100) NOT VALID;
@@ -0,0 +1,168 @@
+"""
+Общий пул соединений PostgreSQL для бота, API и скриптов.
+
+Размеры и таймауты настраиваются через .env, у каждого соединения
+включены JSON-кодеки (json/jsonb <-> dict) и кэш подготовленных запросов.
+Пул считает время ожидания свободного соединения и показывает, сколько
+соединений занято, чтобы подбирать DB_POOL_MAX_SIZE по данным, а время
+самих запросов записывается в query_stats.
+"""
+
+import os
+import json
+import time
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Dict, Optional, Sequence, Tuple
+
+import asyncpg
+
+from query_stats import TimedConnection
+
+logger = logging.getLogger("TusaBot")
+
+DB_HOST = os.getenv("DB_HOST", "localhost")
+DB_PORT = int(os.getenv("DB_PORT", "5432"))
+DB_NAME = os.getenv("DB_NAME", "EuphoriaDB")
+DB_USER = os.getenv("DB_USER", "postgres")
+DB_PASSWORD = os.getenv("DB_PASSWORD", "1")
+
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", "2"))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", "10"))
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", "30"))
+# Сколько подготовленных запросов держать на каждом соединении
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "256"))
+# Через сколько секунд простоя закрывать лишние соединения
+DB_POOL_MAX_INACTIVE_LIFETIME = float(os.getenv("DB_POOL_MAX_INACTIVE_LIFETIME", "300"))
+# Ожидание свободного соединения дольше этого попадает в лог
+DB_POOL_SLOW_ACQUIRE = float(os.getenv("DB_POOL_SLOW_ACQUIRE_MS", "100")) / 1000
+
+
+async def _init_connection(conn: asyncpg.Connection) -> None:
+    """Настройка нового соединения: json/jsonb читаются и пишутся как dict/list"""
+    for type_name in ("json", "jsonb"):
+        await conn.set_type_codec(
+            type_name, encoder=json.dumps, decoder=json.loads, schema="pg_catalog"
+        )
+
+
+class InstrumentedPool:
+    """Обёртка над asyncpg.Pool с метриками ожидания соединений.
+
+    `acquire()` используется так же, как у asyncpg; остальные методы
+    пула (close, fetch, execute, get_size...) передаются как есть.
+    """
+
+    def __init__(self, pool: asyncpg.Pool, name: str = "db"):
+        self._pool = pool
+        self.name = name
+        self.acquired = 0
+        self.waiting = 0
+        self.max_waiting = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.slow_acquires = 0
+
+    def __getattr__(self, item: str) -> Any:
+        return getattr(self._pool, item)
+
+    @asynccontextmanager
+    async def acquire(self, *, timeout: Optional[float] = None) -> AsyncIterator[TimedConnection]:
+        started = time.monotonic()
+        self.waiting += 1
+        self.max_waiting = max(self.max_waiting, self.waiting)
+        try:
+            conn = await self._pool.acquire(timeout=timeout)
+        finally:
+            self.waiting -= 1
+        waited = time.monotonic() - started
+        self.acquired += 1
+        self.wait_total += waited
+        self.wait_max = max(self.wait_max, waited)
+        if waited >= DB_POOL_SLOW_ACQUIRE:
+            self.slow_acquires += 1
+            logger.warning(
+                "DB pool %s: waited %.0f ms for a connection (%d/%d in use)",
+                self.name, waited * 1000, self.in_use, self._pool.get_max_size(),
+            )
+        try:
+            yield TimedConnection(conn)
+        finally:
+            await self._pool.release(conn)
+
+    @property
+    def in_use(self) -> int:
+        return self._pool.get_size() - self._pool.get_idle_size()
+
+    def stats(self) -> Dict[str, Any]:
+        """Снимок метрик пула: размеры, занятость и ожидание соединений"""
+        return {
+            "size": self._pool.get_size(),
+            "min_size": self._pool.get_min_size(),
+            "max_size": self._pool.get_max_size(),
+            "in_use": self.in_use,
+            "idle": self._pool.get_idle_size(),
+            "waiting": self.waiting,
+            "max_waiting": self.max_waiting,
+            "acquired": self.acquired,
+            "wait_avg_ms": self.wait_total / self.acquired * 1000 if self.acquired else 0.0,
+            "wait_max_ms": self.wait_max * 1000,
+            "slow_acquires": self.slow_acquires,
+        }
+
+
+def _connect_options() -> Dict[str, Any]:
+    return dict(host=DB_HOST, port=DB_PORT, database=DB_NAME, user=DB_USER, password=DB_PASSWORD)
+
+
+async def connect(**overrides: Any) -> asyncpg.Connection:
+    """Отдельное соединение вне пула (например, под LISTEN, которое живёт всё время работы)"""
+    options = dict(**_connect_options(), command_timeout=DB_COMMAND_TIMEOUT)
+    options.update(overrides)
+    conn = await asyncpg.connect(**options)
+    await _init_connection(conn)
+    return conn
+
+
+async def warmup(pool: InstrumentedPool, queries: Sequence[Tuple[str, Sequence[Any]]] = ()) -> None:
+    """Поднять min_size соединений и положить частые запросы в их кэш подготовленных запросов.
+
+    queries — пары (текст запроса, безобидные аргументы). Запрос выполняется
+    через fetch: conn.prepare() кэш соединения не наполняет.
+    """
+    async def prepare() -> None:
+        async with pool.acquire() as conn:
+            for query, args in queries:
+                try:
+                    await conn.fetch(query, *args)
+                except asyncpg.PostgresError as e:
+                    # Например, таблицы ещё нет до первой миграции — это не повод не стартовать
+                    logger.debug("DB pool %s: warmup query skipped: %s", pool.name, e)
+
+    await asyncio.gather(*(prepare() for _ in range(pool.get_min_size())))
+
+
+async def create_pool(
+    name: str = "db",
+    warmup_queries: Sequence[Tuple[str, Sequence[Any]]] = (),
+    **overrides: Any,
+) -> InstrumentedPool:
+    """Создать пул с общими настройками; `overrides` передаются в asyncpg.create_pool"""
+    options = dict(
+        **_connect_options(),
+        min_size=DB_POOL_MIN_SIZE,
+        max_size=DB_POOL_MAX_SIZE,
+        command_timeout=DB_COMMAND_TIMEOUT,
+        statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+        max_inactive_connection_lifetime=DB_POOL_MAX_INACTIVE_LIFETIME,
+        init=_init_connection,
+    )
+    options.update(overrides)
+    pool = InstrumentedPool(await asyncpg.create_pool(**options), name=name)
+    await warmup(pool, warmup_queries)
+    logger.info(
+        "DB pool %s ready: %d-%d connections, command timeout %.0fs",
+        name, options["min_size"], options["max_size"], options["command_timeout"],
+    )
+    return pool
@@ -0,0 +1,158 @@
+"""
+Каталог активных афиш в памяти — общий для бота и API.
+
+Снимок каталога неизменяемый: при изменении афиш строится новый и
+подменяется одним присваиванием, поэтому чтение — обычный доступ к
+атрибуту, без блокировок и запросов к БД. Триггер на posters (миграция
+008) шлёт NOTIFY poster_changed; каталог слушает канал на отдельном
+соединении и перечитывает афиши. После обрыва соединения каталог
+переподключается и перечитывает всё: уведомления за это время потеряны.
+"""
+
+import os
+import asyncio
+import logging
+from dataclasses import dataclass, field
+from datetime import datetime
+from types import MappingProxyType
+from typing import Any, Dict, Mapping, Optional, Sequence
+
+import asyncpg
+
+import pg_pool
+from db import get_active_posters
+
+logger = logging.getLogger("TusaBot")
+
+POSTER_CHANNEL = "poster_changed"
+# Несколько изменений подряд (удаление + вставка) перечитываются одним запросом
+POSTER_CATALOG_DEBOUNCE = float(os.getenv("POSTER_CATALOG_DEBOUNCE_MS", "50")) / 1000
+POSTER_CATALOG_RECONNECT = float(os.getenv("POSTER_CATALOG_RECONNECT", "5"))
+
+Poster = Mapping[str, Any]
+
+
+@dataclass(frozen=True)
+class PosterSnapshot:
+    """Активные афиши от старых к новым: posters[-1] — текущая"""
+
+    posters: tuple[Poster, ...] = ()
+    by_id: Mapping[int, Poster] = field(default_factory=lambda: MappingProxyType({}))
+    loaded_at: Optional[datetime] = None
+
+    @classmethod
+    def build(cls, rows: Sequence[Dict[str, Any]]) -> "PosterSnapshot":
+        """rows — в порядке get_active_posters (от новых к старым)"""
+        posters = tuple(MappingProxyType(dict(row)) for row in reversed(rows))
+        return cls(
+            posters=posters,
+            by_id=MappingProxyType({p["id"]: p for p in posters}),
+            loaded_at=datetime.now(),
+        )
+
+    @property
+    def latest(self) -> Optional[Poster]:
+        return self.posters[-1] if self.posters else None
+
+
+class PosterCatalog:
+    """Держит текущий снимок афиш и обновляет его по NOTIFY poster_changed"""
+
+    def __init__(self):
+        self.snapshot = PosterSnapshot()
+        self.refreshes = 0
+        # Перечитывания могут пересечься: снимок из более раннего запроса не должен затереть свежий
+        self._started = 0
+        self._applied = 0
+        self._pool: Optional[asyncpg.Pool] = None
+        self._conn: Optional[asyncpg.Connection] = None
+        self._listener: Optional[asyncio.Task] = None
+        self._pending: Optional[asyncio.Task] = None
+        self._lost = asyncio.Event()
+
+    # --- чтение ---
+
+    @property
+    def posters(self) -> tuple[Poster, ...]:
+        return self.snapshot.posters
+
+    @property
+    def latest(self) -> Optional[Poster]:
+        return self.snapshot.latest
+
+    def get(self, poster_id: int) -> Optional[Poster]:
+        return self.snapshot.by_id.get(poster_id)
+
+    def __len__(self) -> int:
+        return len(self.snapshot.posters)
+
+    # --- обновление ---
+
+    async def refresh(self, pool: Optional[asyncpg.Pool] = None) -> PosterSnapshot:
+        """Перечитать активные афиши и подменить снимок"""
+        pool = pool or self._pool
+        self._started += 1
+        generation = self._started
+        rows = await get_active_posters(pool)
+        if generation > self._applied:
+            self.snapshot = PosterSnapshot.build(rows)
+            self._applied = generation
+        self.refreshes += 1
+        logger.debug("Poster catalog refreshed: %d active posters", len(self.snapshot.posters))
+        return self.snapshot
+
+    async def _refresh_later(self) -> None:
+        await asyncio.sleep(POSTER_CATALOG_DEBOUNCE)
+        self._pending = None
+        try:
+            await self.refresh()
+        except Exception as e:
+            logger.warning("Failed to refresh poster catalog: %s", e)
+
+    def _on_notify(self, conn: asyncpg.Connection, pid: int, channel: str, payload: str) -> None:
+        if self._pending is None:
+            self._pending = asyncio.create_task(self._refresh_later())
+
+    def _on_terminate(self, conn: asyncpg.Connection) -> None:
+        self._lost.set()
+
+    async def _listen(self) -> None:
+        """Держать LISTEN-соединение, переподключаясь после обрывов"""
+        while True:
+            try:
+                self._lost.clear()
+                self._conn = await pg_pool.connect()
+                self._conn.add_termination_listener(self._on_terminate)
+                await self._conn.add_listener(POSTER_CHANNEL, self._on_notify)
+                # Изменения между загрузкой и LISTEN (или за время обрыва) пришли без нас
+                await self.refresh()
+                logger.info("Poster catalog: listening for %s, %d active posters", POSTER_CHANNEL, len(self))
+                await self._lost.wait()
+                logger.warning("Poster catalog: listen connection lost, reconnecting")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Poster catalog: listen failed: %s", e)
+            finally:
+                if self._conn is not None and not self._conn.is_closed():
+                    self._conn.terminate()
+                self._conn = None
+            await asyncio.sleep(POSTER_CATALOG_RECONNECT)
+
+    async def start(self, pool: asyncpg.Pool) -> None:
+        """Загрузить афиши и подписаться на изменения"""
+        self._pool = pool
+        # Слушатель стартует и при ошибке загрузки: он повторит её после переподключения
+        self._listener = asyncio.create_task(self._listen())
+        await self.refresh()
+
+    async def stop(self) -> None:
+        if self._pending is not None:
+            self._pending.cancel()
+        if self._listener is not None:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+        self._listener = self._pending = None
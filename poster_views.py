@@ -0,0 +1,159 @@
+"""
+Готовые представления афиш для бота и API.
+
+Подпись с «Афиша N из M», title/subtitle, photo_url, JSON для API и
+клавиатуры строятся один раз на версию каталога афиш и дальше
+отдаются из памяти. Новая версия — это другой набор объектов афиш
+(каталог при обновлении создаёт новые), поэтому сверка идёт по
+идентичности, без сравнения содержимого.
+"""
+
+from dataclasses import dataclass
+from typing import Any, Dict, Mapping, Optional, Sequence, Tuple
+
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup
+
+from images import pick_variant, variants_json
+
+PROMOTER_URL = "https://t.me/euphoriamsktus"
+
+Poster = Mapping[str, Any]
+
+
+def split_caption(caption: str) -> Tuple[str, str]:
+    """Первая строка подписи — заголовок, остальное — подзаголовок"""
+    lines = caption.split('\n', 1)
+    title = lines[0] if lines else "Мероприятие"
+    subtitle = lines[1] if len(lines) > 1 else ""
+    return title, subtitle
+
+
+def photo_url(file_id: str) -> str:
+    """URL фото для веб-приложения: локальный файл или прокси к Telegram"""
+    # file_id может быть путем к файлу (/posters/poster_123.jpg) или Telegram file_id
+    if file_id.startswith('/posters/') or file_id.startswith('posters/'):
+        return file_id if file_id.startswith('/') else f'/{file_id}'
+    return f"/photo/{file_id}"
+
+
+def _action_rows(poster: Poster, venue_map_callback: str) -> list:
+    rows = []
+    # 1. Кнопка билетов (если есть ссылка)
+    if poster.get("ticket_url"):
+        rows.append([InlineKeyboardButton("🎫 Купить билет", url=poster["ticket_url"])])
+    # 2. Кнопка работы промоутером (всегда)
+    rows.append([InlineKeyboardButton("💼 Работа промоутером", url=PROMOTER_URL)])
+    # 3. Кнопка схемы зала (если есть)
+    if poster.get("venue_map_file_id"):
+        rows.append([InlineKeyboardButton("🗺 Схема зала", callback_data=venue_map_callback)])
+    return rows
+
+
+@dataclass(frozen=True)
+class PosterView:
+    poster: Poster
+    caption: str
+    title: str
+    subtitle: str
+    # Кнопки для рассылки и публикации в канал (без навигации); клавиатуры PTB
+    # неизменяемы, поэтому один объект можно отдавать всем получателям
+    broadcast_markup: InlineKeyboardMarkup
+    # Афиша в формате веб-приложения (None — если афиши ещё нет в БД)
+    web: Optional[Dict[str, Any]]
+
+    @classmethod
+    def build(cls, poster: Poster) -> "PosterView":
+        caption = poster.get("caption") or ""
+        title, subtitle = split_caption(caption)
+        web = None
+        if poster.get("id") and poster.get("file_id") and poster.get("created_at"):
+            variants = poster.get("variants")
+            web = {
+                "id": poster["id"],
+                "file_id": poster["file_id"],
+                # Готовая уменьшенная копия вместо оригинала, если она уже построена
+                "photo_url": pick_variant(variants) or photo_url(poster["file_id"]),
+                "images": variants_json(variants),
+                "caption": caption,
+                "title": title,
+                "subtitle": subtitle,
+                "ticket_url": poster.get("ticket_url"),
+                "venue_map_file_id": poster.get("venue_map_file_id"),
+                "created_at": poster["created_at"].isoformat(),
+                "is_active": poster.get("is_active", True),
+            }
+        return cls(
+            poster=poster,
+            caption=caption,
+            title=title,
+            subtitle=subtitle,
+            broadcast_markup=InlineKeyboardMarkup(_action_rows(poster, "view_venue_map:0")),
+            web=web,
+        )
+
+
+class PosterViews:
+    """Представления одной версии списка афиш (от старых к новым)"""
+
+    def __init__(self, posters: Sequence[Poster]):
+        self.posters = tuple(posters)
+        self.views = tuple(PosterView.build(p) for p in self.posters)
+        # Для API: новые первыми, как ORDER BY created_at DESC
+        self.web = [v.web for v in reversed(self.views) if v.web is not None]
+        self._carousel: Dict[Tuple[Any, int, bool], Tuple[str, InlineKeyboardMarkup]] = {}
+
+    def matches(self, posters: Sequence[Poster]) -> bool:
+        return len(posters) == len(self.posters) and all(a is b for a, b in zip(posters, self.posters))
+
+    @property
+    def latest(self) -> Optional[PosterView]:
+        return self.views[-1] if self.views else None
+
+    def carousel(self, position: int, is_admin: bool) -> Tuple[str, InlineKeyboardMarkup]:
+        """Подпись и кнопки афиши в главном меню (позиция в списке, админ ли смотрит)"""
+        view = self.views[position]
+        key = (view.poster.get("id"), position, is_admin)
+        cached = self._carousel.get(key)
+        if cached is None:
+            cached = self._carousel[key] = self._build_carousel(view, position, is_admin)
+        return cached
+
+    def _build_carousel(self, view: PosterView, position: int, is_admin: bool) -> Tuple[str, InlineKeyboardMarkup]:
+        total = len(self.views)
+        caption = view.caption
+        rows = []
+        # Навигация по афишам (если больше одной)
+        if total > 1:
+            caption += f"\n\n📍 Афиша {position + 1} из {total}"
+            nav_row = []
+            if position > 0:
+                nav_row.append(InlineKeyboardButton("⬅️ Предыдущая", callback_data="poster_prev"))
+            if position < total - 1:
+                nav_row.append(InlineKeyboardButton("➡️ Следующая", callback_data="poster_next"))
+            if nav_row:
+                rows.append(nav_row)
+        rows.extend(_action_rows(view.poster, f"view_venue_map:{position}"))
+        # Админские кнопки
+        if is_admin:
+            rows.append([
+                InlineKeyboardButton("🛠 Админ-панель", callback_data="open_admin"),
+                InlineKeyboardButton("🗑 Удалить", callback_data=f"delete_poster:{position}"),
+            ])
+        return caption, InlineKeyboardMarkup(rows)
+
+
+class PosterViewCache:
+    """Хранит представления последней версии списка афиш"""
+
+    def __init__(self):
+        self._views = PosterViews(())
+        self.builds = 0
+
+    def get(self, posters: Sequence[Poster]) -> PosterViews:
+        if not self._views.matches(posters):
+            self._views = PosterViews(posters)
+            self.builds += 1
+        return self._views
+
+
+poster_views = PosterViewCache()
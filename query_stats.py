@@ -0,0 +1,151 @@
+"""
+Статистика запросов к БД по вызывающим функциям.
+
+Соединения из pg_pool отдаются обёрнутыми в TimedConnection: каждый
+execute/fetch* засекается и записывается под именем функции, которая
+его вызвала (например, db.get_user_stats). Запросы дольше
+DB_SLOW_QUERY_MS попадают в лог — с текстом, но без значений параметров.
+Статистика своя у каждого процесса (бот и API считают отдельно).
+"""
+
+import os
+import re
+import sys
+import time
+import logging
+from collections import deque
+from typing import Any, Dict, List
+
+import asyncpg
+
+logger = logging.getLogger("TusaBot")
+
+DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "200"))
+# По скольким последним вызовам каждого запроса считать перцентили
+DB_QUERY_STATS_WINDOW = int(os.getenv("DB_QUERY_STATS_WINDOW", "1000"))
+
+_WHITESPACE = re.compile(r"\s+")
+
+
+def redact(args: tuple) -> str:
+    """Параметры запроса для лога: только типы и размеры, без значений"""
+    parts = []
+    for i, value in enumerate(args, 1):
+        if value is None:
+            shown = "NULL"
+        elif isinstance(value, (str, bytes, list, tuple, dict)):
+            shown = f"<{type(value).__name__}:{len(value)}>"
+        else:
+            shown = f"<{type(value).__name__}>"
+        parts.append(f"${i}={shown}")
+    return ", ".join(parts)
+
+
+def _percentile(ordered: List[float], q: float) -> float:
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+class QueryStats:
+    """Счётчики, суммарное время и перцентили задержки по именам запросов"""
+
+    def __init__(self, window: int = DB_QUERY_STATS_WINDOW, slow_ms: float = DB_SLOW_QUERY_MS):
+        self.window = window
+        self.slow = slow_ms / 1000
+        self._stats: Dict[str, Dict[str, Any]] = {}
+
+    def record(self, name: str, query: str, args: tuple, elapsed: float, error: bool = False) -> None:
+        entry = self._stats.get(name)
+        if entry is None:
+            entry = self._stats[name] = {
+                "count": 0, "errors": 0, "slow": 0, "total": 0.0, "max": 0.0,
+                "recent": deque(maxlen=self.window),
+            }
+        entry["count"] += 1
+        entry["total"] += elapsed
+        entry["max"] = max(entry["max"], elapsed)
+        entry["recent"].append(elapsed)
+        if error:
+            entry["errors"] += 1
+        if elapsed >= self.slow:
+            entry["slow"] += 1
+            text = _WHITESPACE.sub(" ", query).strip()
+            logger.warning(
+                "Slow query %s: %.0f ms: %s [%s]",
+                name, elapsed * 1000, text[:300], redact(args),
+            )
+
+    def snapshot(self) -> List[Dict[str, Any]]:
+        """Статистика по запросам, от самых затратных по суммарному времени"""
+        rows = []
+        for name, entry in self._stats.items():
+            ordered = sorted(entry["recent"])
+            rows.append({
+                "name": name,
+                "count": entry["count"],
+                "errors": entry["errors"],
+                "slow": entry["slow"],
+                "total_ms": entry["total"] * 1000,
+                "avg_ms": entry["total"] / entry["count"] * 1000,
+                "p50_ms": _percentile(ordered, 0.50) * 1000,
+                "p95_ms": _percentile(ordered, 0.95) * 1000,
+                "p99_ms": _percentile(ordered, 0.99) * 1000,
+                "max_ms": entry["max"] * 1000,
+            })
+        rows.sort(key=lambda row: row["total_ms"], reverse=True)
+        return rows
+
+    def reset(self) -> None:
+        self._stats.clear()
+
+
+query_stats = QueryStats()
+
+
+class TimedConnection:
+    """Соединение asyncpg, которое записывает время запросов в query_stats.
+
+    Имя запроса — модуль и функция, вызвавшая execute/fetch*; остальное
+    (transaction, cursor, prepare...) передаётся соединению как есть.
+    """
+
+    def __init__(self, conn: asyncpg.Connection, stats: QueryStats = query_stats):
+        self._conn = conn
+        self._stats = stats
+
+    def __getattr__(self, item: str) -> Any:
+        return getattr(self._conn, item)
+
+    async def _timed(self, name: str, method: str, query: str, args: tuple, kwargs: Dict[str, Any]) -> Any:
+        started = time.perf_counter()
+        failed = False
+        try:
+            return await getattr(self._conn, method)(query, *args, **kwargs)
+        except Exception:
+            failed = True
+            raise
+        finally:
+            self._stats.record(name, query, args, time.perf_counter() - started, error=failed)
+
+    # Имя берётся синхронно, в момент вызова: так в стеке ещё точно стоит вызывающая функция
+    def _call(self, method: str, query: str, args: tuple, kwargs: Dict[str, Any]):
+        caller = sys._getframe(2)
+        name = f"{caller.f_globals.get('__name__', '?')}.{caller.f_code.co_name}"
+        return self._timed(name, method, query, args, kwargs)
+
+    def execute(self, query: str, *args: Any, **kwargs: Any):
+        return self._call("execute", query, args, kwargs)
+
+    def executemany(self, query: str, args: Any, **kwargs: Any):
+        return self._call("executemany", query, (args,), kwargs)
+
+    def fetch(self, query: str, *args: Any, **kwargs: Any):
+        return self._call("fetch", query, args, kwargs)
+
+    def fetchrow(self, query: str, *args: Any, **kwargs: Any):
+        return self._call("fetchrow", query, args, kwargs)
+
+    def fetchval(self, query: str, *args: Any, **kwargs: Any):
+        return self._call("fetchval", query, args, kwargs)
+
+    def copy_records_to_table(self, table_name: str, **kwargs: Any):
+        return self._call("copy_records_to_table", table_name, (), kwargs)
@@ -0,0 +1,116 @@
+"""
+Отложенная запись профилей при регистрации.
+
+Шаги регистрации (имя, пол, возраст) не пишут в БД сами: изменения
+склеиваются по tg_id и раз в несколько миллисекунд уходят одним
+многострочным upsert. Так всплеск /start после анонса не занимает
+по соединению пула на каждый шаг каждого пользователя.
+Свои изменения пользователь видит сразу — через user_cache.
+"""
+
+import os
+import asyncio
+import logging
+from typing import Any, Dict, Optional
+
+import asyncpg
+
+from db import upsert_users
+from user_cache import user_cache
+
+logger = logging.getLogger("TusaBot")
+
+REGISTRATION_FLUSH_MS = float(os.getenv("REGISTRATION_FLUSH_MS", "50"))
+REGISTRATION_FLUSH_BATCH = int(os.getenv("REGISTRATION_FLUSH_BATCH", "500"))
+# Пауза перед повтором, если запись в БД не удалась
+REGISTRATION_RETRY_DELAY = 1.0
+
+
+class RegistrationBuffer:
+    """Буфер изменений профилей с записью пачками"""
+
+    def __init__(
+        self,
+        pool: asyncpg.Pool,
+        interval: float = REGISTRATION_FLUSH_MS / 1000,
+        max_batch: int = REGISTRATION_FLUSH_BATCH,
+    ):
+        self.pool = pool
+        self.interval = interval
+        self.max_batch = max_batch
+        self._pending: Dict[int, Dict[str, Any]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self._lock = asyncio.Lock()
+
+    def update(self, tg_id: int, **fields: Any) -> None:
+        """Запомнить изменения профиля; None-поля не затирают известные значения"""
+        fields = {key: value for key, value in fields.items() if value is not None}
+        self._pending[tg_id] = {**self._pending.get(tg_id, {}), **fields}
+        user_cache.stage(tg_id, fields)
+        if len(self._pending) >= self.max_batch:
+            self._schedule(0)
+        else:
+            self._schedule(self.interval)
+
+    def _schedule(self, delay: float) -> None:
+        # Пока _task задан, он ещё ждёт таймера, и его можно безопасно отменить
+        if self._task is not None and delay == 0:
+            # Пачка набралась раньше таймера — пишем сразу
+            self._task.cancel()
+            self._task = None
+        if self._task is None:
+            self._task = asyncio.create_task(self._flush_later(delay))
+
+    async def _flush_later(self, delay: float) -> None:
+        await asyncio.sleep(delay)
+        self._task = None
+        await self.flush()
+
+    async def flush(self) -> None:
+        async with self._lock:
+            if not self._pending:
+                return
+            batch, self._pending = self._pending, {}
+            try:
+                rows = await upsert_users(self.pool, batch)
+            except (asyncpg.IntegrityConstraintViolationError, asyncpg.DataError) as e:
+                # Одна строка с неверными данными не должна держать всю пачку
+                logger.warning("Profile batch of %d rejected (%s), writing row by row", len(batch), e)
+                rows = await self._flush_rows(batch)
+            except Exception as e:
+                logger.warning("Failed to flush %d profile updates: %s", len(batch), e)
+                self._requeue(batch)
+                return
+            for row in rows:
+                user_cache.commit(row["tg_id"], row, batch[row["tg_id"]])
+            logger.debug("Flushed %d profile updates", len(rows))
+
+    async def _flush_rows(self, batch: Dict[int, Dict[str, Any]]) -> list:
+        """Записать пачку по одной строке; отклонённые БД строки отбрасываются"""
+        rows = []
+        items = list(batch.items())
+        for i, (tg_id, fields) in enumerate(items):
+            try:
+                rows.extend(await upsert_users(self.pool, {tg_id: fields}))
+            except (asyncpg.IntegrityConstraintViolationError, asyncpg.DataError) as e:
+                # Повтор не поможет: данные не проходят ограничения таблицы
+                logger.warning("Dropped profile update for %s %s: %s", tg_id, fields, e)
+                user_cache.discard(tg_id, fields)
+            except Exception as e:
+                logger.warning("Failed to flush %d profile updates: %s", len(items) - i, e)
+                self._requeue(dict(items[i:]))
+                break
+        return rows
+
+    def _requeue(self, batch: Dict[int, Dict[str, Any]]) -> None:
+        # Более новые изменения важнее тех, что не удалось записать
+        for tg_id, fields in batch.items():
+            self._pending[tg_id] = {**fields, **self._pending.get(tg_id, {})}
+        self._schedule(REGISTRATION_RETRY_DELAY)
+
+    async def close(self) -> None:
+        """Остановить таймер и дописать всё, что осталось (при выключении бота)"""
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
@@ -0,0 +1,221 @@
+"""
+Реестр пользователей бота в памяти процесса — колонками NumPy.
+
+Заменяет set известных ID: на пользователя уходит ~16 байт вместо
+60+, а вопросы «сколько девушек 18–25», «сколько зарегистрировалось
+сегодня» считаются векторно по массивам без обращения к БД.
+
+Массивы отсортированы по tg_id. После полной загрузки при старте бот
+раз в ROSTER_SYNC_INTERVAL секунд забирает только строки users с новым
+updated_at. Удаления так не видны, поэтому если число строк разошлось
+со счётчиком users_total, реестр перечитывается целиком.
+"""
+
+import os
+import logging
+from datetime import date, datetime, timedelta
+from typing import Any, Dict, Iterable, Iterator, Optional, Sequence, Set
+
+import asyncpg
+import numpy as np
+
+from db import fetch_roster_rows, fetch_roster_changes, get_users_total, get_db_now
+
+logger = logging.getLogger("TusaBot")
+
+ROSTER_SYNC_INTERVAL = float(os.getenv("ROSTER_SYNC_INTERVAL", "30"))
+ROSTER_SYNC_BATCH = int(os.getenv("ROSTER_SYNC_BATCH", "50000"))
+# Запас при синхронизации: строки, записанные транзакцией, начатой до прошлой синхронизации,
+# получают updated_at в прошлом — перечитываем последние секунды повторно
+ROSTER_SYNC_OVERLAP = timedelta(seconds=60)
+
+GENDER_CODES = {"male": 1, "female": 2}
+EPOCH = date(1970, 1, 1)
+
+
+def _day(value: date) -> int:
+    return (value - EPOCH).days
+
+
+class UserRoster:
+    """Колонки tg_id, gender, age, reg_day, blocked; строка i — один пользователь.
+
+    gender: 0 — не указан, 1 — male, 2 — female; age: 0 — не указан;
+    reg_day: дней с 1970-01-01 (по часовому поясу БД), -1 — неизвестно.
+    Ведёт себя как набор ID для рассылок: len(), in, итерация и add().
+    """
+
+    def __init__(self):
+        self.tg_id = np.empty(0, dtype=np.int64)
+        self.gender = np.empty(0, dtype=np.int8)
+        self.age = np.empty(0, dtype=np.int16)
+        self.reg_day = np.empty(0, dtype=np.int32)
+        self.blocked = np.empty(0, dtype=bool)
+        self.synced_until: Optional[datetime] = None
+        # Начавшие диалог, но ещё не попавшие в users (или ещё не подтянутые синхронизацией)
+        self._extra: Set[int] = set()
+
+    # --- набор ID для рассылок ---
+
+    def _find(self, ids: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """Позиции ids в tg_id и маска найденных"""
+        pos = np.searchsorted(self.tg_id, ids)
+        if not len(self.tg_id):
+            return pos, np.zeros(len(ids), dtype=bool)
+        found = self.tg_id[np.minimum(pos, len(self.tg_id) - 1)] == ids
+        return pos, found
+
+    def __contains__(self, tg_id: int) -> bool:
+        if tg_id in self._extra:
+            return True
+        _, found = self._find(np.array([tg_id], dtype=np.int64))
+        return bool(found[0])
+
+    def __len__(self) -> int:
+        """Сколько пользователей можно рассылать (без заблокировавших бота)"""
+        return int(np.count_nonzero(~self.blocked)) + len(self._extra)
+
+    def __iter__(self) -> Iterator[int]:
+        for tg_id in self.tg_id[~self.blocked]:
+            yield int(tg_id)
+        yield from list(self._extra)
+
+    def add(self, tg_id: int) -> None:
+        if tg_id not in self:
+            self._extra.add(tg_id)
+
+    def mark_blocked(self, tg_ids: Iterable[int]) -> None:
+        """Исключить из рассылок заблокировавших бота (в БД они уже отмечены)"""
+        ids = np.fromiter(tg_ids, dtype=np.int64)
+        self._extra.difference_update(ids.tolist())
+        pos, found = self._find(ids)
+        self.blocked[pos[found]] = True
+
+    def unblock(self, tg_id: int) -> None:
+        """Вернуть в рассылки пользователя, снова написавшего боту (в БД отметка уже снята)"""
+        pos, found = self._find(np.array([tg_id], dtype=np.int64))
+        if found[0]:
+            self.blocked[pos[0]] = False
+        else:
+            self._extra.add(tg_id)
+
+    # --- синхронизация с БД ---
+
+    def _apply(self, rows: Sequence[asyncpg.Record]) -> None:
+        """Добавить/обновить строки users (в пачке каждый tg_id встречается один раз)"""
+        count = len(rows)
+        ids = np.fromiter((r['tg_id'] for r in rows), dtype=np.int64, count=count)
+        gender = np.fromiter((GENDER_CODES.get(r['gender'], 0) for r in rows), dtype=np.int8, count=count)
+        age = np.fromiter((r['age'] or 0 for r in rows), dtype=np.int16, count=count)
+        reg_day = np.fromiter(
+            (r['reg_day'] if r['reg_day'] is not None else -1 for r in rows), dtype=np.int32, count=count
+        )
+        blocked = np.fromiter((r['blocked'] for r in rows), dtype=bool, count=count)
+
+        order = np.argsort(ids, kind="stable")
+        ids, gender, age, reg_day, blocked = ids[order], gender[order], age[order], reg_day[order], blocked[order]
+        pos, found = self._find(ids)
+
+        at = pos[found]
+        self.gender[at] = gender[found]
+        self.age[at] = age[found]
+        self.reg_day[at] = reg_day[found]
+        self.blocked[at] = blocked[found]
+
+        new = ~found
+        if new.any():
+            at = pos[new]
+            self.tg_id = np.insert(self.tg_id, at, ids[new])
+            self.gender = np.insert(self.gender, at, gender[new])
+            self.age = np.insert(self.age, at, age[new])
+            self.reg_day = np.insert(self.reg_day, at, reg_day[new])
+            self.blocked = np.insert(self.blocked, at, blocked[new])
+            self._extra.difference_update(ids[new].tolist())
+
+    async def load(self, pool: asyncpg.Pool) -> None:
+        """Полная загрузка users (при старте и при расхождении со счётчиком)"""
+        started = await get_db_now(pool)
+        fresh = UserRoster()
+        fresh._extra = self._extra
+        after = 0
+        while True:
+            rows = await fetch_roster_rows(pool, after, ROSTER_SYNC_BATCH)
+            if not rows:
+                break
+            fresh._apply(rows)
+            after = rows[-1]['tg_id']
+        self.tg_id, self.gender, self.age = fresh.tg_id, fresh.gender, fresh.age
+        self.reg_day, self.blocked = fresh.reg_day, fresh.blocked
+        self.synced_until = started
+        logger.info("User roster loaded: %d users, %d KB", len(self.tg_id), self.nbytes // 1024)
+
+    async def sync(self, pool: asyncpg.Pool) -> int:
+        """Подтянуть изменения users с прошлой синхронизации. Возвращает число строк"""
+        if self.synced_until is None:
+            await self.load(pool)
+            return len(self.tg_id)
+        since, after, changed = self.synced_until - ROSTER_SYNC_OVERLAP, 0, 0
+        while True:
+            rows = await fetch_roster_changes(pool, since, after, ROSTER_SYNC_BATCH)
+            if not rows:
+                break
+            self._apply(rows)
+            changed += len(rows)
+            since, after = rows[-1]['updated_at'], rows[-1]['tg_id']
+            self.synced_until = max(self.synced_until, since)
+        total = await get_users_total(pool)
+        if total != len(self.tg_id):
+            logger.info("User roster drifted (%d vs %d in DB), reloading", len(self.tg_id), total)
+            await self.load(pool)
+        return changed
+
+    # --- векторные запросы ---
+
+    def mask(self, segment: Optional[Dict[str, Any]] = None) -> Optional[np.ndarray]:
+        """Маска строк сегмента рассылки (как db._segment_filter).
+
+        None — если сегмент требует данных, которых в реестре нет (poster_id).
+        """
+        segment = segment or {}
+        if segment.get("poster_id"):
+            return None
+        mask = ~self.blocked
+        if segment.get("gender"):
+            mask &= self.gender == GENDER_CODES.get(segment["gender"], -1)
+        if segment.get("age_min") is not None:
+            mask &= self.age >= segment["age_min"]
+        if segment.get("age_max") is not None:
+            mask &= (self.age > 0) & (self.age <= segment["age_max"])
+        if segment.get("registered_from"):
+            mask &= self.reg_day >= _day(segment["registered_from"])
+        if segment.get("registered_to"):
+            mask &= (self.reg_day >= 0) & (self.reg_day <= _day(segment["registered_to"]))
+        return mask
+
+    def count(self, segment: Optional[Dict[str, Any]] = None) -> Optional[int]:
+        """Размер аудитории сегмента или None, если его надо считать в БД"""
+        mask = self.mask(segment)
+        return int(np.count_nonzero(mask)) if mask is not None else None
+
+    def age_histogram(self, segment: Optional[Dict[str, Any]] = None) -> Dict[int, int]:
+        """Возраст -> число пользователей (без не указавших возраст)"""
+        mask = self.mask(segment)
+        if mask is None:
+            mask = ~self.blocked
+        ages = self.age[mask & (self.age > 0)]
+        counts = np.bincount(ages)
+        return {int(age): int(n) for age, n in enumerate(counts) if n}
+
+    def stats(self) -> Dict[str, int]:
+        """Те же показатели, что db.get_user_stats, плюс число заблокировавших"""
+        return {
+            "total_users": len(self.tg_id),
+            "male_users": int(np.count_nonzero(self.gender == GENDER_CODES["male"])),
+            "female_users": int(np.count_nonzero(self.gender == GENDER_CODES["female"])),
+            "today_registrations": int(np.count_nonzero(self.reg_day == _day(date.today()))),
+            "blocked_users": int(np.count_nonzero(self.blocked)),
+        }
+
+    @property
+    def nbytes(self) -> int:
+        return sum(a.nbytes for a in (self.tg_id, self.gender, self.age, self.reg_day, self.blocked))
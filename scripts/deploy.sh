@@ -32,8 +32,7 @@ pip install --upgrade pip
 pip install -r requirements.txt
 
 echo "🗄️ Running database migrations..."
-export PGPASSWORD="${DB_PASSWORD}"
-psql -h ${DB_HOST} -U ${DB_USER} -d ${DB_NAME} -f migrations/001_initial_schema.sql || true
+python migrate.py
 
 echo "📦 Building web application..."
 cd project
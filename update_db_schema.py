@@ -3,6 +3,8 @@ import asyncpg
 from dotenv import load_dotenv
 import os
 
+from migrate import migrate_connection
+
 async def update_database_schema():
     load_dotenv()
     
@@ -18,87 +20,10 @@ async def update_database_schema():
         print("🔄 Обновление структуры базы данных...")
         conn = await asyncpg.connect(**db_config)
         
-        # Добавляем недостающие колонки в таблицу users
-        await conn.execute('''
-            -- Добавляем колонку username, если её нет
-            ALTER TABLE users 
-            ADD COLUMN IF NOT EXISTS username TEXT;
-            
-            -- Добавляем ограничение для поля gender, если его нет
-            DO $$
-            BEGIN
-                IF NOT EXISTS (
-                    SELECT 1 FROM pg_constraint 
-                    WHERE conname = 'users_gender_check'
-                ) THEN
-                    ALTER TABLE users 
-                    ADD CONSTRAINT users_gender_check 
-                    CHECK (gender IN ('male', 'female'));
-                END IF;
-            END $$;
-            
-            -- Добавляем ограничение для поля age, если его нет
-            DO $$
-            BEGIN
-                IF NOT EXISTS (
-                    SELECT 1 FROM pg_constraint 
-                    WHERE conname = 'users_age_check'
-                ) THEN
-                    ALTER TABLE users 
-                    ADD CONSTRAINT users_age_check 
-                    CHECK (age >= 14 AND age <= 100);
-                END IF;
-            END $$;
-            
-            -- Обновляем значения по умолчанию для временных меток
-            ALTER TABLE users 
-            ALTER COLUMN created_at SET DEFAULT now(),
-            ALTER COLUMN updated_at SET DEFAULT now(),
-            ALTER COLUMN registered_at SET DEFAULT now();
-        ''')
-        
-        # Проверяем и обновляем таблицу posters
-        await conn.execute('''
-            -- Создаем таблицу posters, если её нет
-            CREATE TABLE IF NOT EXISTS posters (
-                id SERIAL PRIMARY KEY,
-                file_id TEXT NOT NULL,
-                caption TEXT,
-                ticket_url TEXT,
-                created_at TIMESTAMPTZ DEFAULT now(),
-                is_active BOOLEAN DEFAULT true
-            );
-        ''')
-        
-        # Проверяем и обновляем таблицу attendances
-        await conn.execute('''
-            -- Создаем таблицу attendances, если её нет
-            CREATE TABLE IF NOT EXISTS attendances (
-                id SERIAL PRIMARY KEY,
-                user_id BIGINT REFERENCES users(tg_id) ON DELETE CASCADE,
-                poster_id INTEGER REFERENCES posters(id) ON DELETE CASCADE,
-                attended_at TIMESTAMPTZ DEFAULT now(),
-                UNIQUE(user_id, poster_id)
-            );
-        ''')
-        
-        # Создаем или обновляем функцию для обновления updated_at
-        await conn.execute('''
-            CREATE OR REPLACE FUNCTION update_updated_at_column()
-            RETURNS TRIGGER AS $$
-            BEGIN
-                NEW.updated_at = now();
-                RETURN NEW;
-            END;
-            $$ LANGUAGE plpgsql;
-            
-            -- Создаем или обновляем триггер для users
-            DROP TRIGGER IF EXISTS update_users_updated_at ON users;
-            CREATE TRIGGER update_users_updated_at
-            BEFORE UPDATE ON users
-            FOR EACH ROW
-            EXECUTE FUNCTION update_updated_at_column();
-        ''')
+        # Вся схема описана в migrations/*.sql, применяем только новые миграции
+        applied = await migrate_connection(conn)
+        if applied:
+            print("Применены миграции: " + ", ".join(applied))
         
         print("✅ Структура базы данных успешно обновлена!")
         
@@ -0,0 +1,110 @@
+"""
+Кэш профилей пользователей в памяти процесса.
+
+Стоит перед db.get_user: навигация по меню и кнопкам не ходит в БД
+за пользователями, которых бот уже знает. Записи обновляются на месте
+функциями записи из db.py, поэтому TTL нужен только на случай правок
+БД в обход бота (api.py, скрипты).
+"""
+
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "50000"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "600"))
+
+MISSING = object()
+
+
+class UserCache:
+    """LRU с ограничением по размеру и времени жизни записей.
+
+    Хранится и отсутствие пользователя (None), чтобы незарегистрированные
+    не обращались к БД на каждом нажатии.
+    """
+
+    def __init__(self, maxsize: int = USER_CACHE_SIZE, ttl: float = USER_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data: "OrderedDict[int, tuple[float, Optional[Dict[str, Any]]]]" = OrderedDict()
+        # Изменения, ещё не записанные в БД (см. registration_buffer)
+        self._staged: Dict[int, Dict[str, Any]] = {}
+
+    def get(self, tg_id: int) -> Any:
+        """Профиль из кэша (копия), None для известного отсутствия или MISSING"""
+        entry = self._data.get(tg_id)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self._data[tg_id]
+            self.misses += 1
+            return MISSING
+        self._data.move_to_end(tg_id)
+        self.hits += 1
+        return dict(entry[1]) if entry[1] is not None else None
+
+    def put(self, tg_id: int, profile: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+        """Положить профиль, прочитанный из БД, поверх него — ещё не записанные изменения.
+
+        Возвращает профиль в том виде, в каком он теперь лежит в кэше.
+        """
+        staged = self._staged.get(tg_id)
+        if staged:
+            profile = {**(profile or {"tg_id": tg_id}), **staged}
+        self._data[tg_id] = (time.monotonic() + self.ttl, dict(profile) if profile is not None else None)
+        self._data.move_to_end(tg_id)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+        return dict(profile) if profile is not None else None
+
+    def stage(self, tg_id: int, fields: Dict[str, Any]) -> None:
+        """Учесть изменение профиля до записи в БД (чтение своих записей)"""
+        self._staged[tg_id] = {**self._staged.get(tg_id, {}), **fields}
+        entry = self._data.get(tg_id)
+        if entry is not None:
+            self.put(tg_id, entry[1])
+
+    def commit(self, tg_id: int, profile: Dict[str, Any], fields: Dict[str, Any]) -> None:
+        """Изменения `fields` записаны в БД, `profile` — строка после записи"""
+        staged = self._staged.get(tg_id)
+        if staged is not None:
+            # Поля, изменённые заново во время записи, остаются в силе
+            for key, value in fields.items():
+                if staged.get(key) == value:
+                    staged.pop(key)
+            if not staged:
+                del self._staged[tg_id]
+        self.put(tg_id, profile)
+
+    def discard(self, tg_id: int, fields: Dict[str, Any]) -> None:
+        """Изменения `fields` отклонены БД: профиль снова читается из неё"""
+        staged = self._staged.get(tg_id)
+        if staged is not None:
+            for key, value in fields.items():
+                if staged.get(key) == value:
+                    staged.pop(key)
+            if not staged:
+                del self._staged[tg_id]
+        self._data.pop(tg_id, None)
+
+    def invalidate(self, *tg_ids: int) -> None:
+        for tg_id in tg_ids:
+            self._data.pop(tg_id, None)
+
+    def clear(self) -> None:
+        self._data.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "size": len(self._data),
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+user_cache = UserCache()